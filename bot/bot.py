@@ -1,7 +1,9 @@
 import os
 import time
+import json
 import secrets
 import html
+from contextvars import ContextVar
 from typing import Optional
 
 import requests
@@ -23,6 +25,7 @@ from telegram.ext import (
     ContextTypes,
     InlineQueryHandler,
     MessageHandler,
+    TypeHandler,
     filters,
 )
 
@@ -53,6 +56,9 @@ ANDROID_APP_LINK = os.getenv("ANDROID_APP_LINK", "https://t.me/ANDROIDAPPKK")
 ANDROID_INSTRUCTION_URL = os.getenv("ANDROID_INSTRUCTION_URL", "https://t.me/V7ck9ll_Checker/3")
 IOS_INSTRUCTION_URL = os.getenv("IOS_INSTRUCTION_URL", "https://t.me/V7ck9ll_Checker/2")
 INLINE_HTTP_TIMEOUT = float(os.getenv("INLINE_HTTP_TIMEOUT", "2.5"))
+# must not exceed the server's BULK_MAX_OPS
+BULK_MAX_OPS = int(os.getenv("BULK_MAX_OPS", "500"))
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH", "")
 PREMIUM_CHECK_EMOJI_ID = os.getenv("PREMIUM_CHECK_EMOJI_ID", "5211112665237175703")
 ANDROID_EMOJI_ID = os.getenv("ANDROID_EMOJI_ID", "5359758030198031389")
 IOS_EMOJI_ID = os.getenv("IOS_EMOJI_ID", "5334955749409834455")
@@ -80,6 +86,50 @@ METHOD_LABELS = {
 }
 
 
+# One trace id per Telegram update, sent to the server as a W3C traceparent
+# so its spans (TRACE_EXPORT_PATH on the server) join the bot's own.
+current_trace: ContextVar[Optional[str]] = ContextVar("current_trace", default=None)
+
+
+async def start_trace(update: object, context: ContextTypes.DEFAULT_TYPE):
+    current_trace.set(os.urandom(16).hex())
+
+
+def export_span(span: dict):
+    try:
+        with open(TRACE_EXPORT_PATH, "a") as f:
+            f.write(json.dumps(span, separators=(",", ":")) + "\n")
+    except OSError:
+        pass
+
+
+def server_post(path: str, **kwargs) -> requests.Response:
+    trace_id = current_trace.get() or os.urandom(16).hex()
+    span_id = os.urandom(8).hex()
+    headers = {"X-Bot-Secret": BOT_SECRET, "traceparent": f"00-{trace_id}-{span_id}-01"}
+    start = time.time()
+    started = time.perf_counter()
+    status = 0
+    try:
+        r = requests.post(f"{SERVER_URL}{path}", headers=headers, **kwargs)
+        status = r.status_code
+        return r
+    finally:
+        if TRACE_EXPORT_PATH:
+            export_span(
+                {
+                    "service": "bot",
+                    "trace_id": trace_id,
+                    "span_id": span_id,
+                    "parent_id": None,
+                    "name": f"POST {path}",
+                    "start": round(start, 6),
+                    "ms": round((time.perf_counter() - started) * 1000, 3),
+                    "status": status,
+                }
+            )
+
+
 def parse_plan_prices(raw: str) -> dict[int, int]:
     out: dict[int, int] = {}
     for part in raw.split(","):
@@ -320,9 +370,8 @@ async def issue_android_access_code(
 ):
     uid = user_id or str(update.effective_user.id)
     try:
-        r = requests.post(
-            f"{SERVER_URL}/issue",
-            headers={"X-Bot-Secret": BOT_SECRET},
+        r = server_post(
+            "/issue",
             json={"user_id": uid}
         )
         if r.status_code != 200:
@@ -344,9 +393,8 @@ async def issue_android_access_code(
 
 def fetch_android_access_code(user_id: str) -> tuple[Optional[str], Optional[str]]:
     try:
-        r = requests.post(
-            f"{SERVER_URL}/issue",
-            headers={"X-Bot-Secret": BOT_SECRET},
+        r = server_post(
+            "/issue",
             json={"user_id": user_id},
             timeout=INLINE_HTTP_TIMEOUT,
         )
@@ -362,9 +410,8 @@ def fetch_android_access_code(user_id: str) -> tuple[Optional[str], Optional[str
 
 def fetch_ios_link_by_user_id(user_id: str) -> tuple[Optional[str], Optional[str]]:
     try:
-        r = requests.post(
-            f"{SERVER_URL}/ios/get",
-            headers={"X-Bot-Secret": BOT_SECRET},
+        r = server_post(
+            "/ios/get",
             json={"user_id": user_id},
             timeout=INLINE_HTTP_TIMEOUT,
         )
@@ -657,9 +704,8 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("Допустимо от 0 до 3650 дней.")
             return
         try:
-            r = requests.post(
-                f"{SERVER_URL}/sub/set_days",
-                headers={"X-Bot-Secret": BOT_SECRET},
+            r = server_post(
+                "/sub/set_days",
                 json={"user_id": target_user, "days": days},
                 timeout=10,
             )
@@ -700,9 +746,8 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
         try:
-            r = requests.post(
-                f"{SERVER_URL}/ios/check_name",
-                headers={"X-Bot-Secret": BOT_SECRET},
+            r = server_post(
+                "/ios/check_name",
                 json={"name": name},
             )
             if r.status_code == 200 and not r.json().get("available", False):
@@ -731,9 +776,8 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("Ошибка сети при создании ссылки.")
             return
         try:
-            r = requests.post(
-                f"{SERVER_URL}/ios/create",
-                headers={"X-Bot-Secret": BOT_SECRET},
+            r = server_post(
+                "/ios/create",
                 json={
                     "user_id": str(update.effective_user.id),
                     "name": name,
@@ -782,9 +826,8 @@ async def on_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     file_id = update.message.photo[-1].file_id
     try:
-        r = requests.post(
-            f"{SERVER_URL}/payment/attach",
-            headers={"X-Bot-Secret": BOT_SECRET},
+        r = server_post(
+            "/payment/attach",
             json={"payment_id": int(payment_id), "screenshot_file_id": file_id},
         )
         if r.status_code != 200:
@@ -814,9 +857,8 @@ async def on_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def handle_ios_check(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: str):
     try:
-        r = requests.post(
-            f"{SERVER_URL}/ios/get",
-            headers={"X-Bot-Secret": BOT_SECRET},
+        r = server_post(
+            "/ios/get",
             json={"user_id": str(chat_id)},
         )
         if r.status_code != 200:
@@ -929,9 +971,8 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         if data == "admin_pending":
             try:
-                r = requests.post(
-                    f"{SERVER_URL}/payment/list",
-                    headers={"X-Bot-Secret": BOT_SECRET},
+                r = server_post(
+                    "/payment/list",
                     json={"status": "pending", "limit": 20},
                     timeout=10,
                 )
@@ -1008,9 +1049,8 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await query.message.reply_text("Некорректный user_id.")
                 return
             try:
-                r = requests.post(
-                    f"{SERVER_URL}/payment/by_user",
-                    headers={"X-Bot-Secret": BOT_SECRET},
+                r = server_post(
+                    "/payment/by_user",
                     json={"user_id": target_user, "limit": 20},
                     timeout=10,
                 )
@@ -1058,9 +1098,8 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await query.message.reply_text("Некорректный user_id.")
                 return
             try:
-                r = requests.post(
-                    f"{SERVER_URL}/sub/remove",
-                    headers={"X-Bot-Secret": BOT_SECRET},
+                r = server_post(
+                    "/sub/remove",
                     json={"user_id": target_user},
                     timeout=10,
                 )
@@ -1192,9 +1231,8 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         amount = PLAN_PRICES_MAP.get(int(months))
         try:
-            r = requests.post(
-                f"{SERVER_URL}/payment/create",
-                headers={"X-Bot-Secret": BOT_SECRET},
+            r = server_post(
+                "/payment/create",
                 json={
                     "user_id": user_id,
                     "plan_months": int(months),
@@ -1225,16 +1263,26 @@ async def remind_expiring(context: ContextTypes.DEFAULT_TYPE, days: int, label:
 
 def fetch_active_subscriptions(days_window: int = 3650) -> list[dict]:
     now = int(time.time())
+    items = []
+    # start the cursor at "now" so the server skips already expired rows
+    cursor = {"after_expires_at": now}
     try:
-        r = requests.post(
-            f"{SERVER_URL}/sub/expiring",
-            headers={"X-Bot-Secret": BOT_SECRET},
-            json={"days": days_window},
-            timeout=15,
-        )
-        if r.status_code != 200:
-            return []
-        items = r.json().get("items", [])
+        while True:
+            r = server_post(
+                "/sub/expiring",
+                json={"days": days_window, "limit": 500, **cursor},
+                timeout=15,
+            )
+            if r.status_code != 200:
+                return []
+            data = r.json()
+            items.extend(data.get("items", []))
+            if data.get("next_after_expires_at") is None:
+                break
+            cursor = {
+                "after_expires_at": data["next_after_expires_at"],
+                "after_user_id": data.get("next_after_user_id"),
+            }
     except Exception:
         return []
 
@@ -1291,9 +1339,8 @@ def parse_sub_set_lines(raw_text: str) -> tuple[list[tuple[str, int]], list[str]
 
 def set_subscription_days(target_user: str, days: int) -> tuple[bool, str]:
     try:
-        r = requests.post(
-            f"{SERVER_URL}/sub/set_days",
-            headers={"X-Bot-Secret": BOT_SECRET},
+        r = server_post(
+            "/sub/set_days",
             json={"user_id": target_user, "days": days},
             timeout=10,
         )
@@ -1303,13 +1350,46 @@ def set_subscription_days(target_user: str, days: int) -> tuple[bool, str]:
     except Exception:
         return False, f"{target_user}: ошибка сети"
 
+    return True, describe_set_days(target_user, data)
+
+
+def set_subscription_days_bulk(items: list[tuple[str, int]]) -> list[tuple[bool, str]]:
+    out = []
+    for start in range(0, len(items), BULK_MAX_OPS):
+        out.extend(set_subscription_days_chunk(items[start:start + BULK_MAX_OPS]))
+    return out
+
+
+def set_subscription_days_chunk(items: list[tuple[str, int]]) -> list[tuple[bool, str]]:
+    try:
+        r = server_post(
+            "/admin/bulk",
+            json={"ops": [{"op": "set_days", "user_id": u, "days": d} for u, d in items]},
+            timeout=30,
+        )
+        if r.status_code != 200:
+            return [(False, f"{target_user}: ошибка сервера") for target_user, _ in items]
+        results = r.json().get("results", [])
+    except Exception:
+        return [(False, f"{target_user}: ошибка сети") for target_user, _ in items]
+
+    out = []
+    for (target_user, _), data in zip(items, results):
+        if data.get("ok"):
+            out.append((True, describe_set_days(target_user, data)))
+        else:
+            out.append((False, f"{target_user}: {data.get('detail') or 'ошибка сервера'}"))
+    return out
+
+
+def describe_set_days(target_user: str, data: dict) -> str:
     if data.get("removed"):
-        return True, f"{target_user}: подписка удалена"
+        return f"{target_user}: подписка удалена"
 
     expires_at = int(data.get("expires_at") or 0)
     days_left = max(0, int((expires_at - int(time.time())) / 86400))
     until = time.strftime("%Y-%m-%d %H:%M", time.localtime(expires_at))
-    return True, f"{target_user}: {days_left} дн., до {until}"
+    return f"{target_user}: {days_left} дн., до {until}"
 
 
 def build_admin_subs_keyboard(items: list[dict], page: int, page_size: int = 8) -> InlineKeyboardMarkup:
@@ -1362,9 +1442,8 @@ async def approve(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("payment_id должен быть числом.")
         return
     try:
-        r = requests.post(
-            f"{SERVER_URL}/payment/approve",
-            headers={"X-Bot-Secret": BOT_SECRET},
+        r = server_post(
+            "/payment/approve",
             json={"payment_id": payment_id, "reviewer_id": str(update.effective_user.id)},
         )
         if r.status_code != 200:
@@ -1399,9 +1478,8 @@ async def reject(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("payment_id должен быть числом.")
         return
     try:
-        r = requests.post(
-            f"{SERVER_URL}/payment/reject",
-            headers={"X-Bot-Secret": BOT_SECRET},
+        r = server_post(
+            "/payment/reject",
             json={"payment_id": payment_id, "reviewer_id": str(update.effective_user.id)},
         )
         if r.status_code != 200:
@@ -1476,8 +1554,11 @@ async def sub_set(update: Update, context: ContextTypes.DEFAULT_TYPE):
     results: list[str] = []
     failed = 0
 
-    for target_user, days in items:
-        ok, message = set_subscription_days(target_user, days)
+    if len(items) == 1:
+        outcomes = [set_subscription_days(*items[0])]
+    else:
+        outcomes = set_subscription_days_bulk(items)
+    for ok, message in outcomes:
         results.append(("✅ " if ok else "❌ ") + message)
         if not ok:
             failed += 1
@@ -1508,9 +1589,8 @@ async def sub_del(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     target_user = context.args[0].strip()
     try:
-        r = requests.post(
-            f"{SERVER_URL}/sub/remove",
-            headers={"X-Bot-Secret": BOT_SECRET},
+        r = server_post(
+            "/sub/remove",
             json={"user_id": target_user},
             timeout=10,
         )
@@ -1547,9 +1627,8 @@ async def pending(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Недостаточно прав.")
         return
     try:
-        r = requests.post(
-            f"{SERVER_URL}/payment/list",
-            headers={"X-Bot-Secret": BOT_SECRET},
+        r = server_post(
+            "/payment/list",
             json={"status": "pending", "limit": 20},
         )
         if r.status_code != 200:
@@ -1581,9 +1660,8 @@ async def payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("payment_id должен быть числом.")
         return
     try:
-        r = requests.post(
-            f"{SERVER_URL}/payment/get",
-            headers={"X-Bot-Secret": BOT_SECRET},
+        r = server_post(
+            "/payment/get",
             json={"payment_id": payment_id},
         )
         if r.status_code != 200:
@@ -1624,9 +1702,8 @@ async def user_payments(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     user_id = context.args[0]
     try:
-        r = requests.post(
-            f"{SERVER_URL}/payment/by_user",
-            headers={"X-Bot-Secret": BOT_SECRET},
+        r = server_post(
+            "/payment/by_user",
             json={"user_id": user_id, "limit": 20},
         )
         if r.status_code != 200:
@@ -1658,9 +1735,8 @@ async def ios_bind(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Имя должно быть латиницей/цифрами и может содержать '-' или '_'.")
         return
     try:
-        r = requests.post(
-            f"{SERVER_URL}/ios/check_name",
-            headers={"X-Bot-Secret": BOT_SECRET},
+        r = server_post(
+            "/ios/check_name",
             json={"name": name},
         )
         if r.status_code == 200 and not r.json().get("available", False):
@@ -1689,9 +1765,8 @@ async def ios_bind(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Ошибка сети при создании ссылки.")
         return
     try:
-        r = requests.post(
-            f"{SERVER_URL}/ios/create",
-            headers={"X-Bot-Secret": BOT_SECRET},
+        r = server_post(
+            "/ios/create",
             json={"user_id": str(user_id), "name": name, "code": code},
         )
         if r.status_code == 409:
@@ -1731,6 +1806,7 @@ def main():
     if not BOT_TOKEN:
         raise RuntimeError("TELEGRAM_BOT_TOKEN is missing")
     app = Application.builder().token(BOT_TOKEN).post_init(setup_telegram_menu).build()
+    app.add_handler(TypeHandler(Update, start_trace), group=-1)
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("key", key))
     app.add_handler(CommandHandler("key_android", key_android))
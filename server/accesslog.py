@@ -0,0 +1,220 @@
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from typing import Optional
+
+from capture import anonymize
+from metrics import error_detail, stat_inc
+from ratelimit import MAX_KEYED_BODY, body_fields
+from storage import db_time
+from tracing import current
+
+HASHED_KEYS = ("user_id", "device_id")
+
+
+# "/validate=0.1/100": log 10% of the successful /validate requests and at
+# most 100 lines per second for that path (errors skip the share, not the
+# cap); "/validate=1/50" only caps. Paths without a rule log everything.
+def parse_sampling(spec: str) -> dict:
+    rules = {}
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        path, _, rule = part.partition("=")
+        share, _, per_second = rule.partition("/")
+        rules[path.strip()] = (min(1.0, float(share or 1)), float(per_second or 0))
+    return rules
+
+
+class Sampler:
+    def __init__(self, rules: dict):
+        self.rules = rules
+        # path -> [tokens, updated_at]; only touched from the event loop
+        self.buckets: dict = {}
+
+    def allow(self, route: str, status: int, now: float) -> Optional[float]:
+        # returns the share the line stands for, or None to skip it
+        rule = self.rules.get(route)
+        if rule is None:
+            return 1.0
+        share, per_second = rule
+        if status < 400 and share < 1.0 and random.random() >= share:
+            stat_inc("access_log_sampled_out_total")
+            return None
+        if per_second > 0:
+            bucket = self.buckets.setdefault(route, [per_second, now])
+            bucket[0] = min(per_second, bucket[0] + (now - bucket[1]) * per_second)
+            bucket[1] = now
+            if bucket[0] < 1.0:
+                stat_inc("access_log_capped_total")
+                return None
+            bucket[0] -= 1.0
+        return share if status < 400 else 1.0
+
+
+def format_entry(entry: dict, salt: bytes) -> str:
+    body = entry.pop("body", b"")
+    error = entry.pop("error", None)
+    if error is not None:
+        entry["detail"] = error_detail(error)
+    fields = body_fields(body) or {}
+    for key in HASHED_KEYS:
+        value = fields.get(key)
+        if isinstance(value, str) and value:
+            entry[key.split("_")[0]] = anonymize(value, key, salt)
+    return json.dumps(entry, separators=(",", ":"))
+
+
+# Request threads only put a dict on a queue (a LogRecord through a
+# QueueHandler costs ~10us more per request); JSON parsing, hashing and the
+# write happen in the writer thread, which drains the queue every
+# flush_seconds instead of waking up, and taking the GIL, per line. When the
+# output falls behind, lines are dropped and counted instead of blocking.
+# Lines go to stdout or are appended to path, which is reopened when
+# logrotate has moved it away.
+class AccessLog:
+    def __init__(self, path: str, salt: bytes, sampling: dict, max_pending: int = 10000, flush_seconds: float = 0.5):
+        self.path = path
+        self.sampler = Sampler(sampling)
+        self.flush_seconds = flush_seconds
+        self.salt = salt
+        self.max_pending = max_pending
+        self._queue: "queue.SimpleQueue[dict]" = queue.SimpleQueue()
+        self._file = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        if self.path:
+            self._file = open(self.path, "a", encoding="utf-8")
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="access-log", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _output(self):
+        if not self.path:
+            return sys.stdout
+        try:
+            on_disk = os.stat(self.path)
+            opened = os.fstat(self._file.fileno())
+            moved = (on_disk.st_dev, on_disk.st_ino) != (opened.st_dev, opened.st_ino)
+        except FileNotFoundError:
+            moved = True
+        if moved:
+            # open first: if that fails the old file is kept and retried next flush
+            reopened = open(self.path, "a", encoding="utf-8")
+            self._file.close()
+            self._file = reopened
+        return self._file
+
+    def _run(self):
+        while True:
+            stopping = self._stop.wait(self.flush_seconds)
+            self.flush()
+            if stopping:
+                return
+
+    def flush(self):
+        entries = []
+        while True:
+            try:
+                entries.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if not entries:
+            return
+        lines = []
+        for entry in entries:
+            try:
+                lines.append(format_entry(entry, self.salt) + "\n")
+            except Exception:
+                stat_inc("access_log_errors_total")
+        try:
+            output = self._output()
+            output.write("".join(lines))
+            output.flush()
+        except (OSError, ValueError):
+            stat_inc("access_log_errors_total")
+            return
+        stat_inc("access_log_lines_total", len(lines))
+
+    def put(self, entry: dict):
+        if self._queue.qsize() >= self.max_pending:
+            stat_inc("access_log_dropped_total")
+            return
+        self._queue.put(entry)
+
+
+class AccessLogMiddleware:
+    def __init__(self, app, log: AccessLog):
+        self.app = app
+        self.log = log
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        spent = [0.0]
+        token = db_time.set(spent)
+        status = 500
+        chunks: list = []
+        error_body: Optional[list] = None
+
+        async def receive_teed():
+            message = await receive()
+            if message["type"] == "http.request" and sum(map(len, chunks)) <= MAX_KEYED_BODY:
+                chunks.append(message.get("body", b""))
+            return message
+
+        async def send_logged(message):
+            nonlocal status, error_body
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if status >= 400:
+                    error_body = []
+            elif error_body is not None and len(error_body) < 4:
+                error_body.append(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive_teed, send_logged)
+        finally:
+            db_time.reset(token)
+            finished = time.perf_counter()
+            route = scope.get("route")
+            route = route.path if route is not None else scope["path"][:128]
+            share = self.log.sampler.allow(route, status, finished)
+            if share is not None:
+                entry = {
+                    "ts": round(time.time(), 3),
+                    "method": scope["method"],
+                    "route": route,
+                    "status": status,
+                    "ms": round((finished - started) * 1000, 2),
+                    "db_ms": round(spent[0] * 1000, 2),
+                    "body": b"".join(chunks),
+                }
+                trace = current.get()
+                if trace is not None:
+                    entry["trace_id"] = trace.trace_id
+                if share < 1.0:
+                    entry["sample"] = share
+                if error_body is not None:
+                    entry["error"] = b"".join(error_body)
+                self.log.put(entry)
@@ -0,0 +1,24 @@
+import argparse
+
+from main import archive_old, store
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move old reviewed payments and redeemed codes to the archive DB")
+    parser.add_argument("days", type=int, nargs="?", help="archive rows older than this (default ARCHIVE_AFTER_DAYS)")
+    parser.add_argument(
+        "--convert-vacuum",
+        action="store_true",
+        help="one-time full VACUUM that switches an existing DB to auto_vacuum=INCREMENTAL",
+    )
+    args = parser.parse_args()
+    store.init()
+    store.start()
+    try:
+        print(archive_old(older_than_days=args.days, convert_vacuum=args.convert_vacuum))
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""CPU cost of the JSON request/response path, stdlib vs fast codec.
+
+    python bench/codec_bench.py [--n 20000]
+
+Codec rows time the parse + render work alone; endpoint rows push requests
+through a bare FastAPI app with direct ASGI calls, so routing is included but
+storage and networking are not. Times are process CPU per request.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import anyio
+from fastapi import Depends, FastAPI
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastjson import CODEC, FastJSONResponse, json_body, raw_json  # noqa: E402
+from pydantic import BaseModel  # noqa: E402
+
+
+class ValidateReq(BaseModel):
+    session_token: str
+
+
+class VerifyReq(BaseModel):
+    code: str
+    device_id: str
+
+
+VALIDATE_BODY = json.dumps({"session_token": "x" * 43}).encode()
+VERIFY_BODY = json.dumps({"code": "V7-ABCD-EF12", "device_id": "android-0123456789abcdef"}).encode()
+VERIFY_RESULT = {"ok": True, "session_token": "x" * 43, "expires_at": 1760000000}
+PAYMENT_PAGE = {
+    "items": [
+        {
+            "id": 1000 - i,
+            "user_id": str(100000 + i),
+            "plan_months": 1,
+            "method": "UA",
+            "status": "pending",
+            "created_at": 1760000000 + i,
+        }
+        for i in range(50)
+    ],
+    "next_after_id": 951,
+}
+
+
+def cpu_us(fn, n: int) -> float:
+    fn()
+    started = time.process_time()
+    for _ in range(n):
+        fn()
+    return (time.process_time() - started) / n * 1e6
+
+
+def codec_cases():
+    return [
+        (
+            "validate",
+            lambda: (
+                ValidateReq(**json.loads(VALIDATE_BODY)),
+                JSONResponse(jsonable_encoder({"ok": True, "expires_at": 1760000000})).body,
+            ),
+            lambda: (
+                ValidateReq.model_validate_json(VALIDATE_BODY),
+                raw_json(b'{"ok":true,"expires_at":%d}' % 1760000000).body,
+            ),
+        ),
+        (
+            "verify",
+            lambda: (VerifyReq(**json.loads(VERIFY_BODY)), JSONResponse(jsonable_encoder(VERIFY_RESULT)).body),
+            lambda: (VerifyReq.model_validate_json(VERIFY_BODY), FastJSONResponse(VERIFY_RESULT).body),
+        ),
+        (
+            "payment_list(50)",
+            lambda: JSONResponse(jsonable_encoder(PAYMENT_PAGE)).body,
+            lambda: FastJSONResponse(PAYMENT_PAGE).body,
+        ),
+    ]
+
+
+def make_apps():
+    stdlib = FastAPI()
+    fast = FastAPI(default_response_class=FastJSONResponse)
+
+    @stdlib.post("/validate")
+    async def stdlib_validate(req: ValidateReq):
+        return {"ok": True, "expires_at": 1760000000}
+
+    @stdlib.post("/verify")
+    async def stdlib_verify(req: VerifyReq):
+        return VERIFY_RESULT
+
+    @fast.post("/validate")
+    async def fast_validate(req: ValidateReq = Depends(json_body(ValidateReq))):
+        return raw_json(b'{"ok":true,"expires_at":%d}' % 1760000000)
+
+    @fast.post("/verify")
+    async def fast_verify(req: VerifyReq = Depends(json_body(VerifyReq))):
+        return FastJSONResponse(VERIFY_RESULT)
+
+    return stdlib, fast
+
+
+async def asgi_us(app, path: str, body: bytes, n: int) -> float:
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        "client": ("127.0.0.1", 1),
+        "server": ("127.0.0.1", 80),
+    }
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start" and message["status"] != 200:
+            raise RuntimeError(f"{path}: HTTP {message['status']}")
+
+    await app(dict(scope), receive, send)
+    started = time.process_time()
+    for _ in range(n):
+        await app(dict(scope), receive, send)
+    return (time.process_time() - started) / n * 1e6
+
+
+def report(name: str, before: float, after: float):
+    print(f"{name:<24} {before:>9.2f} {after:>9.2f} {before - after:>9.2f} {before / after:>6.2f}x")
+
+
+async def run(n: int):
+    print(f"codec={CODEC} n={n}")
+    print(f"{'case (us cpu/req)':<24} {'stdlib':>9} {'fast':>9} {'saved':>9} {'ratio':>7}")
+    for name, before, after in codec_cases():
+        report(f"codec {name}", cpu_us(before, n), cpu_us(after, n))
+    stdlib, fast = make_apps()
+    for path, body in (("/validate", VALIDATE_BODY), ("/verify", VERIFY_BODY)):
+        report(
+            f"endpoint {path}",
+            await asgi_us(stdlib, path, body, n // 4),
+            await asgi_us(fast, path, body, n // 4),
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--n", type=int, default=20000)
+    args = parser.parse_args()
+    anyio.run(run, args.n)
+
+
+if __name__ == "__main__":
+    main()
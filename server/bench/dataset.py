@@ -0,0 +1,164 @@
+"""Synthetic production-like SQLite database for capacity tests.
+
+    python bench/dataset.py out.db --codes 1000000 [--payments N] [--seed 1]
+
+The schema comes from the real migrations (SqliteStorage.init, as init_db()
+does); rows are bulk inserted and the background index steps run afterwards,
+the same order a grown production file goes through. Distributions:
+
+- users: codes / 8 users, activity skewed (a few users hold many codes and
+  payments, most have one or two)
+- codes: created over --days with traffic growing towards now, 10 minute
+  TTL, ~85% redeemed (with device and session), the rest expired unused
+- payments: codes / 10 by default; 1/3/12 month plans (60/30/10%), methods
+  UA/RU/CRYPTO; older ones mostly approved, some rejected, a few stale
+  pending; the last two days are mostly pending
+- subscriptions: one per user with an approved payment, ending anywhere from
+  months ago to a year ahead
+- sessions: the short-lived tail that the sweeper has not purged yet
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import SqliteStorage  # noqa: E402
+
+DAY = 24 * 60 * 60
+MONTH = 30 * DAY
+CHUNK = 50000
+
+
+def code_for(i: int) -> str:
+    # multiplying by an odd constant is a bijection mod 2**32: unique codes
+    # spread over the whole space like random ones
+    value = (i * 2654435761) & 0xFFFFFFFF
+    return "V7-%04X-%04X" % (value >> 16, value & 0xFFFF)
+
+
+def user_for(rng: random.Random, users: int) -> str:
+    return str(100000000 + int(users * rng.random() ** 2.5))
+
+
+def created_at(rng: random.Random, now: int, days: int) -> int:
+    # sqrt skews towards now: traffic has grown over the period
+    return now - int(days * DAY * (1 - rng.random() ** 0.5))
+
+
+def code_rows(rng: random.Random, count: int, users: int, now: int, days: int):
+    for i in range(count):
+        created = created_at(rng, now, days)
+        expires_at = created + 600
+        if rng.random() < 0.85:
+            redeemed = created + rng.randint(5, 590)
+            yield (
+                code_for(i), user_for(rng, users), expires_at, 1,
+                "android-%016x" % rng.getrandbits(64), "%032x" % rng.getrandbits(128), redeemed + 600,
+            )
+        else:
+            yield code_for(i), user_for(rng, users), expires_at, 0, None, None, None
+
+
+def payment_rows(rng: random.Random, count: int, users: int, now: int, days: int, subscriptions: dict):
+    for _ in range(count):
+        user_id = user_for(rng, users)
+        created = created_at(rng, now, days)
+        months = rng.choices((1, 3, 12), (60, 30, 10))[0]
+        method = rng.choices(("UA", "RU", "CRYPTO"), (60, 25, 15))[0]
+        screenshot = "AgACAgIAAxkBAA%016x" % rng.getrandbits(64) if rng.random() < 0.9 else None
+        roll = rng.random()
+        if now - created < 2 * DAY:
+            status = "pending" if roll < 0.6 else "approved" if roll < 0.95 else "rejected"
+        else:
+            status = "approved" if roll < 0.82 else "rejected" if roll < 0.97 else "pending"
+        reviewed_at = reviewer_id = None
+        if status != "pending":
+            reviewed_at = created + int(rng.expovariate(1 / 7200))
+            reviewer_id = str(rng.choice((111, 222, 333)))
+        if status == "approved":
+            start = max(reviewed_at, subscriptions.get(user_id, 0))
+            subscriptions[user_id] = start + months * MONTH
+        yield user_id, months, method, screenshot, status, created, reviewed_at, reviewer_id
+
+
+def insert(conn, sql: str, rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= CHUNK:
+            conn.executemany(sql, batch)
+            conn.commit()
+            batch = []
+    if batch:
+        conn.executemany(sql, batch)
+        conn.commit()
+
+
+def generate(path: str, codes: int, payments: int = -1, days: int = 365, seed: int = 1, now: int = 0) -> dict:
+    if os.path.exists(path):
+        raise SystemExit(f"{path} already exists")
+    rng = random.Random(seed)
+    now = now or int(time.time())
+    payments = codes // 10 if payments < 0 else payments
+    users = max(100, codes // 8)
+    started = time.perf_counter()
+    store = SqliteStorage(path, slow_query_ms=0)
+    store.init()
+    conn = store.connect()
+    conn.execute("PRAGMA synchronous=OFF")
+    insert(
+        conn,
+        "INSERT INTO codes(code, user_id, expires_at, used, redeemed_device_id, session_token, session_expires_at) "
+        "VALUES(?, ?, ?, ?, ?, ?, ?)",
+        code_rows(rng, codes, users, now, days),
+    )
+    subscriptions: dict = {}
+    insert(
+        conn,
+        "INSERT INTO payments(user_id, plan_months, method, screenshot_file_id, status, created_at, reviewed_at, "
+        "reviewer_id) VALUES(?, ?, ?, ?, ?, ?, ?, ?)",
+        payment_rows(rng, payments, users, now, days, subscriptions),
+    )
+    insert(conn, "INSERT INTO subscriptions(user_id, expires_at) VALUES(?, ?)", subscriptions.items())
+    insert(
+        conn,
+        "INSERT INTO sessions(token, device_id, expires_at) VALUES(?, ?, ?)",
+        (
+            ("%032x" % rng.getrandbits(128), "android-%016x" % rng.getrandbits(64), now + rng.randint(-3600, 600))
+            for _ in range(max(10, codes // 1000))
+        ),
+    )
+    conn.close()
+    loaded = time.perf_counter()
+    # indexes are built by the same background steps as on a real upgrade
+    store.start()
+    store.steps.wait()
+    store.close()
+    return {
+        "path": path,
+        "codes": codes,
+        "payments": payments,
+        "users": users,
+        "subscriptions": len(subscriptions),
+        "now": now,
+        "load_seconds": round(loaded - started, 1),
+        "index_seconds": round(time.perf_counter() - loaded, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("path")
+    parser.add_argument("--codes", type=float, default=1e5, help="code rows, 1e4 .. 1e7")
+    parser.add_argument("--payments", type=float, default=-1, help="payment rows, default codes / 10")
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    print(generate(args.path, int(args.codes), int(args.payments), args.days, args.seed))
+
+
+if __name__ == "__main__":
+    main()
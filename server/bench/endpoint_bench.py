@@ -0,0 +1,198 @@
+"""Per-endpoint latency through the real app, with JSON baselines.
+
+    python bench/endpoint_bench.py [--n 2000] [--save]
+                                   [--baseline bench/endpoint_baseline.json]
+                                   [--threshold 0.2] [--fail]
+
+main.app is called in process with direct ASGI calls (no network, no rate
+limits) against a temporary DB seeded through the Storage API, so every row is
+handler + validation + storage work. Each request is timed on its own and the
+median is compared with the baseline: a case slower by more than --threshold
+is reported as a regression, and --fail turns that into exit status 1.
+Baselines are machine specific; record one with --save on the machine that
+runs the comparison. STORAGE_BACKEND / DB_* env vars apply as for the server.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import anyio
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+WORKDIR = tempfile.mkdtemp(prefix="v7ck9ll-bench-")
+# main reads its config at import time
+os.environ.update(
+    DB_PATH=os.path.join(WORKDIR, "codes.db"),
+    BOT_SECRET="bench-bot",
+    APP_SECRET="bench-app",
+    RATE_LIMITS="",
+    MAX_CONCURRENT_REQUESTS="0",
+    SWEEP_INTERVAL_SECONDS="0",
+    SLOW_QUERY_MS="0",
+    ACCESS_LOG_PATH=os.path.join(WORKDIR, "access.log"),
+)
+
+import main as server  # noqa: E402
+
+BOT = [(b"x-bot-secret", b"bench-bot")]
+APP = [(b"x-app-secret", b"bench-app")]
+NOW = int(time.time())
+
+
+async def call(path: str, body: dict, headers: list) -> bytes:
+    raw = json.dumps(body).encode()
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(raw)).encode()), *headers],
+        "client": ("127.0.0.1", 1),
+        "server": ("127.0.0.1", 80),
+    }
+    chunks = []
+
+    async def receive():
+        return {"type": "http.request", "body": raw, "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start" and message["status"] != 200:
+            chunks.append(f"HTTP {message['status']} ".encode())
+        elif message["type"] == "http.response.body":
+            chunks.append(message.get("body", b""))
+
+    await server.app(scope, receive, send)
+    body = b"".join(chunks)
+    if body.startswith(b"HTTP "):
+        raise RuntimeError(f"{path}: {body.decode()}")
+    return body
+
+
+def seed(codes: int, payments: int, users: int):
+    store = server.store
+    batch = 500
+    for start in range(0, codes, batch):
+        user_ids = [str(100000 + (start + i) % users) for i in range(min(batch, codes - start))]
+        store.issue_codes(user_ids, NOW + 3600)
+    for i in range(payments):
+        payment_id = store.create_payment(str(100000 + i % users), 1 + i % 3, "UA", NOW - payments + i)
+        if i % 3 == 0:
+            store.review_payment(payment_id, "1", i % 2 == 0, NOW - payments + i)
+
+
+async def measure(n: int, request) -> dict:
+    # request(i) -> (path, body, headers); one warmup call per case
+    await call(*request(-1))
+    timings = []
+    for i in range(n):
+        path, body, headers = request(i)
+        started = time.perf_counter()
+        await call(path, body, headers)
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return {
+        "n": n,
+        "mean_us": round(sum(timings) / n * 1e6, 1),
+        "p50_us": round(timings[n // 2] * 1e6, 1),
+        "p95_us": round(timings[min(n - 1, n * 95 // 100)] * 1e6, 1),
+    }
+
+
+async def run(n: int) -> dict:
+    store = server.store
+    fresh_codes = store.issue_codes([str(200000 + i) for i in range(n + 1)], NOW + 3600)
+    reused_code = store.issue_codes(["300000"], NOW + 3600)[0]
+    reused = json.loads(await call("/verify", {"code": reused_code, "device_id": "bench-reused"}, APP))
+    token = reused["session_token"]
+
+    def validate_db(i):
+        server.session_cache.clear()
+        return "/validate", {"session_token": token}, APP
+
+    cases = {
+        "/issue": lambda i: ("/issue", {"user_id": str(400000 + i)}, BOT),
+        "/verify fresh": lambda i: ("/verify", {"code": fresh_codes[i + 1], "device_id": f"bench-{i}"}, APP),
+        "/verify reused": lambda i: ("/verify", {"code": reused_code, "device_id": "bench-reused"}, APP),
+        "/validate cached": lambda i: ("/validate", {"session_token": token}, APP),
+        "/validate db": validate_db,
+        "/payment/list": lambda i: ("/payment/list", {"status": "pending", "limit": 20}, BOT),
+        "/payment/by_user": lambda i: ("/payment/by_user", {"user_id": str(100000 + i % 1000), "limit": 20}, BOT),
+        "/sub/status": lambda i: ("/sub/status", {"user_id": str(100000 + i % 1000)}, BOT),
+        "/sub/expiring": lambda i: ("/sub/expiring", {"days": 30, "limit": 100}, BOT),
+    }
+    return {name: await measure(n, request) for name, request in cases.items()}
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    regressions = []
+    print(f"{'case':<20} {'p50 us':>9} {'p95 us':>9} {'base p50':>9} {'change':>8}")
+    for name, row in results.items():
+        base = baseline.get("cases", {}).get(name)
+        change = ""
+        if base:
+            ratio = row["p50_us"] / base["p50_us"] - 1
+            change = f"{ratio * 100:+.1f}%"
+            if ratio > threshold:
+                regressions.append(name)
+                change += " !"
+        base_p50 = base["p50_us"] if base else "-"
+        print(f"{name:<20} {row['p50_us']:>9} {row['p95_us']:>9} {base_p50:>9} {change:>8}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--n", type=int, default=2000)
+    parser.add_argument("--seed-codes", type=int, default=20000)
+    parser.add_argument("--seed-payments", type=int, default=5000)
+    parser.add_argument("--baseline", default=os.path.join(BENCH_DIR, "endpoint_baseline.json"))
+    parser.add_argument("--save", action="store_true", help="write the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed p50 slowdown, 0.2 = 20%%")
+    parser.add_argument("--fail", action="store_true", help="exit 1 on regression instead of warning")
+    args = parser.parse_args()
+
+    server._startup()
+    try:
+        seed(args.seed_codes, args.seed_payments, users=1000)
+        results = anyio.run(run, args.n)
+    finally:
+        server._shutdown()
+        shutil.rmtree(WORKDIR, ignore_errors=True)
+    print(f"backend={server.STORAGE_BACKEND} codec={server.CODEC} n={args.n}")
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = compare(results, baseline, args.threshold)
+    if args.save:
+        meta = {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "backend": server.STORAGE_BACKEND,
+            "codec": server.CODEC,
+            "n": args.n,
+            "recorded_at": int(time.time()),
+        }
+        with open(args.baseline, "w") as f:
+            json.dump({"meta": meta, "cases": results}, f, indent=2)
+        print(f"baseline saved to {args.baseline}")
+    elif regressions:
+        print(f"{'REGRESSION' if args.fail else 'warning'}: slower than baseline by >{args.threshold:.0%}: {', '.join(regressions)}")
+        if args.fail:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+"""End-to-end load test of the issue -> verify -> validate flow over HTTP.
+
+    python bench/load_test.py [--users 500] [--concurrency 32] [--duration 20]
+                              [--admin-ratio 0.05] [--reuse-ratio 0.1]
+                              [--workers 1] [--url URL] [--json out.json]
+
+Without --url a server is started from this checkout (run.py) on a free port
+against a temporary DB, with rate limits and the concurrency cap turned off,
+and removed afterwards. With --url the target must have the same secrets
+(--bot-secret / --app-secret) and generous rate limits.
+
+Phases run back to back: every user gets a code via /issue, every code is
+redeemed via /verify from its own device (a --reuse-ratio share is redeemed
+again from the same device), then /validate is hammered with the issued
+sessions for --duration seconds while --admin-ratio of the requests are admin
+traffic (/payment/create, /payment/approve, /payment/list, /sub/status,
+/sub/expiring). Latency is measured client side; the client is a single
+process, so check its CPU before blaming the server for a plateau.
+"""
+import argparse
+import json
+import os
+import random
+import secrets
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import anyio
+import httpx
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values: list, p: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class Recorder:
+    def __init__(self, name: str):
+        self.name = name
+        self.latency: dict = defaultdict(list)
+        self.errors: dict = defaultdict(lambda: defaultdict(int))
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    def add(self, path: str, seconds: float, status: int):
+        self.latency[path].append(seconds)
+        if status != 200:
+            self.errors[path][status] += 1
+
+    def finish(self):
+        self.elapsed = time.perf_counter() - self.started
+
+    def summary(self) -> dict:
+        endpoints = {}
+        for path, values in sorted(self.latency.items()):
+            values = sorted(values)
+            endpoints[path] = {
+                "requests": len(values),
+                "errors": dict(self.errors[path]),
+                "rps": round(len(values) / self.elapsed, 1),
+                "p50_ms": round(percentile(values, 50) * 1000, 2),
+                "p95_ms": round(percentile(values, 95) * 1000, 2),
+                "p99_ms": round(percentile(values, 99) * 1000, 2),
+                "max_ms": round(values[-1] * 1000, 2),
+            }
+        total = sum(len(v) for v in self.latency.values())
+        return {"seconds": round(self.elapsed, 2), "rps": round(total / self.elapsed, 1), "endpoints": endpoints}
+
+
+def report(phase: dict, name: str):
+    print(f"\n{name}: {phase['seconds']}s, {phase['rps']} req/s")
+    print(f"  {'endpoint':<18} {'n':>7} {'err':>6} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}")
+    for path, row in phase["endpoints"].items():
+        errors = sum(row["errors"].values())
+        print(
+            f"  {path:<18} {row['requests']:>7} {errors:>6} {row['rps']:>8} "
+            f"{row['p50_ms']:>8} {row['p95_ms']:>8} {row['p99_ms']:>8} {row['max_ms']:>8}"
+        )
+        if errors:
+            print(f"  {'':<18} statuses: {row['errors']}")
+
+
+class LoadTest:
+    def __init__(self, client: httpx.AsyncClient, args):
+        self.client = client
+        self.args = args
+        self.bot = {"X-Bot-Secret": args.bot_secret}
+        self.app = {"X-App-Secret": args.app_secret}
+        self.users = [str(10_000_000 + i) for i in range(args.users)]
+        self.codes: list = []
+        self.sessions: list = []
+        self.pending: list = []
+        self.recorder: Recorder
+
+    async def call(self, path: str, body: dict, headers: dict):
+        started = time.perf_counter()
+        try:
+            resp = await self.client.post(path, json=body, headers=headers)
+            status = resp.status_code
+        except httpx.HTTPError:
+            resp, status = None, 0
+        self.recorder.add(path, time.perf_counter() - started, status)
+        return resp.json() if status == 200 else None
+
+    async def each(self, items, fn):
+        items = iter(items)
+
+        async def worker():
+            # one shared iterator: next() never awaits, so tasks cannot race on it
+            for item in items:
+                await fn(item)
+
+        async with anyio.create_task_group() as tg:
+            for _ in range(self.args.concurrency):
+                tg.start_soon(worker)
+
+    async def phase(self, name: str, run):
+        self.recorder = Recorder(name)
+        await run()
+        self.recorder.finish()
+        return self.recorder.summary()
+
+    async def issue(self, user_id: str):
+        result = await self.call("/issue", {"user_id": user_id}, self.bot)
+        if result:
+            self.codes.append((result["code"], f"load-device-{user_id}"))
+
+    async def verify(self, item):
+        code, device_id = item
+        result = await self.call("/verify", {"code": code, "device_id": device_id}, self.app)
+        if result:
+            self.sessions.append(result["session_token"])
+            if random.random() < self.args.reuse_ratio:
+                await self.call("/verify", {"code": code, "device_id": device_id}, self.app)
+
+    async def admin(self):
+        user_id = random.choice(self.users)
+        kind = random.random()
+        if kind < 0.25:
+            result = await self.call("/payment/create", {"user_id": user_id, "plan_months": 1, "method": "UA"}, self.bot)
+            if result:
+                self.pending.append(result["payment_id"])
+        elif kind < 0.4 and self.pending:
+            payment_id = self.pending.pop()
+            await self.call("/payment/approve", {"payment_id": payment_id, "reviewer_id": "1"}, self.bot)
+        elif kind < 0.6:
+            await self.call("/payment/list", {"status": "pending", "limit": 20}, self.bot)
+        elif kind < 0.85:
+            await self.call("/sub/status", {"user_id": user_id}, self.bot)
+        else:
+            await self.call("/sub/expiring", {"days": 30, "limit": 100}, self.bot)
+
+    async def mixed(self):
+        deadline = time.perf_counter() + self.args.duration
+
+        async def worker():
+            while time.perf_counter() < deadline:
+                if random.random() < self.args.admin_ratio or not self.sessions:
+                    await self.admin()
+                else:
+                    await self.call("/validate", {"session_token": random.choice(self.sessions)}, self.app)
+
+        async with anyio.create_task_group() as tg:
+            for _ in range(self.args.concurrency):
+                tg.start_soon(worker)
+
+    async def run(self) -> dict:
+        return {
+            "issue": await self.phase("issue", lambda: self.each(self.users, self.issue)),
+            "verify": await self.phase("verify", lambda: self.each(list(self.codes), self.verify)),
+            "mixed": await self.phase("mixed", self.mixed),
+        }
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(args, workdir: str) -> subprocess.Popen:
+    port = free_port()
+    env = dict(
+        os.environ,
+        HOST="127.0.0.1",
+        PORT=str(port),
+        WEB_CONCURRENCY=str(args.workers),
+        DB_PATH=os.path.join(workdir, "codes.db"),
+        METRICS_DIR=os.path.join(workdir, "metrics"),
+        BOT_SECRET=args.bot_secret,
+        APP_SECRET=args.app_secret,
+        RATE_LIMITS="",
+        MAX_CONCURRENT_REQUESTS="0",
+        SWEEP_INTERVAL_SECONDS="0",
+        TRAFFIC_CAPTURE_PATH="",
+    )
+    log = open(os.path.join(workdir, "server.log"), "w")
+    proc = subprocess.Popen([sys.executable, "run.py"], cwd=SERVER_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+    args.url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            break
+        try:
+            if httpx.post(args.url + "/admin/stats", headers={"X-Bot-Secret": args.bot_secret}).status_code == 200:
+                return proc
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    proc.kill()
+    with open(log.name) as f:
+        raise SystemExit(f"server did not start:\n{f.read()}")
+
+
+def stop_server(proc: subprocess.Popen):
+    proc.terminate()
+    try:
+        proc.wait(10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+async def run(args) -> dict:
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=30) as client:
+        return await LoadTest(client, args).run()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--admin-ratio", type=float, default=0.05)
+    parser.add_argument("--reuse-ratio", type=float, default=0.1)
+    parser.add_argument("--workers", type=int, default=1, help="WEB_CONCURRENCY of the local server")
+    parser.add_argument("--url", default="", help="target an already running server instead")
+    parser.add_argument("--bot-secret", default=os.getenv("BOT_SECRET") or secrets.token_urlsafe(16))
+    parser.add_argument("--app-secret", default=os.getenv("APP_SECRET") or secrets.token_urlsafe(16))
+    parser.add_argument("--json", default="", help="also write the results to this file")
+    args = parser.parse_args()
+
+    workdir = proc = None
+    if not args.url:
+        workdir = tempfile.mkdtemp(prefix="v7ck9ll-load-")
+        proc = start_server(args, workdir)
+    try:
+        print(f"target={args.url} users={args.users} concurrency={args.concurrency} duration={args.duration}s")
+        results = anyio.run(run, args)
+    finally:
+        if proc is not None:
+            stop_server(proc)
+        if workdir is not None:
+            shutil.rmtree(workdir, ignore_errors=True)
+    for name, phase in results.items():
+        report(phase, name)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": {k: v for k, v in vars(args).items() if "secret" not in k}, "phases": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
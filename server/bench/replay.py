@@ -0,0 +1,254 @@
+"""Replay a captured traffic trace and compare latency between builds.
+
+    python bench/replay.py trace.jsonl [--speed 1] [--json out.json]
+                           [--workers 1] [--url URL] [--concurrency 256]
+    python bench/replay.py --compare before.json after.json
+
+The trace comes from TRAFFIC_CAPTURE_PATH (capture.py). Requests are sent in
+capture order at the original pace (--speed 1), faster (--speed 10), or as
+fast as --concurrency allows (--speed 0). Without --url a fresh server from
+this checkout is started on a temporary DB, as in load_test.py.
+
+Hashed values are mapped back deterministically: a code, session token or
+payment id that an earlier request produced is replaced by what this server
+returned for that request (the dependent request waits for it), values the
+trace never produced become invalid ones, and every other hashed string
+(user_id, device_id, ...) becomes a stable synthetic value. status_match is
+the share of requests that got the same status as at capture time, which
+shows how faithful the replay was.
+
+Run it once per build with --json, then --compare the two files.
+"""
+import argparse
+import json
+import os
+import secrets
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+import anyio
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from load_test import percentile, start_server, stop_server  # noqa: E402
+
+PRODUCED_FIELDS = ("code", "session_token", "payment_id")
+
+
+def load(path: str) -> list:
+    records = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    records.sort(key=lambda r: r["t"])
+    return records
+
+
+# values are keyed by (field, hash): equal strings hash alike whatever the
+# field, e.g. reviewer_id "1" and payment_id 1
+def produced_hashes(record: dict) -> list:
+    out = record.get("o", {})
+    return [(k, out[k]) for k in PRODUCED_FIELDS if k in out] + [("code", h) for h in out.get("items", [])]
+
+
+def referenced(value, key: str = "") -> list:
+    if isinstance(value, dict):
+        return [h for k, v in value.items() for h in referenced(v, k)]
+    if isinstance(value, list):
+        return [h for v in value for h in referenced(v, key)]
+    if isinstance(value, str) and value.startswith("#") and key in PRODUCED_FIELDS:
+        return [(key, value)]
+    return []
+
+
+def latency_summary(values: list) -> dict:
+    values = sorted(values)
+    return {
+        "requests": len(values),
+        "p50_ms": round(percentile(values, 50) * 1000, 2),
+        "p95_ms": round(percentile(values, 95) * 1000, 2),
+        "p99_ms": round(percentile(values, 99) * 1000, 2),
+    }
+
+
+class Replay:
+    def __init__(self, client: httpx.AsyncClient, records: list, args):
+        self.client = client
+        self.records = records
+        self.args = args
+        self.headers = {"X-Bot-Secret": args.bot_secret, "X-App-Secret": args.app_secret}
+        self.values: dict = {}
+        self.producer: dict = {}
+        self.ready: dict = {}
+        for i, record in enumerate(records):
+            for h in produced_hashes(record):
+                if h not in self.producer:
+                    self.producer[h] = i
+                    self.ready[h] = anyio.Event()
+        self.latency: dict = defaultdict(list)
+        self.statuses: dict = defaultdict(Counter)
+        self.matched = 0
+
+    def materialize(self, value, key: str = ""):
+        if isinstance(value, dict):
+            return {k: self.materialize(v, k) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self.materialize(v, key) for v in value]
+        if not (isinstance(value, str) and value.startswith("#")):
+            return value
+        if (key, value) in self.values:
+            return self.values[(key, value)]
+        digest = value[1:]
+        if key == "code":
+            return "V7-%s-%s" % (digest[:4].upper(), digest[4:8].upper())
+        if key == "payment_id":
+            return 10**12 + int(digest[:8], 16)
+        return "r" + digest
+
+    async def send(self, index: int, record: dict, limiter: anyio.CapacityLimiter):
+        body = record.get("b")
+        # wait for the requests that produce the codes/tokens/ids this one uses
+        for h in referenced(body):
+            if self.producer.get(h, index) < index:
+                with anyio.move_on_after(30):
+                    await self.ready[h].wait()
+        async with limiter:
+            started = time.perf_counter()
+            try:
+                resp = await self.client.request(
+                    record["m"], record["r"], json=self.materialize(body) if body is not None else None,
+                    headers=self.headers,
+                )
+                status = resp.status_code
+            except httpx.HTTPError:
+                resp, status = None, 0
+            elapsed = time.perf_counter() - started
+        self.latency[record["r"]].append(elapsed)
+        self.statuses[record["r"]][status] += 1
+        self.matched += status == record["s"]
+        if status == 200 and "o" in record:
+            try:
+                data = resp.json()
+            except ValueError:
+                data = {}
+            out = record["o"]
+            for k in PRODUCED_FIELDS:
+                if k in out and k in data:
+                    self.values[(k, out[k])] = data[k]
+            for h, item in zip(out.get("items", []), data.get("items", [])):
+                self.values[("code", h)] = item.get("code")
+        for h in produced_hashes(record):
+            if self.producer.get(h) == index:
+                self.ready[h].set()
+
+    async def run(self) -> float:
+        limiter = anyio.CapacityLimiter(self.args.concurrency)
+        t0 = self.records[0]["t"]
+        started = time.perf_counter()
+        async with anyio.create_task_group() as tg:
+            for index, record in enumerate(self.records):
+                if self.args.speed > 0:
+                    delay = (record["t"] - t0) / 1000 / self.args.speed - (time.perf_counter() - started)
+                    if delay > 0:
+                        await anyio.sleep(delay)
+                tg.start_soon(self.send, index, record, limiter)
+        return time.perf_counter() - started
+
+    def summary(self, elapsed: float) -> dict:
+        captured = defaultdict(list)
+        for record in self.records:
+            captured[record["r"]].append(record["us"] / 1e6)
+        return {
+            "requests": len(self.records),
+            "seconds": round(elapsed, 2),
+            "status_match": round(self.matched / len(self.records), 4),
+            "routes": {
+                route: {**latency_summary(values), "statuses": dict(self.statuses[route])}
+                for route, values in sorted(self.latency.items())
+            },
+            "captured_server_side": {route: latency_summary(values) for route, values in sorted(captured.items())},
+        }
+
+
+def report(result: dict):
+    print(
+        f"{result['requests']} requests in {result['seconds']}s, "
+        f"status match {result['status_match'] * 100:.1f}%"
+    )
+    print(f"  {'route':<18} {'n':>7} {'p50':>8} {'p95':>8} {'p99':>8}  statuses")
+    for route, row in result["routes"].items():
+        print(
+            f"  {route:<18} {row['requests']:>7} {row['p50_ms']:>8} {row['p95_ms']:>8} {row['p99_ms']:>8}  "
+            f"{row['statuses']}"
+        )
+
+
+def compare(before_path: str, after_path: str):
+    with open(before_path) as f:
+        before = json.load(f)["routes"]
+    with open(after_path) as f:
+        after = json.load(f)["routes"]
+    print(f"  {'route':<18} " + " ".join(f"{q + ' before':>11} {q + ' after':>10} {'change':>8}" for q in ("p50", "p95", "p99")))
+    for route in sorted(set(before) & set(after)):
+        cells = []
+        for q in ("p50_ms", "p95_ms", "p99_ms"):
+            a, b = before[route][q], after[route][q]
+            change = f"{(b / a - 1) * 100:+.1f}%" if a else "-"
+            cells.append(f"{a:>11} {b:>10} {change:>8}")
+        print(f"  {route:<18} " + " ".join(cells))
+
+
+async def run(records: list, args) -> dict:
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=60) as client:
+        replay = Replay(client, records, args)
+        elapsed = await replay.run()
+        return replay.summary(elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("trace", nargs="?")
+    parser.add_argument("--speed", type=float, default=1.0, help="1 = original pace, 0 = as fast as possible")
+    parser.add_argument("--concurrency", type=int, default=256)
+    parser.add_argument("--workers", type=int, default=1, help="WEB_CONCURRENCY of the local server")
+    parser.add_argument("--url", default="", help="replay against an already running server instead")
+    parser.add_argument("--bot-secret", default=os.getenv("BOT_SECRET") or secrets.token_urlsafe(16))
+    parser.add_argument("--app-secret", default=os.getenv("APP_SECRET") or secrets.token_urlsafe(16))
+    parser.add_argument("--json", default="", help="write the results here for --compare")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if not args.trace:
+        parser.error("a trace file or --compare is required")
+    records = load(args.trace)
+    if not records:
+        raise SystemExit(f"{args.trace} has no records")
+    workdir = proc = None
+    if not args.url:
+        workdir = tempfile.mkdtemp(prefix="v7ck9ll-replay-")
+        proc = start_server(args, workdir)
+    try:
+        result = anyio.run(run, records, args)
+    finally:
+        if proc is not None:
+            stop_server(proc)
+        if workdir is not None:
+            shutil.rmtree(workdir, ignore_errors=True)
+    report(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
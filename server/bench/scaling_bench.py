@@ -0,0 +1,163 @@
+"""Query latency against table size, from 1e4 to 1e7 code rows.
+
+    python bench/scaling_bench.py [--scales 1e4,1e5,1e6] [--n 500]
+                                  [--data-dir bench/data] [--svg scaling.svg]
+
+For every scale a synthetic database is generated with bench/dataset.py (and
+kept in --data-dir, so larger scales are paid for once) and the storage
+queries behind the endpoints are timed through SqliteStorage:
+
+- /verify fresh: redeeming a code issued just before the run
+- /verify expired: an old code from the dataset (code_expired)
+- /verify invalid: a code that does not exist (also probes the archive)
+- /payment/by_user: first page for users drawn with the dataset's skew
+- /sub/expiring: first page of subscriptions ending in the next 3 days
+
+The table shows p50 per scale and the growth exponent k (latency ~ rows^k)
+between the smallest and largest scale; k near 0 is an index lookup, k near
+1 means the query scans. --svg writes a log-log chart. Each run adds its
+fresh codes to the cached files; delete --data-dir for a pristine dataset.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import secrets
+import sys
+import time
+
+from fastapi import HTTPException
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from dataset import generate, user_for  # noqa: E402
+from storage import SqliteStorage  # noqa: E402
+
+QUERIES = ("/verify fresh", "/verify expired", "/verify invalid", "/payment/by_user", "/sub/expiring")
+
+
+def new_session(device_id: str):
+    return secrets.token_urlsafe(32), int(time.time()) + 600, True
+
+
+def timed(fn, n: int) -> dict:
+    timings = []
+    for i in range(-1, n):
+        started = time.perf_counter()
+        try:
+            fn(i)
+        except HTTPException:
+            pass
+        if i >= 0:
+            timings.append(time.perf_counter() - started)
+    timings.sort()
+    return {"p50_us": round(timings[n // 2] * 1e6, 1), "p95_us": round(timings[min(n - 1, n * 95 // 100)] * 1e6, 1)}
+
+
+def run_scale(path: str, scale: int, n: int, rng: random.Random) -> dict:
+    store = SqliteStorage(path, slow_query_ms=0)
+    store.init()
+    store.start()
+    try:
+        now = int(time.time())
+        with store.pool.connection() as conn:
+            old = [r[0] for r in conn.execute("SELECT code FROM codes WHERE expires_at < ? LIMIT ?", (now, n * 20))]
+        users = max(100, scale // 8)
+        fresh = store.issue_codes([user_for(rng, users) for _ in range(n + 1)], now + 3600)
+        return {
+            "rows": scale,
+            "/verify fresh": timed(lambda i: store.redeem_code(fresh[i + 1], f"bench-{i}", now, new_session), n),
+            "/verify expired": timed(lambda i: store.redeem_code(rng.choice(old), "bench-other", now, new_session), n),
+            "/verify invalid": timed(
+                lambda i: store.redeem_code("V7-%04X-%04X" % (rng.getrandbits(16), rng.getrandbits(16)), "bench-other", now, new_session), n
+            ),
+            "/payment/by_user": timed(lambda i: store.payments_by_user(user_for(rng, users), None, 20), n),
+            "/sub/expiring": timed(lambda i: store.list_expiring(now + 3 * 24 * 60 * 60, 500, None, None), n),
+        }
+    finally:
+        store.close()
+
+
+def growth(results: list, query: str) -> float:
+    first, last = results[0], results[-1]
+    if last["rows"] == first["rows"]:
+        return 0.0
+    return math.log(last[query]["p50_us"] / first[query]["p50_us"]) / math.log(last["rows"] / first["rows"])
+
+
+def report(results: list):
+    print(f"{'query (p50 us)':<18}" + "".join(f"{r['rows']:>12,}" for r in results) + f"{'k':>8}")
+    for query in QUERIES:
+        k = growth(results, query) if len(results) > 1 else 0.0
+        flag = "  <- grows with table size" if k > 0.5 else ""
+        print(f"{query:<18}" + "".join(f"{r[query]['p50_us']:>12}" for r in results) + f"{k:>8.2f}{flag}")
+
+
+def svg_chart(results: list, path: str):
+    width, height, pad = 720, 420, 60
+    rows = [r["rows"] for r in results]
+    values = [r[q]["p50_us"] for r in results for q in QUERIES]
+    x0, x1 = math.log10(min(rows)), math.log10(max(rows))
+    y0, y1 = math.log10(min(values)), math.log10(max(values))
+    if x1 == x0:
+        x1 = x0 + 1
+    if y1 == y0:
+        y1 = y0 + 1
+
+    def point(n, v):
+        x = pad + (math.log10(n) - x0) / (x1 - x0) * (width - 2 * pad)
+        y = height - pad - (math.log10(v) - y0) / (y1 - y0) * (height - 2 * pad)
+        return f"{x:.1f},{y:.1f}"
+
+    colors = ("#1f77b4", "#ff7f0e", "#2ca02c", "#d62728", "#9467bd")
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" font-family="sans-serif" font-size="12">',
+        f'<rect width="{width}" height="{height}" fill="white"/>',
+        f'<line x1="{pad}" y1="{height - pad}" x2="{width - pad}" y2="{height - pad}" stroke="black"/>',
+        f'<line x1="{pad}" y1="{pad}" x2="{pad}" y2="{height - pad}" stroke="black"/>',
+        f'<text x="{width / 2}" y="{height - 15}" text-anchor="middle">code rows (log)</text>',
+        f'<text x="15" y="{height / 2}" transform="rotate(-90 15 {height / 2})" text-anchor="middle">p50 us (log)</text>',
+    ]
+    for n in rows:
+        x = point(n, 10**y0).split(",")[0]
+        parts.append(f'<text x="{x}" y="{height - pad + 16}" text-anchor="middle">{n:.0e}</text>')
+    for i, query in enumerate(QUERIES):
+        points = " ".join(point(r["rows"], r[query]["p50_us"]) for r in results)
+        parts.append(f'<polyline points="{points}" fill="none" stroke="{colors[i]}" stroke-width="2"/>')
+        parts.append(f'<text x="{pad + 10}" y="{pad + 16 * i}" fill="{colors[i]}">{query}</text>')
+    parts.append("</svg>")
+    with open(path, "w") as f:
+        f.write("\n".join(parts))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--scales", default="1e4,1e5,1e6", help="comma separated code row counts")
+    parser.add_argument("--n", type=int, default=500, help="timed calls per query and scale")
+    parser.add_argument("--data-dir", default=os.path.join(BENCH_DIR, "data"))
+    parser.add_argument("--svg", default="", help="write a log-log chart here")
+    parser.add_argument("--json", default="", help="also write the results to this file")
+    args = parser.parse_args()
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    rng = random.Random(7)
+    results = []
+    for scale in sorted(int(float(s)) for s in args.scales.split(",") if s.strip()):
+        path = os.path.join(args.data_dir, f"codes_{scale}.db")
+        if not os.path.exists(path):
+            print(f"generating {path} ...", flush=True)
+            print(generate(path, scale), flush=True)
+        results.append(run_scale(path, scale, args.n, rng))
+    report(results)
+    if args.svg:
+        svg_chart(results, args.svg)
+        print(f"chart written to {args.svg}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
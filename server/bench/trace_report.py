@@ -0,0 +1,101 @@
+"""Latency breakdown from exported spans (TRACE_EXPORT_PATH).
+
+    python bench/trace_report.py server_spans.jsonl [bot_spans.jsonl ...]
+                                 [--route /issue] [--json out.json]
+
+Server lines are matched to the bot span that called them (the server line's
+parent_id is the bot's span_id, sent as traceparent). Per route it prints
+p50/p95 of:
+
+- bot: the whole HTTP call as seen by the bot
+- network: bot minus server, i.e. connection setup, transfer and proxies
+- server: from the first byte in the server middleware to the response
+- each server phase (secret_check, validation, db_acquire, query,
+  write_queue, lock_wait, write, commit), summed per request
+- other: server time not covered by a phase (routing, threadpool hand-off,
+  handler code, serialization)
+
+Requests without a bot span (the app, load tests) only get the server columns.
+"""
+import argparse
+import json
+from collections import defaultdict
+
+PHASES = ("secret_check", "validation", "db_acquire", "query", "write_queue", "lock_wait", "write", "commit")
+
+
+def load(paths: list) -> list:
+    records = []
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    records.append(json.loads(line))
+    return records
+
+
+def breakdown(records: list, route: str = "") -> dict:
+    bot = {r["span_id"]: r for r in records if r.get("service") == "bot"}
+    rows = defaultdict(lambda: defaultdict(list))
+    for r in records:
+        if r.get("service") != "server" or (route and not r["name"].endswith(" " + route)):
+            continue
+        row = rows[r["name"]]
+        row["server"].append(r["ms"])
+        phases = defaultdict(float)
+        for s in r.get("spans", []):
+            phases[s["name"]] += s["ms"]
+        for name in PHASES:
+            row[name].append(phases.get(name, 0.0))
+        row["other"].append(max(0.0, r["ms"] - sum(phases.values())))
+        caller = bot.get(r.get("parent_id"))
+        if caller is not None:
+            row["bot"].append(caller["ms"])
+            row["network"].append(max(0.0, caller["ms"] - r["ms"]))
+    return rows
+
+
+def quantile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+def summary(rows: dict) -> dict:
+    columns = ("bot", "network", "server", *PHASES, "other")
+    return {
+        name: {
+            "requests": len(row["server"]),
+            **{c: {"p50_ms": round(quantile(row[c], 0.5), 3), "p95_ms": round(quantile(row[c], 0.95), 3)} for c in columns if any(row[c])},
+        }
+        for name, row in sorted(rows.items())
+    }
+
+
+def report(result: dict):
+    for name, row in result.items():
+        print(f"\n{name}: {row['requests']} requests")
+        print(f"  {'part':<14} {'p50 ms':>9} {'p95 ms':>9}")
+        for part, values in row.items():
+            if part != "requests":
+                print(f"  {part:<14} {values['p50_ms']:>9} {values['p95_ms']:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("files", nargs="+", help="span files from the server and the bot")
+    parser.add_argument("--route", default="", help="only this route, e.g. /issue")
+    parser.add_argument("--json", default="", help="also write the results to this file")
+    args = parser.parse_args()
+
+    result = summary(breakdown(load(args.files), args.route))
+    if not result:
+        raise SystemExit("no server spans found")
+    report(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+import hashlib
+import hmac
+import json
+import os
+import queue
+import threading
+import time
+from typing import Optional
+
+from metrics import stat_inc
+from ratelimit import buffer_body
+
+# Body fields kept verbatim: enum-like values that carry no identity. Every
+# other string, and ids that replay has to map (payment_id), is replaced by
+# "#" + keyed hash, so a trace links requests of one user/code/session to each
+# other without revealing them.
+PLAIN_FIELDS = {"status", "method", "op"}
+HASHED_INTS = {"payment_id"}
+# response fields that later requests refer to; replay maps them to the values
+# its own server returns
+PRODUCED_FIELDS = ("code", "session_token", "payment_id")
+SKIP_PATHS = {"/metrics", "/docs", "/redoc", "/openapi.json"}
+MAX_BODY = 64 * 1024
+
+
+def anonymize(value, key: str, salt: bytes):
+    if isinstance(value, dict):
+        return {k: anonymize(v, k, salt) for k, v in value.items()}
+    if isinstance(value, list):
+        return [anonymize(v, key, salt) for v in value]
+    if (isinstance(value, str) and key not in PLAIN_FIELDS) or (isinstance(value, int) and key in HASHED_INTS):
+        if key == "code":
+            # /verify accepts any case and spacing; hash what the server stores
+            value = value.strip().upper()
+        return "#" + hmac.new(salt, str(value).encode(), hashlib.sha256).hexdigest()[:16]
+    return value
+
+
+def produced(body: bytes, salt: bytes) -> dict:
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return {}
+    if not isinstance(data, dict):
+        return {}
+    out = {k: anonymize(data[k], k, salt) for k in PRODUCED_FIELDS if k in data}
+    items = data.get("items")
+    if isinstance(items, list) and items and isinstance(items[0], dict) and "code" in items[0]:
+        out["items"] = [anonymize(item.get("code"), "code", salt) for item in items]
+    return out
+
+
+# Appends JSON lines from a background thread so request handling never waits
+# on the disk; each batch is one O_APPEND write, so several workers can share
+# one file. When the disk falls behind, records are dropped and counted.
+class TraceWriter:
+    def __init__(self, path: str, max_pending: int = 10000, name: str = "capture"):
+        self.path = path
+        self.max_pending = max_pending
+        self.name = name
+        self._queue: "queue.SimpleQueue[Optional[bytes]]" = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=f"{self.name}-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def put(self, record: dict):
+        if self._queue.qsize() >= self.max_pending:
+            stat_inc(f"{self.name}_dropped_total")
+            return
+        self._queue.put(json.dumps(record, separators=(",", ":")).encode() + b"\n")
+
+    def _run(self):
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            running = True
+            while running:
+                lines = [self._queue.get()]
+                while len(lines) < 1000:
+                    try:
+                        lines.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if None in lines:
+                    running = False
+                    lines = [line for line in lines if line is not None]
+                if lines:
+                    os.write(fd, b"".join(lines))
+                    stat_inc(f"{self.name}_records_total", len(lines))
+        finally:
+            os.close(fd)
+
+
+class CaptureMiddleware:
+    def __init__(self, app, writer: TraceWriter, salt: bytes):
+        self.app = app
+        self.writer = writer
+        self.salt = salt
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in SKIP_PATHS:
+            return await self.app(scope, receive, send)
+        raw, receive = await buffer_body(receive)
+        at = int(time.time() * 1000)
+        started = time.perf_counter()
+        status = 500
+        chunks = []
+
+        async def send_captured(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif sum(map(len, chunks)) < MAX_BODY:
+                chunks.append(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_captured)
+        finally:
+            record = {
+                "t": at,
+                "m": scope["method"],
+                "r": scope["path"],
+                "s": status,
+                "us": int((time.perf_counter() - started) * 1e6),
+            }
+            body = None
+            if raw and len(raw) <= MAX_BODY:
+                try:
+                    body = json.loads(raw)
+                except ValueError:
+                    pass
+            if body is not None:
+                record["b"] = anonymize(body, "", self.salt)
+            response = b"".join(chunks)
+            if status == 200:
+                out = produced(response, self.salt)
+                if out:
+                    record["o"] = out
+            elif status >= 400:
+                try:
+                    detail = json.loads(response).get("detail")
+                except (ValueError, AttributeError):
+                    detail = None
+                if isinstance(detail, str):
+                    record["d"] = detail
+            self.writer.put(record)
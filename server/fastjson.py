@@ -0,0 +1,60 @@
+import json
+from typing import Any, Callable, Type, TypeVar
+
+from fastapi import Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import JSONResponse, Response
+from pydantic import BaseModel, ValidationError
+
+from tracing import span
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+CODEC = "orjson" if orjson is not None else "json"
+
+Model = TypeVar("Model", bound=BaseModel)
+
+
+def dumps(content: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def raw_json(body: bytes, status_code: int = 200) -> Response:
+    return Response(body, status_code=status_code, media_type="application/json")
+
+
+def json_body(model: Type[Model]) -> Callable:
+    # Parses the body with pydantic-core's JSON parser in one pass instead of
+    # json.loads + dict validation; errors keep FastAPI's 422 shape.
+    async def parse(request: Request) -> Model:
+        body = await request.body()
+        try:
+            with span("validation"):
+                return model.model_validate_json(body)
+        except ValidationError as e:
+            raise RequestValidationError(
+                [{**err, "loc": ("body", *err["loc"])} for err in e.errors(include_url=False)]
+            )
+
+    return parse
+
+
+def body_schema(model: Type[BaseModel]) -> dict:
+    # json_body() hides the model from FastAPI, so routes pass this as
+    # openapi_extra to keep the request body in the API docs
+    return {
+        "requestBody": {
+            "required": True,
+            "content": {"application/json": {"schema": model.model_json_schema()}},
+        }
+    }
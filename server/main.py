@@ -1,102 +1,321 @@
+import base64
+import fcntl
+import hashlib
+import hmac
 import os
-import sqlite3
 import secrets
+import threading
 import time
-from typing import Optional
+import tracemalloc
+from collections import OrderedDict
+from typing import List, Optional
 
-from fastapi import FastAPI, Header, HTTPException
+from fastapi import Depends, FastAPI, Header, HTTPException
+from fastapi.responses import PlainTextResponse, Response
 from pydantic import BaseModel
 from dotenv import load_dotenv
 
+from accesslog import AccessLog, AccessLogMiddleware, parse_sampling
+from capture import CaptureMiddleware, TraceWriter
+from fastjson import CODEC, FastJSONResponse, body_schema, json_body, raw_json
+from metrics import MetricsMiddleware, render_prometheus, snapshot, start_sharing, stat_inc, stat_set, stop_sharing
+from profiling import ProfileMiddleware, download, memory_dump, memory_snapshot, memory_start, memory_stop, profile_cpu
+from ratelimit import AdmissionMiddleware, parse_rules
+from storage import MemoryStorage, ShardedStorage, SqliteStorage, Storage, check_days, slow_queries
+from tracing import TraceMiddleware, span
+
 load_dotenv()
 
 BOT_SECRET = os.getenv("BOT_SECRET", "")
 APP_SECRET = os.getenv("APP_SECRET", "")
 DB_PATH = os.getenv("DB_PATH", "codes.db")
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite").strip().lower()
+DB_SHARDS = int(os.getenv("DB_SHARDS", "1"))
 CODE_TTL_SECONDS = int(os.getenv("CODE_TTL_SECONDS", "600"))
+CODE_ALLOC_MAX_ATTEMPTS = int(os.getenv("CODE_ALLOC_MAX_ATTEMPTS", "8"))
+ISSUE_BATCH_MAX = int(os.getenv("ISSUE_BATCH_MAX", "100"))
+BULK_MAX_OPS = int(os.getenv("BULK_MAX_OPS", "500"))
 SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", "600"))
 SUBSCRIPTION_MONTH_SECONDS = int(os.getenv("SUBSCRIPTION_MONTH_SECONDS", str(30 * 24 * 60 * 60)))
-
-app = FastAPI(title="V7CK9LL Code Server")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "16"))
+DB_JOURNAL_MODE = os.getenv("DB_JOURNAL_MODE", "WAL")
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(64 * 1024 * 1024)))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", str(16 * 1024)))
+DB_WRITE_BATCH_SIZE = int(os.getenv("DB_WRITE_BATCH_SIZE", "32"))
+DB_BUSY_RETRIES = int(os.getenv("DB_BUSY_RETRIES", "5"))
+SCHEMA_STEPS_BACKGROUND = os.getenv("SCHEMA_STEPS_BACKGROUND", "true").lower() in ("1", "true", "yes")
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))
+SWEEP_INTERVAL_SECONDS = int(os.getenv("SWEEP_INTERVAL_SECONDS", "300"))
+SWEEP_BATCH_SIZE = int(os.getenv("SWEEP_BATCH_SIZE", "500"))
+SWEEP_GRACE_SECONDS = int(os.getenv("SWEEP_GRACE_SECONDS", "3600"))
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "90"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "500"))
+SESSION_CACHE_ENABLED = os.getenv("SESSION_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "10000"))
+SESSION_MODE = os.getenv("SESSION_MODE", "table").strip().lower()
+SESSION_KEYS = os.getenv("SESSION_KEYS", "")
+SESSION_SIGNING_SECRET = os.getenv("SESSION_SIGNING_SECRET", "")
+SESSION_KEY_ID = os.getenv("SESSION_KEY_ID", "").strip()
+# @ip rules are not in the defaults: behind a proxy every client has the
+# proxy's address until RATE_LIMIT_TRUSTED_HOPS is set
+RATE_LIMITS = os.getenv("RATE_LIMITS", "/issue=30/60@user_id,/verify=20/60@device_id")
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+RATE_LIMIT_TRUSTED_HOPS = int(os.getenv("RATE_LIMIT_TRUSTED_HOPS", "0"))
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", "64"))
+METRICS_DIR = os.getenv("METRICS_DIR", "")
+METRICS_FLUSH_SECONDS = float(os.getenv("METRICS_FLUSH_SECONDS", "1"))
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+TRAFFIC_CAPTURE_PATH = os.getenv("TRAFFIC_CAPTURE_PATH", "")
+TRAFFIC_CAPTURE_SALT = os.getenv("TRAFFIC_CAPTURE_SALT", "") or secrets.token_hex(16)
+ACCESS_LOG = os.getenv("ACCESS_LOG", "true").lower() in ("1", "true", "yes")
+ACCESS_LOG_PATH = os.getenv("ACCESS_LOG_PATH", "")
+ACCESS_LOG_SAMPLING = os.getenv("ACCESS_LOG_SAMPLING", "/validate=0.1/100")
+ACCESS_LOG_SALT = os.getenv("ACCESS_LOG_SALT", "") or TRAFFIC_CAPTURE_SALT
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH", "")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1"))
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "true").lower() in ("1", "true", "yes")
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+
+app = FastAPI(title="V7CK9LL Code Server", default_response_class=FastJSONResponse)
+if PROFILING_ENABLED and BOT_SECRET:
+    # innermost, so the profile covers the handler and not time queued in admission
+    app.add_middleware(ProfileMiddleware, secret=BOT_SECRET)
+app.add_middleware(
+    AdmissionMiddleware,
+    rules=parse_rules(RATE_LIMITS),
+    max_concurrency=MAX_CONCURRENT_REQUESTS,
+    max_keys=RATE_LIMIT_MAX_KEYS,
+    trusted_hops=RATE_LIMIT_TRUSTED_HOPS,
+)
+trace_writer = TraceWriter(TRAFFIC_CAPTURE_PATH) if TRAFFIC_CAPTURE_PATH else None
+if trace_writer is not None:
+    # outside admission control so rejected requests are part of the replayed mix
+    app.add_middleware(CaptureMiddleware, writer=trace_writer, salt=TRAFFIC_CAPTURE_SALT.encode())
+access_log = AccessLog(ACCESS_LOG_PATH, ACCESS_LOG_SALT.encode(), parse_sampling(ACCESS_LOG_SAMPLING)) if ACCESS_LOG else None
+if access_log is not None:
+    app.add_middleware(AccessLogMiddleware, log=access_log)
+span_writer = TraceWriter(TRACE_EXPORT_PATH, name="trace_export") if TRACE_EXPORT_PATH else None
+# outside the access log, which picks up the trace id
+app.add_middleware(TraceMiddleware, writer=span_writer, sample_rate=TRACE_SAMPLE_RATE)
+# added last so it wraps admission control and also sees shed/429 responses
+app.add_middleware(MetricsMiddleware)
+
+
+
+def make_storage() -> Storage:
+    if STORAGE_BACKEND == "memory":
+        return MemoryStorage(month_seconds=SUBSCRIPTION_MONTH_SECONDS, code_alloc_attempts=CODE_ALLOC_MAX_ATTEMPTS)
+    options = dict(
+        pool_size=DB_POOL_SIZE,
+        journal_mode=DB_JOURNAL_MODE,
+        synchronous=DB_SYNCHRONOUS,
+        busy_timeout_ms=DB_BUSY_TIMEOUT_MS,
+        mmap_size=DB_MMAP_SIZE,
+        cache_size_kb=DB_CACHE_SIZE_KB,
+        write_batch_size=DB_WRITE_BATCH_SIZE,
+        busy_retries=DB_BUSY_RETRIES,
+        steps_in_background=SCHEMA_STEPS_BACKGROUND,
+        slow_query_ms=SLOW_QUERY_MS,
+        month_seconds=SUBSCRIPTION_MONTH_SECONDS,
+        code_alloc_attempts=CODE_ALLOC_MAX_ATTEMPTS,
+    )
+    if DB_SHARDS > 1:
+        return ShardedStorage(DB_PATH, DB_SHARDS, **options)
+    return SqliteStorage(DB_PATH, **options)
 
 
-def db():
-    return sqlite3.connect(DB_PATH)
+store = make_storage()
 
 
 def init_db():
-    with db() as conn:
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS codes (
-                code TEXT PRIMARY KEY,
-                user_id TEXT,
-                expires_at INTEGER,
-                used INTEGER DEFAULT 0
-            )
-            """
-        )
-        conn.execute("CREATE INDEX IF NOT EXISTS idx_codes_user_id ON codes(user_id)")
-        columns = {row[1] for row in conn.execute("PRAGMA table_info(codes)").fetchall()}
-        if "redeemed_device_id" not in columns:
-            conn.execute("ALTER TABLE codes ADD COLUMN redeemed_device_id TEXT")
-        if "session_token" not in columns:
-            conn.execute("ALTER TABLE codes ADD COLUMN session_token TEXT")
-        if "session_expires_at" not in columns:
-            conn.execute("ALTER TABLE codes ADD COLUMN session_expires_at INTEGER")
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS subscriptions (
-                user_id TEXT PRIMARY KEY,
-                expires_at INTEGER
-            )
-            """
-        )
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS payments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id TEXT,
-                plan_months INTEGER,
-                method TEXT,
-                screenshot_file_id TEXT,
-                status TEXT,
-                created_at INTEGER,
-                reviewed_at INTEGER,
-                reviewer_id TEXT
-            )
-            """
-        )
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS ios_links (
-                user_id TEXT PRIMARY KEY,
-                name TEXT UNIQUE,
-                code TEXT,
-                created_at INTEGER
-            )
-            """
-        )
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS sessions (
-                token TEXT PRIMARY KEY,
-                device_id TEXT,
-                expires_at INTEGER
-            )
-            """
-        )
+    store.init()
+
+
+def sweep_expired(now: Optional[int] = None) -> dict:
+    cutoff = (now or int(time.time())) - SWEEP_GRACE_SECONDS
+    batch_size = max(1, SWEEP_BATCH_SIZE)
+    purged = {}
+    for table in ("codes", "sessions"):
+        total = 0
+        while True:
+            # one batch per write op keeps the write lock short and lets
+            # request writes interleave between batches
+            deleted = store.purge_expired(table, cutoff, batch_size)
+            total += deleted
+            if deleted < batch_size:
+                break
+        purged[table] = total
+        stat_inc(f"sweep_{table}_purged_total", total)
+        stat_set(f"sweep_{table}_purged_last", total)
+    stat_inc("sweep_runs_total")
+    stat_set("sweep_last_run_at", int(time.time()))
+    return purged
+
+
+def archive_old(
+    now: Optional[int] = None, older_than_days: Optional[int] = None, convert_vacuum: bool = False
+) -> dict:
+    days = ARCHIVE_AFTER_DAYS if older_than_days is None else older_than_days
+    cutoff = (now or int(time.time())) - max(0, days) * 24 * 60 * 60
+    batch_size = max(1, ARCHIVE_BATCH_SIZE)
+    moved = {"payments": 0, "codes": 0}
+    if convert_vacuum:
+        # one-time full VACUUM of a pre-existing file; blocks writes while it runs
+        moved["vacuum_converted"] = store.convert_incremental_vacuum()
+    while True:
+        payments, codes = store.archive(cutoff, batch_size)
+        moved["payments"] += payments
+        moved["codes"] += codes
+        if payments < batch_size and codes < batch_size:
+            break
+    moved["vacuum_pages"] = store.incremental_vacuum()
+    stat_inc("archive_payments_total", moved["payments"])
+    stat_inc("archive_codes_total", moved["codes"])
+    stat_set("archive_vacuum_pages_last", moved["vacuum_pages"])
+    stat_set("archive_last_run_at", int(time.time()))
+    return moved
+
+
+# Non-blocking flock held for the life of the process. The OS drops it when
+# the holder exits, so another worker picks it up on its next attempt.
+class ProcessLock:
+    def __init__(self, path: str):
+        self._path = path
+        self._fd: Optional[int] = None
+
+    def acquire(self) -> bool:
+        if self._fd is not None:
+            return True
+        fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class Sweeper:
+    def __init__(self, interval: int, lock: ProcessLock):
+        self._interval = interval
+        self._lock = lock
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._interval <= 0 or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="expiry-sweeper", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self._lock.release()
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            # with several workers only the lock holder sweeps
+            if not self._lock.acquire():
+                continue
+            try:
+                sweep_expired()
+            except Exception:
+                stat_inc("sweep_errors_total")
+
+
+sweeper = Sweeper(SWEEP_INTERVAL_SECONDS, ProcessLock(f"{DB_PATH}.sweeper.lock"))
+
+
+# token -> expires_at, in LRU order. Sessions are immutable once written, so
+# an entry stays correct until its own expiry and never needs invalidating.
+class SessionCache:
+    def __init__(self, size: int, enabled: bool):
+        self._size = max(1, size)
+        self.enabled = enabled
+        self._items: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token: str, now: int) -> Optional[int]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            expires_at = self._items.get(token)
+            if expires_at is not None:
+                if expires_at < now:
+                    del self._items[token]
+                    expires_at = None
+                else:
+                    self._items.move_to_end(token)
+        stat_inc("session_cache_hits" if expires_at is not None else "session_cache_misses")
+        return expires_at
+
+    def put(self, token: str, expires_at: int):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._items[token] = expires_at
+            self._items.move_to_end(token)
+            while len(self._items) > self._size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+session_cache = SessionCache(SESSION_CACHE_SIZE, SESSION_CACHE_ENABLED)
 
 
 @app.on_event("startup")
 def _startup():
+    start_sharing(METRICS_DIR, METRICS_FLUSH_SECONDS)
+    if trace_writer is not None:
+        trace_writer.start()
+    if access_log is not None:
+        access_log.start()
+    if span_writer is not None:
+        span_writer.start()
     init_db()
+    store.start()
+    sweeper.start()
+
+
+@app.on_event("shutdown")
+def _shutdown():
+    sweeper.stop()
+    store.close()
+    if trace_writer is not None:
+        trace_writer.stop()
+    if access_log is not None:
+        access_log.stop()
+    if span_writer is not None:
+        span_writer.stop()
+    stop_sharing()
 
 
 class IssueReq(BaseModel):
     user_id: Optional[str] = None
 
 
+class IssueBatchReq(BaseModel):
+    user_ids: Optional[List[str]] = None
+    user_id: Optional[str] = None
+    count: int = 1
+
+
 class VerifyReq(BaseModel):
     code: str
     device_id: str
@@ -129,11 +348,13 @@ class PaymentGetReq(BaseModel):
 class PaymentListReq(BaseModel):
     status: Optional[str] = None
     limit: int = 20
+    after_id: Optional[int] = None
 
 
 class PaymentByUserReq(BaseModel):
     user_id: str
     limit: int = 20
+    after_id: Optional[int] = None
 
 
 class SubStatusReq(BaseModel):
@@ -142,6 +363,9 @@ class SubStatusReq(BaseModel):
 
 class SubExpiringReq(BaseModel):
     days: int = 3
+    limit: int = 500
+    after_expires_at: Optional[int] = None
+    after_user_id: Optional[str] = None
 
 
 class SubRemoveReq(BaseModel):
@@ -153,6 +377,37 @@ class SubSetDaysReq(BaseModel):
     days: int
 
 
+class BulkOp(BaseModel):
+    op: str
+    user_id: Optional[str] = None
+    days: Optional[int] = None
+    payment_id: Optional[int] = None
+    reviewer_id: Optional[str] = None
+
+
+class BulkReq(BaseModel):
+    ops: List[BulkOp]
+
+
+class ArchiveReq(BaseModel):
+    older_than_days: Optional[int] = None
+    convert_vacuum: bool = False
+
+
+class ProfileCpuReq(BaseModel):
+    seconds: float = 10
+    interval_ms: float = 5
+    mode: str = "cpu"
+    format: str = "collapsed"
+
+
+class ProfileMemoryReq(BaseModel):
+    action: str = "snapshot"
+    frames: int = 1
+    limit: int = 30
+    format: str = "json"
+
+
 class IosGetReq(BaseModel):
     user_id: str
 
@@ -168,73 +423,133 @@ class IosCheckNameReq(BaseModel):
 
 
 def check_secret(given: Optional[str], expected: str, name: str):
-    if not expected:
-        raise HTTPException(status_code=500, detail=f"{name} not configured")
-    if given != expected:
-        raise HTTPException(status_code=401, detail="unauthorized")
-
-
-def gen_code() -> str:
-    a = secrets.token_hex(2).upper()
-    b = secrets.token_hex(2).upper()
-    return f"V7-{a}-{b}"
+    with span("secret_check"):
+        if not expected:
+            raise HTTPException(status_code=500, detail=f"{name} not configured")
+        if given != expected:
+            raise HTTPException(status_code=401, detail="unauthorized")
 
 
 def normalize_code(value: str) -> str:
     return value.strip().upper()
 
 
-def get_active_subscription(conn: sqlite3.Connection, user_id: str) -> Optional[int]:
-    now = int(time.time())
-    row = conn.execute(
-        "SELECT expires_at FROM subscriptions WHERE user_id=?",
-        (user_id,),
-    ).fetchone()
-    if not row:
-        return None
-    (expires_at,) = row
+# Signed sessions: "v1.<kid>.<payload>.<sig>", payload = b64("<exp>.<nonce>.<device_id>").
+# Every key id has its own server-only secret: SESSION_KEYS="k1:<secret>,k2:<secret>"
+# (SESSION_SIGNING_SECRET alone is the same as "k1:<secret>"). New tokens are signed
+# with SESSION_KEY_ID, or the first key; rotating means adding a key with a new
+# secret, switching SESSION_KEY_ID to it, and dropping the old key once its
+# tokens have expired. Without any key, "v1." tokens are not accepted at all.
+SIGNED_TOKEN_PREFIX = "v1."
+
+
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _unb64(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def parse_session_keys(spec: str, single_secret: str = "") -> dict:
+    keys = {}
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        kid, _, secret = part.partition(":")
+        kid, secret = kid.strip(), secret.strip()
+        if not kid or "." in kid or not secret:
+            raise ValueError(f"SESSION_KEYS entries must be <kid>:<secret>: {part}")
+        keys[kid] = hmac.new(secret.encode(), f"session-key:{kid}".encode(), hashlib.sha256).digest()
+    if not keys and single_secret:
+        keys["k1"] = hmac.new(single_secret.encode(), b"session-key:k1", hashlib.sha256).digest()
+    return keys
+
+
+session_keys = parse_session_keys(SESSION_KEYS, SESSION_SIGNING_SECRET)
+signing_kid = SESSION_KEY_ID or next(iter(session_keys), "")
+if session_keys and signing_kid not in session_keys:
+    raise RuntimeError(f"SESSION_KEY_ID={signing_kid} is not in SESSION_KEYS")
+if SESSION_MODE == "signed" and not session_keys:
+    raise RuntimeError("SESSION_MODE=signed needs SESSION_KEYS or SESSION_SIGNING_SECRET")
+
+
+def sign_session(device_id: str, expires_at: int) -> str:
+    payload = _b64(f"{expires_at}.{secrets.token_hex(8)}.{device_id}".encode())
+    body = f"{SIGNED_TOKEN_PREFIX}{signing_kid}.{payload}"
+    sig = hmac.new(session_keys[signing_kid], body.encode(), hashlib.sha256).digest()
+    return f"{body}.{_b64(sig)}"
+
+
+def check_signed_session(token: str, now: int) -> int:
+    try:
+        _, kid, payload, sig = token.split(".")
+        key = session_keys.get(kid)
+        if key is None:
+            raise ValueError(kid)
+        body = token[: -len(sig) - 1]
+        expected = hmac.new(key, body.encode(), hashlib.sha256).digest()
+        if not hmac.compare_digest(expected, _unb64(sig)):
+            raise ValueError("signature")
+        expires_at = int(_unb64(payload).split(b".", 1)[0])
+    except ValueError:
+        raise HTTPException(status_code=400, detail="invalid_session")
     if expires_at < now:
-        return None
+        raise HTTPException(status_code=400, detail="session_expired")
     return expires_at
 
 
-def extend_subscription(conn: sqlite3.Connection, user_id: str, months: int) -> int:
-    now = int(time.time())
-    row = conn.execute(
-        "SELECT expires_at FROM subscriptions WHERE user_id=?",
-        (user_id,),
-    ).fetchone()
-    base = now
-    if row:
-        (current_expires,) = row
-        if current_expires > now:
-            base = current_expires
-    new_expires = base + (months * SUBSCRIPTION_MONTH_SECONDS)
-    conn.execute(
-        "INSERT INTO subscriptions(user_id, expires_at) VALUES(?, ?)"
-        " ON CONFLICT(user_id) DO UPDATE SET expires_at=excluded.expires_at",
-        (user_id, new_expires),
-    )
-    return new_expires
+def new_session(device_id: str, now: int):
+    session_expires = now + SESSION_TTL_SECONDS
+    if SESSION_MODE == "signed":
+        return sign_session(device_id, session_expires), session_expires, False
+    return secrets.token_urlsafe(32), session_expires, True
+
 
+def session_ok(expires_at: int) -> Response:
+    # the most frequent response body, rendered without a serializer
+    return raw_json(b'{"ok":true,"expires_at":%d}' % expires_at)
 
-@app.post("/issue")
-def issue(req: IssueReq, x_bot_secret: Optional[str] = Header(None)):
+
+# Hot endpoints take their body through json_body() and return a finished
+# Response, which skips FastAPI's body parsing and jsonable_encoder.
+@app.post("/issue", openapi_extra=body_schema(IssueReq))
+def issue(req: IssueReq = Depends(json_body(IssueReq)), x_bot_secret: Optional[str] = Header(None)):
     check_secret(x_bot_secret, BOT_SECRET, "BOT_SECRET")
     if not req.user_id:
         raise HTTPException(status_code=400, detail="user_id_required")
-    code = gen_code()
     expires_at = int(time.time()) + CODE_TTL_SECONDS
-    with db() as conn:
-        conn.execute(
-            "INSERT INTO codes(code, user_id, expires_at, used) VALUES(?, ?, ?, 0)",
-            (code, req.user_id or "", expires_at),
-        )
-    return {"code": code, "expires_at": expires_at}
+    (code,) = store.issue_codes([req.user_id], expires_at)
+    return FastJSONResponse({"code": code, "expires_at": expires_at})
 
 
-@app.post("/verify")
-def verify(req: VerifyReq, x_app_secret: Optional[str] = Header(None)):
+@app.post("/issue/batch")
+def issue_batch(req: IssueBatchReq, x_bot_secret: Optional[str] = Header(None)):
+    check_secret(x_bot_secret, BOT_SECRET, "BOT_SECRET")
+    user_id = (req.user_id or "").strip()
+    if req.user_ids is not None:
+        user_ids = [u.strip() for u in req.user_ids]
+    elif user_id:
+        if req.count < 1:
+            raise HTTPException(status_code=400, detail="invalid_count")
+        user_ids = [user_id] * min(int(req.count), ISSUE_BATCH_MAX + 1)
+    else:
+        user_ids = []
+    if not user_ids or not all(user_ids):
+        raise HTTPException(status_code=400, detail="user_id_required")
+    if len(user_ids) > ISSUE_BATCH_MAX:
+        raise HTTPException(status_code=400, detail="batch_too_large")
+    expires_at = int(time.time()) + CODE_TTL_SECONDS
+    codes = store.issue_codes(user_ids, expires_at)
+    return {
+        "items": [{"user_id": u, "code": c} for u, c in zip(user_ids, codes)],
+        "expires_at": expires_at,
+    }
+
+
+@app.post("/verify", openapi_extra=body_schema(VerifyReq))
+def verify(req: VerifyReq = Depends(json_body(VerifyReq)), x_app_secret: Optional[str] = Header(None)):
     check_secret(x_app_secret, APP_SECRET, "APP_SECRET")
     now = int(time.time())
     code_input = normalize_code(req.code)
@@ -244,121 +559,44 @@ def verify(req: VerifyReq, x_app_secret: Optional[str] = Header(None)):
     if not device_id:
         raise HTTPException(status_code=400, detail="invalid_device")
 
-    with db() as conn:
-        conn.execute("BEGIN IMMEDIATE")
-        row = conn.execute(
-            "SELECT code, user_id, expires_at, used, redeemed_device_id, session_token, session_expires_at "
-            "FROM codes WHERE code=?",
-            (code_input,),
-        ).fetchone()
-        if not row:
-            raise HTTPException(status_code=400, detail="invalid_code")
-        code, user_id, expires_at, used, redeemed_device_id, session_token, session_expires_at = row
-        if expires_at < now:
-            raise HTTPException(status_code=400, detail="code_expired")
-        redeemed_device_id = (redeemed_device_id or "").strip()
-        session_token = (session_token or "").strip()
-        session_expires_at = int(session_expires_at or 0)
-
-        if used:
-            if (
-                redeemed_device_id == device_id
-                and session_token
-                and session_expires_at >= now
-            ):
-                return {
-                    "ok": True,
-                    "session_token": session_token,
-                    "expires_at": session_expires_at,
-                    "reused": True,
-                }
-            raise HTTPException(status_code=400, detail="code_used")
-
-
-        token = secrets.token_urlsafe(32)
-        session_expires = now + SESSION_TTL_SECONDS
-        conn.execute(
-            "INSERT INTO sessions(token, device_id, expires_at) VALUES(?, ?, ?)",
-            (token, device_id, session_expires),
-        )
-        updated = conn.execute(
-            "UPDATE codes "
-            "SET used=1, redeemed_device_id=?, session_token=?, session_expires_at=? "
-            "WHERE code=? AND used=0",
-            (device_id, token, session_expires, code),
-        )
-        if updated.rowcount != 1:
-            row = conn.execute(
-                "SELECT redeemed_device_id, session_token, session_expires_at, used "
-                "FROM codes WHERE code=?",
-                (code,),
-            ).fetchone()
-            if row:
-                existing_device_id, existing_token, existing_session_expires_at, existing_used = row
-                if (
-                    int(existing_used or 0) == 1
-                    and (existing_device_id or "").strip() == device_id
-                    and (existing_token or "").strip()
-                    and int(existing_session_expires_at or 0) >= now
-                ):
-                    return {
-                        "ok": True,
-                        "session_token": existing_token,
-                        "expires_at": int(existing_session_expires_at),
-                        "reused": True,
-                    }
-            raise HTTPException(status_code=400, detail="code_used")
-    return {"ok": True, "session_token": token, "expires_at": session_expires}
-
-
-@app.post("/validate")
-def validate(req: ValidateReq, x_app_secret: Optional[str] = Header(None)):
+    result = store.redeem_code(code_input, device_id, now, lambda d: new_session(d, now))
+    if not result["session_token"].startswith(SIGNED_TOKEN_PREFIX):
+        session_cache.put(result["session_token"], result["expires_at"])
+    return FastJSONResponse(result)
+
+
+@app.post("/validate", openapi_extra=body_schema(ValidateReq))
+def validate(req: ValidateReq = Depends(json_body(ValidateReq)), x_app_secret: Optional[str] = Header(None)):
     check_secret(x_app_secret, APP_SECRET, "APP_SECRET")
     now = int(time.time())
-    with db() as conn:
-        row = conn.execute(
-            "SELECT token, expires_at FROM sessions WHERE token=?",
-            (req.session_token,),
-        ).fetchone()
-        if not row:
-            raise HTTPException(status_code=400, detail="invalid_session")
-        _, expires_at = row
-        if expires_at < now:
-            raise HTTPException(status_code=400, detail="session_expired")
-    return {"ok": True, "expires_at": expires_at}
+    # signed tokens are accepted in either mode so switching modes does not log
+    # devices out, but only while a server-only signing key is configured
+    if session_keys and req.session_token.startswith(SIGNED_TOKEN_PREFIX):
+        return session_ok(check_signed_session(req.session_token, now))
+    cached = session_cache.get(req.session_token, now)
+    if cached is not None:
+        return session_ok(cached)
+    expires_at = store.get_session(req.session_token)
+    if expires_at is None:
+        raise HTTPException(status_code=400, detail="invalid_session")
+    if expires_at < now:
+        raise HTTPException(status_code=400, detail="session_expired")
+    session_cache.put(req.session_token, expires_at)
+    return session_ok(expires_at)
 
 
 @app.post("/payment/create")
 def payment_create(req: PaymentCreateReq, x_bot_secret: Optional[str] = Header(None)):
     check_secret(x_bot_secret, BOT_SECRET, "BOT_SECRET")
     now = int(time.time())
-    with db() as conn:
-        cur = conn.execute(
-            "INSERT INTO payments(user_id, plan_months, method, status, created_at)"
-            " VALUES(?, ?, ?, 'pending', ?)",
-            (req.user_id, req.plan_months, req.method, now),
-        )
-        payment_id = cur.lastrowid
+    payment_id = store.create_payment(req.user_id, req.plan_months, req.method, now)
     return {"payment_id": payment_id}
 
 
 @app.post("/payment/attach")
 def payment_attach(req: PaymentAttachReq, x_bot_secret: Optional[str] = Header(None)):
     check_secret(x_bot_secret, BOT_SECRET, "BOT_SECRET")
-    with db() as conn:
-        row = conn.execute(
-            "SELECT status FROM payments WHERE id=?",
-            (req.payment_id,),
-        ).fetchone()
-        if not row:
-            raise HTTPException(status_code=404, detail="payment_not_found")
-        (status,) = row
-        if status != "pending":
-            raise HTTPException(status_code=400, detail="payment_not_pending")
-        conn.execute(
-            "UPDATE payments SET screenshot_file_id=? WHERE id=?",
-            (req.screenshot_file_id, req.payment_id),
-        )
+    store.attach_screenshot(req.payment_id, req.screenshot_file_id)
     return {"ok": True}
 
 
@@ -366,49 +604,87 @@ def payment_attach(req: PaymentAttachReq, x_bot_secret: Optional[str] = Header(N
 def payment_approve(req: PaymentReviewReq, x_bot_secret: Optional[str] = Header(None)):
     check_secret(x_bot_secret, BOT_SECRET, "BOT_SECRET")
     now = int(time.time())
-    with db() as conn:
-        row = conn.execute(
-            "SELECT user_id, plan_months, status FROM payments WHERE id=?",
-            (req.payment_id,),
-        ).fetchone()
-        if not row:
-            raise HTTPException(status_code=404, detail="payment_not_found")
-        user_id, plan_months, status = row
-        if status != "pending":
-            raise HTTPException(status_code=400, detail="payment_not_pending")
-        conn.execute(
-            "UPDATE payments SET status='approved', reviewed_at=?, reviewer_id=? WHERE id=?",
-            (now, req.reviewer_id or "", req.payment_id),
-        )
-        new_expires = extend_subscription(conn, user_id, int(plan_months))
-    return {"ok": True, "user_id": user_id, "expires_at": new_expires}
+    return store.review_payment(req.payment_id, req.reviewer_id, True, now)
 
 
 @app.post("/payment/reject")
 def payment_reject(req: PaymentReviewReq, x_bot_secret: Optional[str] = Header(None)):
     check_secret(x_bot_secret, BOT_SECRET, "BOT_SECRET")
     now = int(time.time())
-    with db() as conn:
-        row = conn.execute(
-            "SELECT user_id, status FROM payments WHERE id=?",
-            (req.payment_id,),
-        ).fetchone()
-        if not row:
-            raise HTTPException(status_code=404, detail="payment_not_found")
-        user_id, status = row
-        if status != "pending":
-            raise HTTPException(status_code=400, detail="payment_not_pending")
-        conn.execute(
-            "UPDATE payments SET status='rejected', reviewed_at=?, reviewer_id=? WHERE id=?",
-            (now, req.reviewer_id or "", req.payment_id),
-        )
-    return {"ok": True, "user_id": user_id}
-
-
-@app.post("/sub/status")
-def sub_status(req: SubStatusReq, x_bot_secret: Optional[str] = Header(None)):
+    return store.review_payment(req.payment_id, req.reviewer_id, False, now)
+
+
+@app.post("/sub/status", openapi_extra=body_schema(SubStatusReq))
+def sub_status(req: SubStatusReq = Depends(json_body(SubStatusReq)), x_bot_secret: Optional[str] = Header(None)):
+    check_secret(x_bot_secret, BOT_SECRET, "BOT_SECRET")
+    return raw_json(b'{"active":true,"expires_at":%d}' % (int(time.time()) + (3650 * 24 * 60 * 60)))
+
+
+@app.post("/admin/stats")
+def admin_stats(x_bot_secret: Optional[str] = Header(None)):
+    check_secret(x_bot_secret, BOT_SECRET, "BOT_SECRET")
+    stats = snapshot()
+    stats["session_cache_enabled"] = session_cache.enabled
+    stats["storage_backend"] = STORAGE_BACKEND
+    stats["json_codec"] = CODEC
+    return {"stats": stats}
+
+
+@app.post("/admin/storage")
+def admin_storage(x_bot_secret: Optional[str] = Header(None)):
+    check_secret(x_bot_secret, BOT_SECRET, "BOT_SECRET")
+    return {"storage": store.introspect(), "slow_query_ms": SLOW_QUERY_MS, "slow_queries": list(slow_queries)}
+
+
+def check_profiling():
+    if not PROFILING_ENABLED:
+        raise HTTPException(status_code=404, detail="profiling_disabled")
+
+
+@app.post("/admin/profile/cpu")
+def admin_profile_cpu(req: ProfileCpuReq, x_bot_secret: Optional[str] = Header(None)):
     check_secret(x_bot_secret, BOT_SECRET, "BOT_SECRET")
-    return {"active": True, "expires_at": int(time.time()) + (3650 * 24 * 60 * 60)}
+    check_profiling()
+    if req.mode not in ("cpu", "wall") or req.format not in ("collapsed", "pstats"):
+        raise HTTPException(status_code=400, detail="bad_profile_options")
+    seconds = max(0.1, min(req.seconds, PROFILE_MAX_SECONDS))
+    body = profile_cpu(seconds, req.interval_ms / 1000, req.mode, req.format)
+    if body is None:
+        raise HTTPException(status_code=409, detail="profile_running")
+    return Response(body, headers=download(body, req.format, "cpu"))
+
+
+@app.post("/admin/profile/memory")
+def admin_profile_memory(req: ProfileMemoryReq, x_bot_secret: Optional[str] = Header(None)):
+    check_secret(x_bot_secret, BOT_SECRET, "BOT_SECRET")
+    check_profiling()
+    if req.action == "start":
+        memory_start(min(max(1, req.frames), 64))
+        return {"tracing": True}
+    if req.action == "stop":
+        memory_stop()
+        return {"tracing": False}
+    if req.action != "snapshot" or req.format not in ("json", "dump"):
+        raise HTTPException(status_code=400, detail="bad_profile_options")
+    if not tracemalloc.is_tracing():
+        raise HTTPException(status_code=409, detail="tracing_not_started")
+    result = memory_snapshot(max(1, min(req.limit, 500)))
+    if req.format == "json":
+        return result
+    body = memory_dump()
+    return Response(body, headers=download(body, "dump", "memory"))
+
+
+# GET for Prometheus scrapers: "Authorization: Bearer <METRICS_TOKEN>",
+# falling back to BOT_SECRET when no separate token is set
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics(authorization: Optional[str] = Header(None), x_bot_secret: Optional[str] = Header(None)):
+    token = METRICS_TOKEN or BOT_SECRET
+    given = x_bot_secret
+    if authorization and authorization.startswith("Bearer "):
+        given = authorization[len("Bearer ") :]
+    check_secret(given, token, "METRICS_TOKEN")
+    return PlainTextResponse(render_prometheus(), media_type="text/plain; version=0.0.4")
 
 
 @app.post("/sub/expiring")
@@ -416,68 +692,56 @@ def sub_expiring(req: SubExpiringReq, x_bot_secret: Optional[str] = Header(None)
     check_secret(x_bot_secret, BOT_SECRET, "BOT_SECRET")
     now = int(time.time())
     until = now + (req.days * 24 * 60 * 60)
-    with db() as conn:
-        rows = conn.execute(
-            "SELECT user_id, expires_at FROM subscriptions WHERE expires_at <= ?",
-            (until,),
-        ).fetchall()
-    return {"items": [{"user_id": r[0], "expires_at": r[1]} for r in rows]}
+    limit = max(1, min(int(req.limit), 1000))
+    rows = store.list_expiring(until, limit, req.after_expires_at, req.after_user_id)
+    # like next_after_id on /payment/*: the cursor keys are always present and
+    # null once there are no more pages
+    full = len(rows) == limit
+    return FastJSONResponse(
+        {
+            "items": [{"user_id": r[0], "expires_at": r[1]} for r in rows],
+            "next_after_expires_at": rows[-1][1] if full else None,
+            "next_after_user_id": rows[-1][0] if full else None,
+        }
+    )
 
 
 @app.post("/sub/remove")
 def sub_remove(req: SubRemoveReq, x_bot_secret: Optional[str] = Header(None)):
     check_secret(x_bot_secret, BOT_SECRET, "BOT_SECRET")
-    with db() as conn:
-        row = conn.execute(
-            "SELECT expires_at FROM subscriptions WHERE user_id=?",
-            (req.user_id,),
-        ).fetchone()
-        if not row:
-            return {"ok": True, "removed": False}
-        old_expires = int(row[0] or 0)
-        conn.execute(
-            "DELETE FROM subscriptions WHERE user_id=?",
-            (req.user_id,),
-        )
-    return {"ok": True, "removed": True, "old_expires_at": old_expires}
+    return store.remove_subscription(req.user_id)
 
 
 @app.post("/sub/set_days")
 def sub_set_days(req: SubSetDaysReq, x_bot_secret: Optional[str] = Header(None)):
     check_secret(x_bot_secret, BOT_SECRET, "BOT_SECRET")
-    days = int(req.days)
-    if days < 0 or days > 3650:
-        raise HTTPException(status_code=400, detail="invalid_days")
-
+    days = check_days(req.days)
     now = int(time.time())
-    with db() as conn:
-        if days == 0:
-            conn.execute(
-                "DELETE FROM subscriptions WHERE user_id=?",
-                (req.user_id,),
-            )
-            return {"ok": True, "user_id": req.user_id, "removed": True, "expires_at": None}
-
-        new_expires = now + days * 24 * 60 * 60
-        conn.execute(
-            "INSERT INTO subscriptions(user_id, expires_at) VALUES(?, ?)"
-            " ON CONFLICT(user_id) DO UPDATE SET expires_at=excluded.expires_at",
-            (req.user_id, new_expires),
-        )
-    return {"ok": True, "user_id": req.user_id, "removed": False, "expires_at": new_expires}
+    return store.set_subscription_days(req.user_id, days, now)
+
+
+@app.post("/admin/bulk")
+def admin_bulk(req: BulkReq, x_bot_secret: Optional[str] = Header(None)):
+    check_secret(x_bot_secret, BOT_SECRET, "BOT_SECRET")
+    if len(req.ops) > BULK_MAX_OPS:
+        raise HTTPException(status_code=400, detail="batch_too_large")
+    results = store.bulk(req.ops, int(time.time()))
+    return {"results": results, "failed": sum(1 for r in results if not r.get("ok"))}
+
+
+@app.post("/admin/archive")
+def admin_archive(req: ArchiveReq, x_bot_secret: Optional[str] = Header(None)):
+    check_secret(x_bot_secret, BOT_SECRET, "BOT_SECRET")
+    return {"ok": True, **archive_old(older_than_days=req.older_than_days, convert_vacuum=req.convert_vacuum)}
 
 
 @app.post("/ios/get")
 def ios_get(req: IosGetReq, x_bot_secret: Optional[str] = Header(None)):
     check_secret(x_bot_secret, BOT_SECRET, "BOT_SECRET")
-    with db() as conn:
-        row = conn.execute(
-            "SELECT name, code, created_at FROM ios_links WHERE user_id=?",
-            (req.user_id,),
-        ).fetchone()
-    if not row:
+    link = store.get_ios_link(req.user_id)
+    if not link:
         return {"exists": False}
-    return {"exists": True, "name": row[0], "code": row[1], "created_at": row[2]}
+    return {"exists": True, **link}
 
 
 @app.post("/ios/create")
@@ -487,14 +751,7 @@ def ios_create(req: IosCreateReq, x_bot_secret: Optional[str] = Header(None)):
     if not name:
         raise HTTPException(status_code=400, detail="invalid_name")
     now = int(time.time())
-    with db() as conn:
-        try:
-            conn.execute(
-                "INSERT INTO ios_links(user_id, name, code, created_at) VALUES(?, ?, ?, ?)",
-                (req.user_id, name, req.code, now),
-            )
-        except sqlite3.IntegrityError:
-            raise HTTPException(status_code=409, detail="name_taken")
+    store.create_ios_link(req.user_id, name, req.code, now)
     return {"ok": True, "name": name, "code": req.code}
 
 
@@ -504,92 +761,29 @@ def ios_check_name(req: IosCheckNameReq, x_bot_secret: Optional[str] = Header(No
     name = req.name.strip()
     if not name:
         raise HTTPException(status_code=400, detail="invalid_name")
-    with db() as conn:
-        row = conn.execute(
-            "SELECT 1 FROM ios_links WHERE name=?",
-            (name,),
-        ).fetchone()
-    return {"available": row is None}
+    return {"available": not store.ios_name_taken(name)}
 
 
 @app.post("/payment/get")
 def payment_get(req: PaymentGetReq, x_bot_secret: Optional[str] = Header(None)):
     check_secret(x_bot_secret, BOT_SECRET, "BOT_SECRET")
-    with db() as conn:
-        row = conn.execute(
-            "SELECT id, user_id, plan_months, method, screenshot_file_id, status, created_at, reviewed_at, reviewer_id "
-            "FROM payments WHERE id=?",
-            (req.payment_id,),
-        ).fetchone()
-    if not row:
+    payment = store.get_payment(req.payment_id)
+    if not payment:
         raise HTTPException(status_code=404, detail="payment_not_found")
-    return {
-        "payment": {
-            "id": row[0],
-            "user_id": row[1],
-            "plan_months": row[2],
-            "method": row[3],
-            "screenshot_file_id": row[4],
-            "status": row[5],
-            "created_at": row[6],
-            "reviewed_at": row[7],
-            "reviewer_id": row[8],
-        }
-    }
+    return {"payment": payment}
 
 
 @app.post("/payment/list")
 def payment_list(req: PaymentListReq, x_bot_secret: Optional[str] = Header(None)):
     check_secret(x_bot_secret, BOT_SECRET, "BOT_SECRET")
     limit = max(1, min(int(req.limit), 100))
-    with db() as conn:
-        if req.status:
-            rows = conn.execute(
-                "SELECT id, user_id, plan_months, method, status, created_at "
-                "FROM payments WHERE status=? ORDER BY id DESC LIMIT ?",
-                (req.status, limit),
-            ).fetchall()
-        else:
-            rows = conn.execute(
-                "SELECT id, user_id, plan_months, method, status, created_at "
-                "FROM payments ORDER BY id DESC LIMIT ?",
-                (limit,),
-            ).fetchall()
-    items = []
-    for r in rows:
-        items.append(
-            {
-                "id": r[0],
-                "user_id": r[1],
-                "plan_months": r[2],
-                "method": r[3],
-                "status": r[4],
-                "created_at": r[5],
-            }
-        )
-    return {"items": items}
+    items = store.list_payments(req.status, req.after_id, limit)
+    return FastJSONResponse({"items": items, "next_after_id": items[-1]["id"] if len(items) == limit else None})
 
 
 @app.post("/payment/by_user")
 def payment_by_user(req: PaymentByUserReq, x_bot_secret: Optional[str] = Header(None)):
     check_secret(x_bot_secret, BOT_SECRET, "BOT_SECRET")
     limit = max(1, min(int(req.limit), 100))
-    with db() as conn:
-        rows = conn.execute(
-            "SELECT id, user_id, plan_months, method, status, created_at "
-            "FROM payments WHERE user_id=? ORDER BY id DESC LIMIT ?",
-            (req.user_id, limit),
-        ).fetchall()
-    items = []
-    for r in rows:
-        items.append(
-            {
-                "id": r[0],
-                "user_id": r[1],
-                "plan_months": r[2],
-                "method": r[3],
-                "status": r[4],
-                "created_at": r[5],
-            }
-        )
-    return {"items": items}
+    items = store.payments_by_user(req.user_id, req.after_id, limit)
+    return FastJSONResponse({"items": items, "next_after_id": items[-1]["id"] if len(items) == limit else None})
@@ -0,0 +1,282 @@
+import bisect
+import json
+import os
+import re
+import threading
+import time
+from typing import Optional, Tuple
+
+stats: dict = {}
+counters: set = set()
+stats_lock = threading.Lock()
+
+# Labeled series for the Prometheus exposition. Labels are a tuple of
+# (name, value) pairs; histograms keep per-bucket (not cumulative) counts,
+# then the +Inf count, then the sum.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+labeled: dict = {}
+histograms: dict = {}
+
+# With several worker processes each one writes its own stats to
+# <share_dir>/<pid>.json and snapshot() merges every file: counters are
+# summed, LOAD_GAUGES (work in progress per worker) are summed, other gauges
+# (settings, last run times) take the largest value. Gauges in files of
+# workers that have exited are left out; their counters still count.
+LOAD_GAUGES = frozenset(("admission_inflight", "db_pool_in_use", "db_write_queue_depth"))
+share_dir = ""
+_flusher: Optional[threading.Thread] = None
+_flusher_stop = threading.Event()
+
+
+def stat_inc(name: str, value: int = 1):
+    with stats_lock:
+        stats[name] = stats.get(name, 0) + value
+        counters.add(name)
+
+
+def stat_set(name: str, value):
+    with stats_lock:
+        stats[name] = value
+
+
+def stat_add(name: str, value):
+    # gauge that moves both ways, e.g. connections in use
+    with stats_lock:
+        stats[name] = stats.get(name, 0) + value
+
+
+def count(name: str, labels: Tuple = (), value: int = 1):
+    key = (name, labels)
+    with stats_lock:
+        labeled[key] = labeled.get(key, 0) + value
+
+
+def observe(name: str, seconds: float, labels: Tuple = ()):
+    index = bisect.bisect_left(BUCKETS, seconds)
+    key = (name, labels)
+    with stats_lock:
+        series = histograms.get(key)
+        if series is None:
+            series = histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+        series[index] += 1
+        series[-1] += seconds
+
+
+def _local() -> dict:
+    with stats_lock:
+        return {
+            "counters": {k: v for k, v in stats.items() if k in counters},
+            "gauges": {k: v for k, v in stats.items() if k not in counters},
+            "labeled": [[name, labels, value] for (name, labels), value in labeled.items()],
+            "histograms": [[name, labels, list(series)] for (name, labels), series in histograms.items()],
+        }
+
+
+def flush():
+    if not share_dir:
+        return
+    path = os.path.join(share_dir, f"{os.getpid()}.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(_local(), f)
+    os.replace(path + ".tmp", path)
+
+
+def start_sharing(directory: str, interval: float):
+    global share_dir, _flusher
+    if not directory or _flusher is not None:
+        return
+    os.makedirs(directory, exist_ok=True)
+    share_dir = directory
+    _flusher_stop.clear()
+
+    def run():
+        while not _flusher_stop.wait(interval):
+            try:
+                flush()
+            except OSError:
+                pass
+
+    _flusher = threading.Thread(target=run, name="metrics-flusher", daemon=True)
+    _flusher.start()
+
+
+def stop_sharing():
+    global _flusher
+    if _flusher is None:
+        return
+    _flusher_stop.set()
+    _flusher.join()
+    _flusher = None
+    flush()
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _parts() -> list:
+    parts = [_local()]
+    if not share_dir:
+        return parts
+    own = f"{os.getpid()}.json"
+    for name in os.listdir(share_dir):
+        if not name.endswith(".json") or name == own:
+            continue
+        try:
+            with open(os.path.join(share_dir, name)) as f:
+                part = json.load(f)
+        except (OSError, ValueError):
+            continue
+        pid = name[: -len(".json")]
+        if pid.isdigit() and not _alive(int(pid)):
+            part["gauges"] = {}
+        parts.append(part)
+    return parts
+
+
+def _merge_flat(parts: list) -> Tuple[dict, set]:
+    merged: dict = {}
+    summed: set = set()
+    for part in parts:
+        for k, v in part["gauges"].items():
+            current = merged.get(k)
+            if k in LOAD_GAUGES and current is not None:
+                merged[k] = current + v
+            elif current is None or (isinstance(v, (int, float)) and isinstance(current, (int, float)) and v > current):
+                merged[k] = v
+        for k, v in part["counters"].items():
+            merged[k] = merged.get(k, 0) + v
+            summed.add(k)
+    return merged, summed
+
+
+def snapshot() -> dict:
+    if not share_dir:
+        with stats_lock:
+            return dict(stats)
+    parts = _parts()
+    merged, _ = _merge_flat(parts)
+    merged["metrics_workers"] = len(parts)
+    return merged
+
+
+def _name(prefix: str, name: str) -> str:
+    return prefix + "_" + re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def _labels(labels, extra: str = "") -> str:
+    pairs = [
+        '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def render_prometheus(prefix: str = "v7ck9ll") -> str:
+    parts = _parts()
+    flat, summed = _merge_flat(parts)
+    flat["metrics_workers"] = len(parts)
+    series: dict = {}
+    buckets: dict = {}
+    for part in parts:
+        for name, labels, value in part["labeled"]:
+            key = (name, tuple(tuple(pair) for pair in labels))
+            series[key] = series.get(key, 0) + value
+        for name, labels, values in part["histograms"]:
+            key = (name, tuple(tuple(pair) for pair in labels))
+            current = buckets.get(key)
+            buckets[key] = values if current is None else [a + b for a, b in zip(current, values)]
+    lines = []
+    for k in sorted(flat):
+        v = flat[k]
+        if isinstance(v, bool):
+            v = int(v)
+        if not isinstance(v, (int, float)):
+            continue
+        name = _name(prefix, k)
+        lines.append(f"# TYPE {name} {'counter' if k in summed else 'gauge'}")
+        lines.append(f"{name} {v}")
+    typed = set()
+    for (k, labels), v in sorted(series.items()):
+        name = _name(prefix, k)
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} counter")
+        lines.append(f"{name}{_labels(labels)} {v}")
+    for (k, labels), values in sorted(buckets.items()):
+        name = _name(prefix, k)
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} histogram")
+        total = 0
+        for le, n in zip(BUCKETS + ("+Inf",), values):
+            total += n
+            lines.append("%s_bucket%s %d" % (name, _labels(labels, 'le="%s"' % le), total))
+        lines.append(f"{name}_sum{_labels(labels)} {values[-1]:.6f}")
+        lines.append(f"{name}_count{_labels(labels)} {total}")
+    return "\n".join(lines) + "\n"
+
+
+def error_detail(body: bytes) -> str:
+    try:
+        detail = json.loads(body).get("detail")
+    except (ValueError, AttributeError):
+        return "-"
+    if isinstance(detail, list):
+        return "validation_error"
+    return str(detail)[:64] if detail is not None else "-"
+
+
+# Outermost pure ASGI wrapper: one timer per request plus a labeled count;
+# error bodies (4xx/5xx) are buffered only to read their "detail" code.
+# Unmatched paths are folded into one label so scanners cannot blow up the
+# series count.
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+        self.paths: Optional[set] = None
+
+    def route_label(self, scope) -> str:
+        route = scope.get("route")
+        if route is not None:
+            return route.path
+        if self.paths is None:
+            app = scope.get("app")
+            self.paths = {r.path for r in getattr(app, "routes", []) if "{" not in getattr(r, "path", "{")}
+        return scope["path"] if scope["path"] in self.paths else "unmatched"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        status = 500
+        error_body: Optional[list] = None
+
+        async def send_timed(message):
+            nonlocal status, error_body
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if status >= 400:
+                    error_body = []
+            elif error_body is not None and len(error_body) < 4:
+                error_body.append(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            elapsed = time.perf_counter() - started
+            route = self.route_label(scope)
+            observe("http_request_duration_seconds", elapsed, (("route", route),))
+            count("http_requests_total", (("route", route), ("status", str(status))))
+            if status >= 400:
+                detail = error_detail(b"".join(error_body)) if error_body else "-"
+                count("http_errors_total", (("route", route), ("status", str(status)), ("detail", detail)))
@@ -0,0 +1,20 @@
+import argparse
+
+from main import store
+
+
+def main():
+    argparse.ArgumentParser(
+        description="Apply schema migrations and build BACKGROUND_STEPS (indexes) in the foreground; "
+        "for SCHEMA_STEPS_BACKGROUND=false, run it in a quiet window since the builds block writes"
+    ).parse_args()
+    store.init()
+    store.start()
+    try:
+        print({"steps": store.run_steps()})
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
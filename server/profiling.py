@@ -0,0 +1,266 @@
+import hmac
+import marshal
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from typing import Callable, Optional
+
+from metrics import stat_inc
+
+# Sampling profiler: a thread that reads sys._current_frames() every interval.
+# Nothing is hooked into the interpreter, so there is no cost while it is not
+# running. In "cpu" mode a thread is only sampled when its CPU clock moved
+# since the previous sample, which leaves out idle pool threads and waits; in
+# "wall" mode every sampled stack counts, waits included.
+
+
+def _thread_cpu(ident: int) -> Optional[float]:
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(ident))
+    except (AttributeError, OSError):
+        return None
+
+
+class Sampler:
+    def __init__(self, interval: float, mode: str = "cpu", keep: Optional[Callable] = None):
+        self.interval = max(0.001, interval)
+        self.mode = mode
+        self.keep = keep
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        names = {}
+        cpu: dict = {}
+        while not self._stop.wait(self.interval):
+            self.samples += 1
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                if self.mode == "cpu":
+                    now = _thread_cpu(ident)
+                    if now is not None:
+                        before = cpu.get(ident)
+                        cpu[ident] = now
+                        if before is None or now <= before:
+                            continue
+                if self.keep is not None and not self.keep(frame):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                    frame = frame.f_back
+                if ident not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                stack.append(("<thread>", 0, names.get(ident, str(ident))))
+                stack.reverse()
+                self.stacks[tuple(stack)] += 1
+
+    def collapsed(self) -> bytes:
+        # Brendan Gregg's folded format, for flamegraph.pl / speedscope
+        lines = []
+        for stack, count in self.stacks.most_common():
+            labels = [stack[0][2]] + [f"{os.path.basename(f)}:{name}" for f, _, name in stack[1:]]
+            lines.append(f"{';'.join(labels)} {count}")
+        return ("\n".join(lines) + "\n").encode()
+
+    def pstats(self) -> bytes:
+        # marshalled in the layout pstats.Stats() loads: call counts are sample
+        # counts and times are samples * interval
+        stats: dict = {}
+        step = self.interval
+        for stack, count in self.stacks.items():
+            frames = stack[1:]
+            if not frames:
+                continue
+            seen = set()
+            for depth, func in enumerate(frames):
+                entry = stats.setdefault(func, [0, 0, 0.0, 0.0, {}])
+                leaf = depth == len(frames) - 1
+                if leaf:
+                    entry[2] += count * step
+                if func not in seen:
+                    seen.add(func)
+                    entry[0] += count
+                    entry[1] += count
+                    entry[3] += count * step
+                if depth:
+                    caller = frames[depth - 1]
+                    nc, cc, tt, ct = entry[4].get(caller, (0, 0, 0.0, 0.0))
+                    entry[4][caller] = (nc + count, cc + count, tt + (count * step if leaf else 0.0), ct + count * step)
+        return marshal.dumps({func: (cc, nc, tt, ct, callers) for func, (cc, nc, tt, ct, callers) in stats.items()})
+
+    def render(self, fmt: str) -> bytes:
+        return self.pstats() if fmt == "pstats" else self.collapsed()
+
+
+profile_lock = threading.Lock()
+
+
+def profile_cpu(seconds: float, interval: float, mode: str, fmt: str) -> Optional[bytes]:
+    # one profile at a time; returns None when another one is running
+    if not profile_lock.acquire(blocking=False):
+        return None
+    try:
+        sampler = Sampler(interval, mode)
+        sampler.start()
+        time.sleep(seconds)
+        sampler.stop()
+        stat_inc("profile_cpu_runs_total")
+        return sampler.render(fmt)
+    finally:
+        profile_lock.release()
+
+
+_last_snapshot: Optional[tracemalloc.Snapshot] = None
+_snapshot_lock = threading.Lock()
+
+
+def memory_start(frames: int):
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(max(1, frames))
+
+
+def memory_stop():
+    global _last_snapshot
+    with _snapshot_lock:
+        _last_snapshot = None
+    tracemalloc.stop()
+
+
+def memory_snapshot(limit: int) -> dict:
+    # top allocation sites, diffed against the previous snapshot if there is one
+    global _last_snapshot
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        (
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        )
+    )
+    with _snapshot_lock:
+        previous, _last_snapshot = _last_snapshot, snapshot
+    if previous is not None:
+        stats = snapshot.compare_to(previous, "lineno")[:limit]
+        top = [
+            {
+                "where": str(s.traceback[0]),
+                "size_kb": round(s.size / 1024, 1),
+                "size_diff_kb": round(s.size_diff / 1024, 1),
+                "count": s.count,
+                "count_diff": s.count_diff,
+            }
+            for s in stats
+        ]
+    else:
+        top = [
+            {"where": str(s.traceback[0]), "size_kb": round(s.size / 1024, 1), "count": s.count}
+            for s in snapshot.statistics("lineno")[:limit]
+        ]
+    current, peak = tracemalloc.get_traced_memory()
+    return {
+        "traced_kb": round(current / 1024, 1),
+        "peak_kb": round(peak / 1024, 1),
+        "diff": previous is not None,
+        "top": top,
+    }
+
+
+def memory_dump() -> bytes:
+    # the last snapshot in tracemalloc's own format, for Snapshot.load()
+    with _snapshot_lock:
+        snapshot = _last_snapshot
+    if snapshot is None:
+        return b""
+    fd, path = tempfile.mkstemp(suffix=".tracemalloc")
+    os.close(fd)
+    try:
+        snapshot.dump(path)
+        with open(path, "rb") as f:
+            return f.read()
+    finally:
+        os.remove(path)
+
+
+def download(body: bytes, fmt: str, prefix: str) -> dict:
+    suffix = {"pstats": "pstats", "dump": "tracemalloc"}.get(fmt, "folded")
+    return {
+        "content-type": "text/plain; charset=utf-8" if suffix == "folded" else "application/octet-stream",
+        "content-disposition": f'attachment; filename="{prefix}-{int(time.time())}.{suffix}"',
+        "content-length": str(len(body)),
+    }
+
+
+# "X-Profile: collapsed|pstats" plus a valid X-Bot-Secret turns the response
+# into a wall-clock profile of that request: only threads currently running
+# the matched endpoint are sampled, and the original status moves to the
+# X-Profile-Status header. Other requests pay one header scan.
+class ProfileMiddleware:
+    def __init__(self, app, secret: str, interval: float = 0.001):
+        self.app = app
+        self.secret = secret.encode()
+        self.interval = interval
+
+    def requested(self, scope) -> Optional[str]:
+        fmt = secret = None
+        for name, value in scope.get("headers", []):
+            if name == b"x-profile":
+                fmt = value.decode("latin-1").strip().lower()
+            elif name == b"x-bot-secret":
+                secret = value
+        if fmt not in ("collapsed", "pstats") or not self.secret or secret is None:
+            return None
+        return fmt if hmac.compare_digest(secret, self.secret) else None
+
+    async def __call__(self, scope, receive, send):
+        fmt = self.requested(scope) if scope["type"] == "http" else None
+        if fmt is None:
+            return await self.app(scope, receive, send)
+
+        def keep(frame) -> bool:
+            route = scope.get("route")
+            target = getattr(getattr(route, "endpoint", None), "__code__", None)
+            while frame is not None:
+                if frame.f_code is target:
+                    return True
+                frame = frame.f_back
+            return False
+
+        status = 500
+
+        async def swallow(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+
+        sampler = Sampler(self.interval, "wall", keep)
+        sampler.start()
+        try:
+            await self.app(scope, receive, swallow)
+        finally:
+            sampler.stop()
+        stat_inc("profile_request_runs_total")
+        body = sampler.render(fmt)
+        headers = download(body, fmt, "request")
+        headers["x-profile-status"] = str(status)
+        headers["x-profile-samples"] = str(sum(sampler.stacks.values()))
+        headers = [(k.encode(), v.encode()) for k, v in headers.items()]
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,191 @@
+import json
+import time
+from collections import OrderedDict
+from typing import List, NamedTuple, Optional
+
+from metrics import stat_inc, stat_set
+
+KEY_KINDS = ("user_id", "device_id", "ip")
+MAX_KEYED_BODY = 64 * 1024
+
+
+class Rule(NamedTuple):
+    path: str
+    key: str
+    count: float
+    seconds: float
+
+    @property
+    def name(self) -> str:
+        return f"{self.path.strip('/').replace('/', '_')}_{self.key}"
+
+
+# "/issue=30/60@user_id,/verify=60/60@ip": <count> requests per <seconds> for
+# each distinct key; several rules may share a path and all of them must pass.
+def parse_rules(spec: str) -> List[Rule]:
+    rules = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        path, _, limit = part.partition("=")
+        limit, _, key = limit.partition("@")
+        count, _, seconds = limit.partition("/")
+        key = key.strip() or "ip"
+        if key not in KEY_KINDS:
+            raise ValueError(f"rate limit key must be one of {KEY_KINDS}: {part}")
+        rules.append(Rule(path.strip(), key, float(count), float(seconds or 1)))
+    return rules
+
+
+# Token buckets for one rule: key -> [tokens, updated_at], in LRU order so an
+# attacker cycling keys cannot grow memory past max_keys. Only touched from
+# the event loop, so no lock is needed.
+class TokenBuckets:
+    def __init__(self, rule: Rule, max_keys: int):
+        self.capacity = max(1.0, rule.count)
+        self.refill = rule.count / max(rule.seconds, 1e-9)
+        self.max_keys = max(1, max_keys)
+        self.buckets: "OrderedDict[str, list]" = OrderedDict()
+
+    def take(self, key: str, now: float) -> float:
+        # returns 0 when a token was taken, else seconds until one is available
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [self.capacity, now]
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+            bucket[0] = min(self.capacity, bucket[0] + (now - bucket[1]) * self.refill)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0.0
+        return (1 - bucket[0]) / self.refill if self.refill else 60.0
+
+
+def reject(detail: str, retry_after: float):
+    body = json.dumps({"detail": detail}).encode()
+    return [
+        {
+            "type": "http.response.start",
+            "status": 429,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(max(1, int(retry_after + 0.999))).encode()),
+            ],
+        },
+        {"type": "http.response.body", "body": body},
+    ]
+
+
+# Pure ASGI so the check costs no extra task or response wrapping. Requests
+# beyond max_concurrency are shed before routing; per-key limits read the body
+# only for rules keyed by a body field and replay it to the app.
+class AdmissionMiddleware:
+    def __init__(
+        self,
+        app,
+        rules: List[Rule],
+        max_concurrency: int = 0,
+        max_keys: int = 100000,
+        trusted_hops: int = 0,
+    ):
+        self.app = app
+        self.max_concurrency = max_concurrency
+        self.trusted_hops = max(0, trusted_hops)
+        self.inflight = 0
+        self.rules: dict = {}
+        for rule in rules:
+            self.rules.setdefault(rule.path, []).append((rule, TokenBuckets(rule, max_keys)))
+            stat_set(f"ratelimit_{rule.name}_limit", f"{rule.count:g}/{rule.seconds:g}s")
+        stat_set("admission_max_concurrency", max_concurrency)
+
+    # Each proxy appends the address it got the request from to
+    # X-Forwarded-For, so with trusted_hops proxies in front the client is the
+    # trusted_hops-th entry from the right; anything further left was sent by
+    # the client itself and can be anything.
+    def client_ip(self, scope) -> str:
+        if self.trusted_hops:
+            entries = []
+            for name, value in scope.get("headers", []):
+                if name == b"x-forwarded-for":
+                    entries.extend(value.decode("latin-1").split(","))
+            if len(entries) >= self.trusted_hops:
+                return entries[-self.trusted_hops].strip()
+        client = scope.get("client")
+        return client[0] if client else "-"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        if self.max_concurrency and self.inflight >= self.max_concurrency:
+            stat_inc("admission_shed_total")
+            for message in reject("overloaded", 1):
+                await send(message)
+            return
+        rules = self.rules.get(scope["path"])
+        if rules:
+            receive, retry_after, rule = await self.check(scope, receive, rules)
+            if rule is not None:
+                stat_inc("ratelimit_rejected_total")
+                stat_inc(f"ratelimit_{rule.name}_rejected")
+                for message in reject("rate_limited", retry_after):
+                    await send(message)
+                return
+        self.inflight += 1
+        stat_set("admission_inflight", self.inflight)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.inflight -= 1
+            stat_set("admission_inflight", self.inflight)
+
+    async def check(self, scope, receive, rules):
+        fields: Optional[dict] = None
+        if any(rule.key != "ip" for rule, _ in rules):
+            body, receive = await buffer_body(receive)
+            fields = body_fields(body)
+        now = time.monotonic()
+        for rule, buckets in rules:
+            key = self.client_ip(scope) if rule.key == "ip" else (fields or {}).get(rule.key)
+            if not isinstance(key, str) or not key.strip():
+                key = "ip:" + self.client_ip(scope)
+            retry_after = buckets.take(key.strip(), now)
+            if retry_after:
+                return receive, retry_after, rule
+        return receive, 0.0, None
+
+
+async def buffer_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] != "http.request":
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            break
+    body = b"".join(chunks)
+    replayed = False
+
+    async def replay():
+        nonlocal replayed
+        if not replayed:
+            replayed = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        return await receive()
+
+    return body, replay
+
+
+def body_fields(body: bytes) -> Optional[dict]:
+    if not body or len(body) > MAX_KEYED_BODY:
+        return None
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
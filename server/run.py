@@ -0,0 +1,44 @@
+import glob
+import os
+import secrets
+import tempfile
+
+import uvicorn
+
+
+def prepare_metrics_dir() -> str:
+    metrics_dir = os.getenv("METRICS_DIR", "")
+    if not metrics_dir:
+        metrics_dir = tempfile.mkdtemp(prefix="v7ck9ll-metrics-")
+        os.environ["METRICS_DIR"] = metrics_dir
+        return metrics_dir
+    # an operator-supplied directory may hold other files: only drop the
+    # per-worker stats of earlier runs so they are not merged in
+    os.makedirs(metrics_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(metrics_dir, "*.json")):
+        os.remove(path)
+    return metrics_dir
+
+
+def main():
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    host = os.getenv("HOST", "0.0.0.0")
+    port = int(os.getenv("PORT", "8000"))
+    if workers > 1:
+        prepare_metrics_dir()
+        # every worker must hash keys the same way or a trace cannot link an
+        # /issue in one worker to the /verify served by another
+        os.environ.setdefault("TRAFFIC_CAPTURE_SALT", secrets.token_hex(16))
+
+    import main as server
+
+    if workers > 1 and server.STORAGE_BACKEND == "memory":
+        raise SystemExit("STORAGE_BACKEND=memory keeps data per process and cannot run with WEB_CONCURRENCY > 1")
+    # migrate once here instead of racing N workers through the first start
+    server.init_db()
+    # uvicorn's own access log writes from the event loop; ours is queued
+    uvicorn.run("main:app", host=host, port=port, workers=workers, access_log=not server.ACCESS_LOG)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1791 @@
+import bisect
+import logging
+import os
+import queue
+import random
+import re
+import secrets
+import sqlite3
+import threading
+import time
+import zlib
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from types import SimpleNamespace
+from typing import Callable, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+from metrics import observe, stat_add, stat_inc, stat_set
+from tracing import record
+
+# new_session(device_id) -> (token, expires_at, persist); persist=False means the
+# token is self-contained and must not be written to the sessions table
+SessionFactory = Callable[[str], Tuple[str, int, bool]]
+
+PAYMENT_COLUMNS = (
+    "id", "user_id", "plan_months", "method", "screenshot_file_id",
+    "status", "created_at", "reviewed_at", "reviewer_id",
+)
+PAYMENT_LIST_COLUMNS = ("id", "user_id", "plan_months", "method", "status", "created_at")
+MAX_ID = 1 << 62
+
+
+def gen_code() -> str:
+    a = secrets.token_hex(2).upper()
+    b = secrets.token_hex(2).upper()
+    return f"V7-{a}-{b}"
+
+
+def check_days(days: Optional[int]) -> int:
+    if days is None or days < 0 or days > 3650:
+        raise HTTPException(status_code=400, detail="invalid_days")
+    return int(days)
+
+
+# The interface every backend implements. Methods raise HTTPException with the
+# same detail codes the endpoints return, so handlers stay storage-agnostic.
+class Storage:
+    def init(self):
+        pass
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+    def run_steps(self) -> List[str]:
+        # builds pending schema steps in the calling thread, returns their names
+        return []
+
+    def issue_codes(self, user_ids: List[str], expires_at: int) -> List[str]:
+        raise NotImplementedError
+
+    def redeem_code(self, code: str, device_id: str, now: int, new_session: SessionFactory) -> dict:
+        raise NotImplementedError
+
+    def get_session(self, token: str) -> Optional[int]:
+        raise NotImplementedError
+
+    def purge_expired(self, table: str, cutoff: int, limit: int) -> int:
+        raise NotImplementedError
+
+    def create_payment(self, user_id: str, plan_months: int, method: str, now: int) -> int:
+        raise NotImplementedError
+
+    def attach_screenshot(self, payment_id: int, screenshot_file_id: str):
+        raise NotImplementedError
+
+    def review_payment(self, payment_id: int, reviewer_id: Optional[str], approve: bool, now: int) -> dict:
+        raise NotImplementedError
+
+    def get_payment(self, payment_id: int) -> Optional[dict]:
+        raise NotImplementedError
+
+    def list_payments(self, status: Optional[str], after_id: Optional[int], limit: int) -> List[dict]:
+        raise NotImplementedError
+
+    def payments_by_user(self, user_id: str, after_id: Optional[int], limit: int) -> List[dict]:
+        raise NotImplementedError
+
+    def list_expiring(
+        self, until: int, limit: int, after_expires_at: Optional[int], after_user_id: Optional[str]
+    ) -> List[Tuple[str, int]]:
+        raise NotImplementedError
+
+    def remove_subscription(self, user_id: str) -> dict:
+        raise NotImplementedError
+
+    def set_subscription_days(self, user_id: str, days: int, now: int) -> dict:
+        raise NotImplementedError
+
+    def bulk(self, ops: list, now: int) -> List[dict]:
+        raise NotImplementedError
+
+    def get_ios_link(self, user_id: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    def create_ios_link(self, user_id: str, name: str, code: str, now: int):
+        raise NotImplementedError
+
+    def ios_name_taken(self, name: str) -> bool:
+        raise NotImplementedError
+
+    def archive(self, cutoff: int, limit: int) -> Tuple[int, int]:
+        raise NotImplementedError
+
+    def incremental_vacuum(self) -> int:
+        raise NotImplementedError
+
+    def convert_incremental_vacuum(self) -> bool:
+        raise NotImplementedError
+
+    def introspect(self) -> dict:
+        raise NotImplementedError
+
+
+def run_bulk_op(store_ops, item, now: int) -> dict:
+    # store_ops exposes remove_subscription/set_subscription_days/review_payment
+    # bound to the current transaction
+    if item.op in ("set_days", "remove"):
+        user_id = (item.user_id or "").strip()
+        if not user_id:
+            raise HTTPException(status_code=400, detail="user_id_required")
+        if item.op == "remove":
+            return store_ops.remove_subscription(user_id)
+        return store_ops.set_subscription_days(user_id, check_days(item.days), now)
+    if item.op in ("approve", "reject"):
+        if item.payment_id is None:
+            raise HTTPException(status_code=400, detail="payment_id_required")
+        return store_ops.review_payment(item.payment_id, item.reviewer_id, item.op == "approve", now)
+    raise HTTPException(status_code=400, detail="unknown_op")
+
+
+slow_log = logging.getLogger("v7ck9ll.sql")
+slow_queries: deque = deque(maxlen=50)
+EXPLAINED = ("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE", "WITH")
+_query_labels: dict = {}
+
+
+def query_label(sql: str) -> str:
+    # "SELECT payments" style label so the histogram has one series per
+    # statement shape rather than per SQL string
+    label = _query_labels.get(sql)
+    if label is None:
+        verb = sql.split(None, 1)[0].upper() if sql.strip() else "-"
+        match = re.search(r"\b(?:FROM|INTO|UPDATE)\s+([\w.]+)", sql, re.IGNORECASE)
+        label = f"{verb} {match.group(1)}" if match and verb != "PRAGMA" else verb
+        if len(_query_labels) < 1000:
+            _query_labels[sql] = label
+    return label
+
+
+def log_slow_query(conn: sqlite3.Connection, sql: str, params, elapsed: float):
+    stat_inc("db_slow_queries_total")
+    plan = []
+    if sql.lstrip()[:7].upper().startswith(EXPLAINED):
+        if params is None:
+            params = [None] * sql.count("?")
+        try:
+            plan = [row[3] for row in sqlite3.Connection.execute(conn, "EXPLAIN QUERY PLAN " + sql, params)]
+        except sqlite3.Error:
+            pass
+    # parameters are left out: they carry codes, tokens and user ids
+    entry = {"at": int(time.time()), "ms": round(elapsed * 1000, 2), "sql": " ".join(sql.split()), "plan": plan}
+    slow_queries.append(entry)
+    slow_log.warning("slow query %.1f ms: %s | plan: %s", entry["ms"], entry["sql"], "; ".join(plan) or "-")
+
+
+# Connection factory that times every statement; anything slower than
+# slow_query_ms is logged with its query plan.
+class TimedConnection(sqlite3.Connection):
+    slow_query_ms = 0.0
+
+    def execute(self, sql, params=()):
+        started = time.perf_counter()
+        cursor = super().execute(sql, params)
+        self._record(sql, params, time.perf_counter() - started)
+        return cursor
+
+    def executemany(self, sql, seq_of_params):
+        started = time.perf_counter()
+        cursor = super().executemany(sql, seq_of_params)
+        self._record(sql, None, time.perf_counter() - started)
+        return cursor
+
+    def _record(self, sql: str, params, elapsed: float):
+        label = query_label(sql)
+        observe("db_statement_seconds", elapsed, (("query", label),))
+        record("query", time.perf_counter() - elapsed, elapsed, query=label)
+        if self.slow_query_ms and elapsed * 1000 >= self.slow_query_ms:
+            log_slow_query(self, sql, params, elapsed)
+
+
+def file_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def db_info(conn: sqlite3.Connection, schema: str, path: str) -> dict:
+    def pragma(name: str):
+        return conn.execute(f"PRAGMA {schema}.{name}").fetchone()[0]
+
+    tables = [
+        row[0]
+        for row in conn.execute(
+            f"SELECT name FROM {schema}.sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+        )
+    ]
+    try:
+        # dbstat walks every page, so this endpoint is for occasional admin use
+        pages = dict(conn.execute("SELECT name, COUNT(*) FROM dbstat(?) GROUP BY name", (schema,)))
+    except sqlite3.Error:
+        pages = {}
+    return {
+        "path": path,
+        "page_size": pragma("page_size"),
+        "page_count": pragma("page_count"),
+        "freelist_count": pragma("freelist_count"),
+        "auto_vacuum": pragma("auto_vacuum"),
+        "file_bytes": file_size(path),
+        "wal_bytes": file_size(path + "-wal"),
+        "tables": {
+            name: {"rows": conn.execute(f'SELECT COUNT(*) FROM {schema}."{name}"').fetchone()[0], "pages": pages.get(name)}
+            for name in tables
+        },
+        "indexes": {name: n for name, n in pages.items() if name not in tables and not name.startswith("sqlite_")},
+    }
+
+
+# Per-request DB time: the access log middleware sets a one-element list and
+# request threads (which run in a copy of its context) add pool and writer
+# time to it. Unset outside requests, e.g. in the writer thread itself.
+db_time: ContextVar[Optional[list]] = ContextVar("db_time", default=None)
+
+
+class ConnectionPool:
+    def __init__(self, connect: Callable[[], sqlite3.Connection], size: int):
+        self._connect = connect
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max(1, size))
+
+    @contextmanager
+    def connection(self):
+        started = time.perf_counter()
+        self._slots.acquire()
+        acquired = time.perf_counter()
+        observe("db_pool_wait_seconds", acquired - started)
+        stat_add("db_pool_in_use", 1)
+        conn = None
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+            record("db_acquire", started, time.perf_counter() - started)
+            with conn:
+                yield conn
+        finally:
+            if conn is not None:
+                if conn.in_transaction:
+                    conn.rollback()
+                self._idle.put(conn)
+            self._slots.release()
+            stat_add("db_pool_in_use", -1)
+            finished = time.perf_counter()
+            observe("db_read_seconds", finished - acquired)
+            spent = db_time.get()
+            if spent is not None:
+                spent[0] += finished - started
+
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            conn.close()
+
+
+def is_busy(error: sqlite3.OperationalError) -> bool:
+    message = str(error)
+    return "database is locked" in message or "database is busy" in message
+
+
+class WriteOp:
+    __slots__ = ("fn", "done", "result", "error", "queued_at", "phases", "batch_size")
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.queued_at = time.perf_counter()
+        # batch timestamps set by the writer: started, locked, executed, committed
+        self.phases: tuple = ()
+        self.batch_size = 0
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+
+
+# Owns the only write connection and commits queued operations in groups.
+# Every operation runs inside its own savepoint, so an exception (e.g. an
+# HTTPException raised by a handler) only undoes that operation and the rest
+# of the group still commits with a single fsync.
+class DbWriter:
+    def __init__(self, connect: Callable[[], sqlite3.Connection], batch_size: int, busy_retries: int = 0):
+        self._connect = connect
+        self._queue: "queue.Queue[Optional[WriteOp]]" = queue.Queue()
+        self._batch_size = max(1, batch_size)
+        self._busy_retries = max(0, busy_retries)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def submit(self, fn):
+        if self._thread is None:
+            self.start()
+        op = WriteOp(fn)
+        self._queue.put(op)
+        op.done.wait()
+        spent = db_time.get()
+        if spent is not None:
+            spent[0] += time.perf_counter() - op.queued_at
+        marks = (op.queued_at, *op.phases)
+        for name, begin, end in zip(("write_queue", "lock_wait", "write", "commit"), marks, marks[1:]):
+            record(name, begin, end - begin, batch=op.batch_size)
+        if op.error is not None:
+            raise op.error
+        return op.result
+
+    def _run(self):
+        conn = self._connect()
+        conn.isolation_level = None
+        try:
+            running = True
+            while running:
+                op = self._queue.get()
+                if op is None:
+                    break
+                batch = [op]
+                while len(batch) < self._batch_size:
+                    try:
+                        op = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if op is None:
+                        running = False
+                        break
+                    batch.append(op)
+                stat_set("db_write_queue_depth", self._queue.qsize())
+                self._commit(conn, batch)
+        finally:
+            conn.close()
+
+    def _begin(self, conn: sqlite3.Connection):
+        # Other worker processes hold the same write lock. busy_timeout already
+        # waits inside SQLite; when it runs out, back off and try again before
+        # failing the batch. Nothing has executed yet, so a retry is safe.
+        for attempt in range(self._busy_retries + 1):
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                return
+            except sqlite3.OperationalError as e:
+                if not is_busy(e) or attempt == self._busy_retries:
+                    stat_inc("db_busy_failures_total")
+                    raise
+                stat_inc("db_busy_retries_total")
+                time.sleep(min(0.05 * 2**attempt, 1.0) * random.uniform(0.5, 1.0))
+
+    def _commit(self, conn: sqlite3.Connection, batch):
+        started = time.perf_counter()
+        phases = [started]
+        for op in batch:
+            observe("db_write_queue_wait_seconds", started - op.queued_at)
+        stat_inc("db_write_batches_total")
+        stat_inc("db_write_ops_total", len(batch))
+        try:
+            self._begin(conn)
+            locked = time.perf_counter()
+            phases.append(locked)
+            observe("db_lock_wait_seconds", locked - started)
+            for op in batch:
+                conn.execute("SAVEPOINT op")
+                try:
+                    op.result = op.fn(conn)
+                except Exception as e:
+                    op.error = e
+                    if not conn.in_transaction:
+                        raise
+                    conn.execute("ROLLBACK TO op")
+                conn.execute("RELEASE op")
+            executed = time.perf_counter()
+            phases.append(executed)
+            observe("db_write_seconds", executed - locked)
+            conn.execute("COMMIT")
+            phases.append(time.perf_counter())
+            observe("db_commit_seconds", phases[-1] - executed)
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            for op in batch:
+                if op.error is None:
+                    op.error = e
+        finally:
+            phases = tuple(phases)
+            for op in batch:
+                op.phases = phases
+                op.batch_size = len(batch)
+                op.done.set()
+
+
+def _migrate_1(conn: sqlite3.Connection):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS codes (
+            code TEXT PRIMARY KEY,
+            user_id TEXT,
+            expires_at INTEGER,
+            used INTEGER DEFAULT 0
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_codes_user_id ON codes(user_id)")
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(codes)").fetchall()}
+    if "redeemed_device_id" not in columns:
+        conn.execute("ALTER TABLE codes ADD COLUMN redeemed_device_id TEXT")
+    if "session_token" not in columns:
+        conn.execute("ALTER TABLE codes ADD COLUMN session_token TEXT")
+    if "session_expires_at" not in columns:
+        conn.execute("ALTER TABLE codes ADD COLUMN session_expires_at INTEGER")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            user_id TEXT PRIMARY KEY,
+            expires_at INTEGER
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS payments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT,
+            plan_months INTEGER,
+            method TEXT,
+            screenshot_file_id TEXT,
+            status TEXT,
+            created_at INTEGER,
+            reviewed_at INTEGER,
+            reviewer_id TEXT
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS ios_links (
+            user_id TEXT PRIMARY KEY,
+            name TEXT UNIQUE,
+            code TEXT,
+            created_at INTEGER
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sessions (
+            token TEXT PRIMARY KEY,
+            device_id TEXT,
+            expires_at INTEGER
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_steps (
+            name TEXT PRIMARY KEY,
+            done_at INTEGER
+        )
+        """
+    )
+
+
+# Schema version N is reached by running MIGRATIONS[N - 1]; PRAGMA user_version
+# records the version so a current database skips all of them at startup.
+MIGRATIONS = [_migrate_1]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+# Index builds can take minutes on big tables, so they run after startup on the
+# writer thread. Each finished step is recorded in schema_steps; an interrupted
+# one is simply re-run on the next start.
+BACKGROUND_STEPS = [
+    ("idx_codes_expires_at", "CREATE INDEX IF NOT EXISTS idx_codes_expires_at ON codes(expires_at)"),
+    ("idx_sessions_expires_at", "CREATE INDEX IF NOT EXISTS idx_sessions_expires_at ON sessions(expires_at)"),
+    ("idx_payments_status_id", "CREATE INDEX IF NOT EXISTS idx_payments_status_id ON payments(status, id)"),
+    ("idx_payments_user_id_id", "CREATE INDEX IF NOT EXISTS idx_payments_user_id_id ON payments(user_id, id)"),
+    (
+        "idx_subscriptions_expires_at",
+        "CREATE INDEX IF NOT EXISTS idx_subscriptions_expires_at ON subscriptions(expires_at, user_id)",
+    ),
+]
+
+
+def _migrate_directory_1(conn: sqlite3.Connection):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS code_shards (
+            code TEXT PRIMARY KEY,
+            shard INTEGER,
+            expires_at INTEGER
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS ios_names (
+            name TEXT PRIMARY KEY,
+            user_id TEXT
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_steps (
+            name TEXT PRIMARY KEY,
+            done_at INTEGER
+        )
+        """
+    )
+
+
+# Schema of the shard directory file used by ShardedStorage.
+DIRECTORY_MIGRATIONS = [_migrate_directory_1]
+
+CODE_COLUMNS = (
+    "code",
+    "user_id",
+    "expires_at",
+    "used",
+    "redeemed_device_id",
+    "session_token",
+    "session_expires_at",
+)
+
+
+# Cold copies of reviewed payments and redeemed codes, in a separate file that
+# is ATTACHed as "archive" to every connection of the hot database.
+def _migrate_archive_1(conn: sqlite3.Connection):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS payments (
+            id INTEGER PRIMARY KEY,
+            user_id TEXT,
+            plan_months INTEGER,
+            method TEXT,
+            screenshot_file_id TEXT,
+            status TEXT,
+            created_at INTEGER,
+            reviewed_at INTEGER,
+            reviewer_id TEXT
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_payments_user_id_id ON payments(user_id, id)")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS codes (
+            code TEXT PRIMARY KEY,
+            user_id TEXT,
+            expires_at INTEGER,
+            used INTEGER,
+            redeemed_device_id TEXT,
+            session_token TEXT,
+            session_expires_at INTEGER
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_steps (
+            name TEXT PRIMARY KEY,
+            done_at INTEGER
+        )
+        """
+    )
+
+
+ARCHIVE_MIGRATIONS = [_migrate_archive_1]
+
+
+def archive_path(path: str) -> str:
+    root, ext = os.path.splitext(path)
+    return f"{root}.archive{ext}"
+
+
+def ensure_incremental_vacuum(conn: sqlite3.Connection, rewrite: bool = False) -> bool:
+    # auto_vacuum takes effect for free on a file without tables; an existing
+    # file only switches through a full VACUUM, which blocks writes for the
+    # whole rewrite, so that only happens when explicitly asked for.
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return False
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    if conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0]:
+        if not rewrite:
+            return False
+        conn.execute("VACUUM")
+    return True
+
+
+def migrate(
+    conn: sqlite3.Connection,
+    journal_mode: str = "WAL",
+    migrations: list = MIGRATIONS,
+    background_steps: list = BACKGROUND_STEPS,
+) -> List[str]:
+    started = time.perf_counter()
+    # journal_mode is persistent in the db file, so it only needs setting once
+    conn.execute(f"PRAGMA journal_mode={journal_mode}")
+    conn.isolation_level = None
+    applied = []
+    latest = len(migrations)
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version < latest:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # re-read under the write lock in case another process migrated first
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for target in range(version + 1, latest + 1):
+                migrations[target - 1](conn)
+                applied.append(target)
+            conn.execute(f"PRAGMA user_version={max(version, latest)}")
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    done = {row[0] for row in conn.execute("SELECT name FROM schema_steps").fetchall()}
+    pending = [name for name, _ in background_steps if name not in done]
+    stat_set("schema_version", max(version, latest))
+    stat_set("schema_migrations_applied", len(applied))
+    stat_set("schema_migrate_ms", round((time.perf_counter() - started) * 1000, 2))
+    stat_set("schema_steps_pending", len(pending))
+    return pending
+
+
+# Runs BACKGROUND_STEPS one per write op. Each step goes through the single
+# DbWriter like any request write, so while CREATE INDEX scans a large table
+# every /issue, /verify and /payment write waits behind it; on a big database
+# start the server with steps_in_background=False (SCHEMA_STEPS_BACKGROUND)
+# and build them in a quiet window with run_steps() (migrate.py).
+class StepRunner:
+    def __init__(self, submit, background_steps: list = BACKGROUND_STEPS):
+        self._submit = submit
+        self._steps = dict(background_steps)
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, pending: List[str]):
+        if not pending or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, args=(pending,), name="schema-steps", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+
+    def run(self, pending: List[str]):
+        steps = self._steps
+        for done, name in enumerate(pending, start=1):
+            if self._stop.is_set():
+                return
+            started = time.perf_counter()
+
+            def tx(conn, name=name):
+                conn.execute(steps[name])
+                conn.execute(
+                    "INSERT OR REPLACE INTO schema_steps(name, done_at) VALUES(?, ?)",
+                    (name, int(time.time())),
+                )
+
+            try:
+                self._submit(tx)
+            except Exception:
+                stat_inc("schema_step_errors_total")
+                return
+            stat_set(f"schema_step_{name}_ms", round((time.perf_counter() - started) * 1000, 2))
+            stat_set("schema_steps_pending", len(pending) - done)
+
+
+def insert_unique_code(conn: sqlite3.Connection, attempts: int, sql: str, params: Callable[[str], tuple]) -> str:
+    # The primary key is the uniqueness check: a collision costs one failed
+    # index probe and a fresh candidate, so latency does not depend on table size.
+    for attempt in range(max(1, attempts)):
+        code = gen_code()
+        try:
+            conn.execute(sql, params(code))
+        except sqlite3.IntegrityError:
+            stat_inc("code_alloc_collisions_total")
+            continue
+        if attempt:
+            stat_inc("code_alloc_retried_total")
+        return code
+    stat_inc("code_alloc_failed_total")
+    raise HTTPException(status_code=503, detail="code_alloc_failed")
+
+
+# Transaction-level SQL. Every function takes the connection it runs on, so the
+# same code serves single writes, batches and /admin/bulk.
+class SqliteOps:
+    def __init__(self, conn: sqlite3.Connection, month_seconds: int, code_alloc_attempts: int, archive: bool = False):
+        self.conn = conn
+        self.month_seconds = month_seconds
+        self.code_alloc_attempts = code_alloc_attempts
+        self.archive = archive
+
+    def allocate_code(self, user_id: str, expires_at: int) -> str:
+        return insert_unique_code(
+            self.conn,
+            self.code_alloc_attempts,
+            "INSERT INTO codes(code, user_id, expires_at, used) VALUES(?, ?, ?, 0)",
+            lambda code: (code, user_id, expires_at),
+        )
+
+    def redeem_code(self, code_input: str, device_id: str, now: int, new_session: SessionFactory) -> dict:
+        conn = self.conn
+        row = conn.execute(
+            f"SELECT {', '.join(CODE_COLUMNS)} FROM main.codes WHERE code=?",
+            (code_input,),
+        ).fetchone()
+        if not row and self.archive:
+            # archived codes are long expired; this keeps code_expired/code_used
+            # answers instead of turning them into invalid_code
+            row = conn.execute(
+                f"SELECT {', '.join(CODE_COLUMNS)} FROM archive.codes WHERE code=?",
+                (code_input,),
+            ).fetchone()
+        if not row:
+            raise HTTPException(status_code=400, detail="invalid_code")
+        code, user_id, expires_at, used, redeemed_device_id, session_token, session_expires_at = row
+        if expires_at < now:
+            raise HTTPException(status_code=400, detail="code_expired")
+        redeemed_device_id = (redeemed_device_id or "").strip()
+        session_token = (session_token or "").strip()
+        session_expires_at = int(session_expires_at or 0)
+
+        if used:
+            if (
+                redeemed_device_id == device_id
+                and session_token
+                and session_expires_at >= now
+            ):
+                return {
+                    "ok": True,
+                    "session_token": session_token,
+                    "expires_at": session_expires_at,
+                    "reused": True,
+                }
+            raise HTTPException(status_code=400, detail="code_used")
+
+        token, session_expires, persist = new_session(device_id)
+        if persist:
+            conn.execute(
+                "INSERT INTO sessions(token, device_id, expires_at) VALUES(?, ?, ?)",
+                (token, device_id, session_expires),
+            )
+        updated = conn.execute(
+            "UPDATE codes "
+            "SET used=1, redeemed_device_id=?, session_token=?, session_expires_at=? "
+            "WHERE code=? AND used=0",
+            (device_id, token, session_expires, code),
+        )
+        if updated.rowcount != 1:
+            row = conn.execute(
+                "SELECT redeemed_device_id, session_token, session_expires_at, used "
+                "FROM codes WHERE code=?",
+                (code,),
+            ).fetchone()
+            if row:
+                existing_device_id, existing_token, existing_session_expires_at, existing_used = row
+                if (
+                    int(existing_used or 0) == 1
+                    and (existing_device_id or "").strip() == device_id
+                    and (existing_token or "").strip()
+                    and int(existing_session_expires_at or 0) >= now
+                ):
+                    return {
+                        "ok": True,
+                        "session_token": existing_token,
+                        "expires_at": int(existing_session_expires_at),
+                        "reused": True,
+                    }
+            raise HTTPException(status_code=400, detail="code_used")
+        return {"ok": True, "session_token": token, "expires_at": session_expires}
+
+    def purge_expired(self, table: str, cutoff: int, limit: int) -> List[str]:
+        # Redeemed codes are kept as redemption history; only codes that were
+        # never used are garbage once expired.
+        key, where = ("code", "used=0") if table == "codes" else ("token", "1=1")
+        keys = [
+            row[0]
+            for row in self.conn.execute(
+                f"SELECT {key} FROM {table} WHERE {where} AND expires_at < ? LIMIT ?",
+                (cutoff, limit),
+            ).fetchall()
+        ]
+        self.conn.executemany(f"DELETE FROM {table} WHERE {key}=?", [(k,) for k in keys])
+        return keys
+
+    # Archiving is two writer operations. SQLite commits ATTACHed WAL files one
+    # by one, main first, so copying and deleting in one transaction could
+    # keep the delete and lose the copy after a crash. archive_copy commits
+    # the copies first; archive_drop then deletes only rows present in
+    # archive.*. A crash in between leaves a row in both files, and the next
+    # run's INSERT OR REPLACE copies it again.
+    def archive_copy(self, cutoff: int, limit: int) -> Tuple[List[int], List[str]]:
+        ids = [
+            row[0]
+            for row in self.conn.execute(
+                "SELECT id FROM payments WHERE status IN ('approved', 'rejected') AND reviewed_at < ? "
+                "ORDER BY id LIMIT ?",
+                (cutoff, limit),
+            ).fetchall()
+        ]
+        self.conn.executemany(
+            f"INSERT OR REPLACE INTO archive.payments({', '.join(PAYMENT_COLUMNS)}) "
+            f"SELECT {', '.join(PAYMENT_COLUMNS)} FROM main.payments WHERE id=?",
+            [(i,) for i in ids],
+        )
+        codes = [
+            row[0]
+            for row in self.conn.execute(
+                "SELECT code FROM codes WHERE used=1 AND expires_at < ? LIMIT ?",
+                (cutoff, limit),
+            ).fetchall()
+        ]
+        self.conn.executemany(
+            f"INSERT OR REPLACE INTO archive.codes({', '.join(CODE_COLUMNS)}) "
+            f"SELECT {', '.join(CODE_COLUMNS)} FROM main.codes WHERE code=?",
+            [(c,) for c in codes],
+        )
+        return ids, codes
+
+    def archive_drop(self, ids: List[int], codes: List[str]) -> Tuple[List[int], List[str]]:
+        ids = [
+            i for i in ids if self.conn.execute("SELECT 1 FROM archive.payments WHERE id=?", (i,)).fetchone()
+        ]
+        codes = [
+            c for c in codes if self.conn.execute("SELECT 1 FROM archive.codes WHERE code=?", (c,)).fetchone()
+        ]
+        self.conn.executemany("DELETE FROM main.payments WHERE id=?", [(i,) for i in ids])
+        self.conn.executemany("DELETE FROM main.codes WHERE code=?", [(c,) for c in codes])
+        return ids, codes
+
+    def insert_codes(self, codes: List[Tuple[str, str]], expires_at: int):
+        self.conn.executemany(
+            "INSERT INTO codes(code, user_id, expires_at, used) VALUES(?, ?, ?, 0)",
+            [(code, user_id, expires_at) for code, user_id in codes],
+        )
+
+    def create_payment(self, user_id: str, plan_months: int, method: str, now: int) -> int:
+        cur = self.conn.execute(
+            "INSERT INTO payments(user_id, plan_months, method, status, created_at)"
+            " VALUES(?, ?, ?, 'pending', ?)",
+            (user_id, plan_months, method, now),
+        )
+        return cur.lastrowid
+
+    def pending_payment(self, payment_id: int) -> tuple:
+        # (user_id, plan_months) of a pending payment
+        row = self.conn.execute(
+            "SELECT user_id, plan_months, status FROM main.payments WHERE id=?",
+            (payment_id,),
+        ).fetchone()
+        if not row:
+            # only reviewed payments are archived, so one found there has
+            # been reviewed already, as /payment/get would show
+            archived = self.archive and self.conn.execute(
+                "SELECT 1 FROM archive.payments WHERE id=?", (payment_id,)
+            ).fetchone()
+            if archived:
+                raise HTTPException(status_code=400, detail="payment_not_pending")
+            raise HTTPException(status_code=404, detail="payment_not_found")
+        if row[2] != "pending":
+            raise HTTPException(status_code=400, detail="payment_not_pending")
+        return row[:2]
+
+    def attach_screenshot(self, payment_id: int, screenshot_file_id: str):
+        self.pending_payment(payment_id)
+        self.conn.execute(
+            "UPDATE payments SET screenshot_file_id=? WHERE id=?",
+            (screenshot_file_id, payment_id),
+        )
+
+    def get_active_subscription(self, user_id: str, now: int) -> Optional[int]:
+        row = self.conn.execute(
+            "SELECT expires_at FROM subscriptions WHERE user_id=?",
+            (user_id,),
+        ).fetchone()
+        if not row:
+            return None
+        (expires_at,) = row
+        if expires_at < now:
+            return None
+        return expires_at
+
+    def extend_subscription(self, user_id: str, months: int, now: int) -> int:
+        row = self.conn.execute(
+            "SELECT expires_at FROM subscriptions WHERE user_id=?",
+            (user_id,),
+        ).fetchone()
+        base = now
+        if row:
+            (current_expires,) = row
+            if current_expires > now:
+                base = current_expires
+        new_expires = base + (months * self.month_seconds)
+        self.conn.execute(
+            "INSERT INTO subscriptions(user_id, expires_at) VALUES(?, ?)"
+            " ON CONFLICT(user_id) DO UPDATE SET expires_at=excluded.expires_at",
+            (user_id, new_expires),
+        )
+        return new_expires
+
+    def review_payment(self, payment_id: int, reviewer_id: Optional[str], approve: bool, now: int) -> dict:
+        user_id, plan_months = self.pending_payment(payment_id)
+        self.conn.execute(
+            "UPDATE payments SET status=?, reviewed_at=?, reviewer_id=? WHERE id=?",
+            ("approved" if approve else "rejected", now, reviewer_id or "", payment_id),
+        )
+        if not approve:
+            return {"ok": True, "user_id": user_id}
+        new_expires = self.extend_subscription(user_id, int(plan_months), now)
+        return {"ok": True, "user_id": user_id, "expires_at": new_expires}
+
+    def remove_subscription(self, user_id: str) -> dict:
+        row = self.conn.execute(
+            "SELECT expires_at FROM subscriptions WHERE user_id=?",
+            (user_id,),
+        ).fetchone()
+        if not row:
+            return {"ok": True, "removed": False}
+        old_expires = int(row[0] or 0)
+        self.conn.execute(
+            "DELETE FROM subscriptions WHERE user_id=?",
+            (user_id,),
+        )
+        return {"ok": True, "removed": True, "old_expires_at": old_expires}
+
+    def set_subscription_days(self, user_id: str, days: int, now: int) -> dict:
+        if days == 0:
+            self.conn.execute(
+                "DELETE FROM subscriptions WHERE user_id=?",
+                (user_id,),
+            )
+            return {"ok": True, "user_id": user_id, "removed": True, "expires_at": None}
+
+        new_expires = now + days * 24 * 60 * 60
+        self.conn.execute(
+            "INSERT INTO subscriptions(user_id, expires_at) VALUES(?, ?)"
+            " ON CONFLICT(user_id) DO UPDATE SET expires_at=excluded.expires_at",
+            (user_id, new_expires),
+        )
+        return {"ok": True, "user_id": user_id, "removed": False, "expires_at": new_expires}
+
+    def bulk(self, ops: list, now: int) -> List[dict]:
+        results = []
+        for item in ops:
+            # a failed item is rolled back on its own; the rest still commit
+            self.conn.execute("SAVEPOINT bulk_item")
+            try:
+                results.append(run_bulk_op(self, item, now))
+            except HTTPException as e:
+                self.conn.execute("ROLLBACK TO bulk_item")
+                results.append({"ok": False, "detail": e.detail})
+            self.conn.execute("RELEASE bulk_item")
+        return results
+
+    def create_ios_link(self, user_id: str, name: str, code: str, now: int):
+        try:
+            self.conn.execute(
+                "INSERT INTO ios_links(user_id, name, code, created_at) VALUES(?, ?, ?, ?)",
+                (user_id, name, code, now),
+            )
+        except sqlite3.IntegrityError:
+            raise HTTPException(status_code=409, detail="name_taken")
+
+
+class SqliteStorage(Storage):
+    def __init__(
+        self,
+        path: str,
+        pool_size: int = 16,
+        journal_mode: str = "WAL",
+        synchronous: str = "NORMAL",
+        busy_timeout_ms: int = 5000,
+        mmap_size: int = 64 * 1024 * 1024,
+        cache_size_kb: int = 16 * 1024,
+        write_batch_size: int = 32,
+        busy_retries: int = 5,
+        month_seconds: int = 30 * 24 * 60 * 60,
+        code_alloc_attempts: int = 8,
+        migrations: list = MIGRATIONS,
+        background_steps: list = BACKGROUND_STEPS,
+        archive: bool = True,
+        steps_in_background: bool = True,
+        vacuum_step_pages: int = 1000,
+        slow_query_ms: float = 100.0,
+    ):
+        self.path = path
+        self.slow_query_ms = slow_query_ms
+        self.archive_path = archive_path(path) if archive else None
+        self.vacuum_step_pages = vacuum_step_pages
+        self.migrations = migrations
+        self.background_steps = background_steps
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.busy_timeout_ms = busy_timeout_ms
+        self.mmap_size = mmap_size
+        self.cache_size_kb = cache_size_kb
+        self.month_seconds = month_seconds
+        self.code_alloc_attempts = code_alloc_attempts
+        self.pool = ConnectionPool(lambda: self.connect(query_only=True), pool_size)
+        self.writer = DbWriter(self.connect, write_batch_size, busy_retries)
+        self.steps = StepRunner(self.writer.submit, background_steps)
+        self.steps_in_background = steps_in_background
+        self.pending_steps: List[str] = []
+
+    def connect(self, query_only: bool = False) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path, timeout=self.busy_timeout_ms / 1000, check_same_thread=False, factory=TimedConnection
+        )
+        conn.slow_query_ms = self.slow_query_ms
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        conn.execute(f"PRAGMA busy_timeout={self.busy_timeout_ms}")
+        conn.execute(f"PRAGMA mmap_size={self.mmap_size}")
+        # negative cache_size is in KiB rather than pages
+        conn.execute(f"PRAGMA cache_size={-self.cache_size_kb}")
+        if self.archive_path:
+            conn.execute("ATTACH DATABASE ? AS archive", (self.archive_path,))
+        if query_only:
+            conn.execute("PRAGMA query_only=1")
+        return conn
+
+    def init(self):
+        if self.archive_path:
+            conn = sqlite3.connect(self.archive_path, timeout=self.busy_timeout_ms / 1000)
+            try:
+                migrate(conn, self.journal_mode, ARCHIVE_MIGRATIONS, [])
+            finally:
+                conn.close()
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000)
+        try:
+            ensure_incremental_vacuum(conn)
+            self.pending_steps = migrate(conn, self.journal_mode, self.migrations, self.background_steps)
+        finally:
+            conn.close()
+
+    def start(self):
+        self.writer.start()
+        if self.steps_in_background:
+            self.steps.start(self.pending_steps)
+
+    def close(self):
+        self.steps.stop()
+        self.writer.stop()
+        self.pool.close()
+
+    def run_steps(self) -> List[str]:
+        if self.steps_in_background:
+            self.steps.wait()
+        else:
+            self.steps.run(self.pending_steps)
+        return list(self.pending_steps)
+
+    def write(self, fn):
+        return self.writer.submit(
+            lambda conn: fn(SqliteOps(conn, self.month_seconds, self.code_alloc_attempts, bool(self.archive_path)))
+        )
+
+    def issue_codes(self, user_ids: List[str], expires_at: int) -> List[str]:
+        return self.write(lambda ops: [ops.allocate_code(u, expires_at) for u in user_ids])
+
+    def redeem_code(self, code: str, device_id: str, now: int, new_session: SessionFactory) -> dict:
+        return self.write(lambda ops: ops.redeem_code(code, device_id, now, new_session))
+
+    def get_session(self, token: str) -> Optional[int]:
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                "SELECT token, expires_at FROM sessions WHERE token=?",
+                (token,),
+            ).fetchone()
+        return None if row is None else row[1]
+
+    def purge_expired(self, table: str, cutoff: int, limit: int) -> int:
+        return len(self.write(lambda ops: ops.purge_expired(table, cutoff, limit)))
+
+    def create_payment(self, user_id: str, plan_months: int, method: str, now: int) -> int:
+        return self.write(lambda ops: ops.create_payment(user_id, plan_months, method, now))
+
+    def attach_screenshot(self, payment_id: int, screenshot_file_id: str):
+        return self.write(lambda ops: ops.attach_screenshot(payment_id, screenshot_file_id))
+
+    def review_payment(self, payment_id: int, reviewer_id: Optional[str], approve: bool, now: int) -> dict:
+        return self.write(lambda ops: ops.review_payment(payment_id, reviewer_id, approve, now))
+
+    def get_payment(self, payment_id: int) -> Optional[dict]:
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                f"SELECT {', '.join(PAYMENT_COLUMNS)} FROM main.payments WHERE id=?",
+                (payment_id,),
+            ).fetchone()
+            if row is None and self.archive_path:
+                row = conn.execute(
+                    f"SELECT {', '.join(PAYMENT_COLUMNS)} FROM archive.payments WHERE id=?",
+                    (payment_id,),
+                ).fetchone()
+        return None if row is None else dict(zip(PAYMENT_COLUMNS, row))
+
+    def list_payments(self, status: Optional[str], after_id: Optional[int], limit: int) -> List[dict]:
+        # keyset cursor: ids are strictly decreasing, so "after" means "below"
+        after_id = after_id if after_id is not None else MAX_ID
+        with self.pool.connection() as conn:
+            if status:
+                rows = conn.execute(
+                    f"SELECT {', '.join(PAYMENT_LIST_COLUMNS)} "
+                    "FROM payments WHERE status=? AND id < ? ORDER BY id DESC LIMIT ?",
+                    (status, after_id, limit),
+                ).fetchall()
+            else:
+                rows = conn.execute(
+                    f"SELECT {', '.join(PAYMENT_LIST_COLUMNS)} "
+                    "FROM payments WHERE id < ? ORDER BY id DESC LIMIT ?",
+                    (after_id, limit),
+                ).fetchall()
+        return [dict(zip(PAYMENT_LIST_COLUMNS, r)) for r in rows]
+
+    def payments_by_user(self, user_id: str, after_id: Optional[int], limit: int) -> List[dict]:
+        after_id = after_id if after_id is not None else MAX_ID
+        schemas = ("main", "archive") if self.archive_path else ("main",)
+        rows: dict = {}
+        with self.pool.connection() as conn:
+            for schema in schemas:
+                for r in conn.execute(
+                    f"SELECT {', '.join(PAYMENT_LIST_COLUMNS)} "
+                    f"FROM {schema}.payments WHERE user_id=? AND id < ? ORDER BY id DESC LIMIT ?",
+                    (user_id, after_id, limit),
+                ).fetchall():
+                    rows.setdefault(r[0], r)
+        return [dict(zip(PAYMENT_LIST_COLUMNS, rows[i])) for i in sorted(rows, reverse=True)[:limit]]
+
+    def list_expiring(
+        self, until: int, limit: int, after_expires_at: Optional[int], after_user_id: Optional[str]
+    ) -> List[Tuple[str, int]]:
+        with self.pool.connection() as conn:
+            if after_expires_at is None:
+                rows = conn.execute(
+                    "SELECT user_id, expires_at FROM subscriptions WHERE expires_at <= ? "
+                    "ORDER BY expires_at, user_id LIMIT ?",
+                    (until, limit),
+                ).fetchall()
+            elif after_user_id is None:
+                rows = conn.execute(
+                    "SELECT user_id, expires_at FROM subscriptions WHERE expires_at > ? AND expires_at <= ? "
+                    "ORDER BY expires_at, user_id LIMIT ?",
+                    (after_expires_at, until, limit),
+                ).fetchall()
+            else:
+                rows = conn.execute(
+                    "SELECT user_id, expires_at FROM subscriptions "
+                    "WHERE (expires_at, user_id) > (?, ?) AND expires_at <= ? "
+                    "ORDER BY expires_at, user_id LIMIT ?",
+                    (after_expires_at, after_user_id, until, limit),
+                ).fetchall()
+        return [(r[0], r[1]) for r in rows]
+
+    def remove_subscription(self, user_id: str) -> dict:
+        return self.write(lambda ops: ops.remove_subscription(user_id))
+
+    def set_subscription_days(self, user_id: str, days: int, now: int) -> dict:
+        return self.write(lambda ops: ops.set_subscription_days(user_id, days, now))
+
+    def bulk(self, ops: list, now: int) -> List[dict]:
+        return self.write(lambda tx: tx.bulk(ops, now))
+
+    def get_ios_link(self, user_id: str) -> Optional[dict]:
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                "SELECT name, code, created_at FROM ios_links WHERE user_id=?",
+                (user_id,),
+            ).fetchone()
+        if not row:
+            return None
+        return {"name": row[0], "code": row[1], "created_at": row[2]}
+
+    def create_ios_link(self, user_id: str, name: str, code: str, now: int):
+        return self.write(lambda ops: ops.create_ios_link(user_id, name, code, now))
+
+    def ios_name_taken(self, name: str) -> bool:
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                "SELECT 1 FROM ios_links WHERE name=?",
+                (name,),
+            ).fetchone()
+        return row is not None
+
+    def archive_batch(self, cutoff: int, limit: int) -> Tuple[List[int], List[str]]:
+        ids, codes = self.write(lambda ops: ops.archive_copy(cutoff, limit))
+        return self.write(lambda ops: ops.archive_drop(ids, codes))
+
+    def archive(self, cutoff: int, limit: int) -> Tuple[int, int]:
+        ids, codes = self.archive_batch(cutoff, limit)
+        return len(ids), len(codes)
+
+    def has_archived_code(self, code: str) -> bool:
+        if not self.archive_path:
+            return False
+        with self.pool.connection() as conn:
+            return conn.execute("SELECT 1 FROM archive.codes WHERE code=?", (code,)).fetchone() is not None
+
+    def convert_incremental_vacuum(self) -> bool:
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000, isolation_level=None)
+        try:
+            return ensure_incremental_vacuum(conn, rewrite=True)
+        finally:
+            conn.close()
+
+    def incremental_vacuum(self) -> int:
+        # executescript steps the pragma to completion but commits any open
+        # transaction, so this runs on its own connection rather than the
+        # writer; small steps keep each write-lock hold short.
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000, isolation_level=None)
+        try:
+            before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            remaining = before
+            while remaining:
+                conn.executescript(f"PRAGMA incremental_vacuum({max(1, self.vacuum_step_pages)})")
+                left = conn.execute("PRAGMA freelist_count").fetchone()[0]
+                if left >= remaining:
+                    break
+                remaining = left
+            return before - remaining
+        finally:
+            conn.close()
+
+    def introspect(self) -> dict:
+        with self.pool.connection() as conn:
+            info = {"main": db_info(conn, "main", self.path)}
+            if self.archive_path:
+                info["archive"] = db_info(conn, "archive", self.archive_path)
+        return info
+
+
+def shard_paths(path: str, shards: int) -> Tuple[List[str], str]:
+    root, ext = os.path.splitext(path)
+    return [f"{root}.shard{i}{ext}" for i in range(shards)], f"{root}.dir{ext}"
+
+
+# Splits user-owned rows across N SQLite files by crc32(user_id), so every shard
+# has its own writer thread and write lock. Codes and iOS names must stay
+# globally unique, so a small directory file maps code -> shard and owns the
+# name index. Payment ids encode their shard as local_id * N + shard, and
+# table-mode session tokens carry an "s<shard>:" prefix.
+# Operations that touch several shards (/issue/batch, /admin/bulk, list
+# endpoints) are atomic per shard only, and global payment ids order by shard
+# counter rather than creation time.
+class ShardedStorage(Storage):
+    def __init__(self, path: str, shards: int, **options):
+        shard_files, directory_file = shard_paths(path, shards)
+        self.count = shards
+        self.shards = [SqliteStorage(shard_file, **options) for shard_file in shard_files]
+        self.directory = SqliteStorage(
+            directory_file, migrations=DIRECTORY_MIGRATIONS, background_steps=[], archive=False, **options
+        )
+        self.code_alloc_attempts = options.get("code_alloc_attempts", 8)
+
+    def user_shard(self, user_id: str) -> int:
+        return zlib.crc32(user_id.encode()) % self.count
+
+    def token_shard(self, token: str) -> int:
+        prefix, sep, _ = token.partition(":")
+        if sep and prefix[:1] == "s" and prefix[1:].isdigit():
+            return int(prefix[1:]) % self.count
+        return zlib.crc32(token[:8].encode()) % self.count
+
+    def split_id(self, payment_id: int) -> Tuple[SqliteStorage, int]:
+        return self.shards[payment_id % self.count], payment_id // self.count
+
+    def local_after(self, shard: int, after_id: Optional[int]) -> Optional[int]:
+        # smallest local id whose global id is >= after_id
+        if after_id is None:
+            return None
+        return (after_id - shard - 1) // self.count + 1
+
+    def global_items(self, shard: int, items: List[dict]) -> List[dict]:
+        for item in items:
+            item["id"] = item["id"] * self.count + shard
+        return items
+
+    def init(self):
+        self.directory.init()
+        for shard in self.shards:
+            shard.init()
+
+    def start(self):
+        self.directory.start()
+        for shard in self.shards:
+            shard.start()
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+        self.directory.close()
+
+    def run_steps(self) -> List[str]:
+        names = self.directory.run_steps()
+        for shard in self.shards:
+            names += shard.run_steps()
+        return names
+
+    def issue_codes(self, user_ids: List[str], expires_at: int) -> List[str]:
+        def claim(conn):
+            return [
+                insert_unique_code(
+                    conn,
+                    self.code_alloc_attempts,
+                    "INSERT INTO code_shards(code, shard, expires_at) VALUES(?, ?, ?)",
+                    lambda code, user_id=user_id: (code, self.user_shard(user_id), expires_at),
+                )
+                for user_id in user_ids
+            ]
+
+        codes = self.directory.writer.submit(claim)
+        by_shard: dict = {}
+        for code, user_id in zip(codes, user_ids):
+            by_shard.setdefault(self.user_shard(user_id), []).append((code, user_id))
+        inserted = []
+        try:
+            for shard, pairs in by_shard.items():
+                self.shards[shard].write(lambda ops, pairs=pairs: ops.insert_codes(pairs, expires_at))
+                inserted.append(pairs)
+        except Exception:
+            # each shard commits on its own, so undo the ones that landed to
+            # keep the batch all-or-nothing for the caller
+            for shard, pairs in zip(by_shard, inserted):
+                keys = [(code,) for code, _ in pairs]
+                self.shards[shard].writer.submit(
+                    lambda conn, keys=keys: conn.executemany("DELETE FROM codes WHERE code=? AND used=0", keys)
+                )
+            self.forget_codes(codes)
+            raise
+        return codes
+
+    def forget_codes(self, codes: List[str]):
+        if codes:
+            self.directory.writer.submit(
+                lambda conn: conn.executemany("DELETE FROM code_shards WHERE code=?", [(c,) for c in codes])
+            )
+
+    def redeem_code(self, code: str, device_id: str, now: int, new_session: SessionFactory) -> dict:
+        with self.directory.pool.connection() as conn:
+            row = conn.execute("SELECT shard FROM code_shards WHERE code=?", (code,)).fetchone()
+        if row is not None:
+            shard = row[0]
+        else:
+            # archived codes leave the directory; probing each shard's archive
+            # only costs lookups for codes that are unknown anyway
+            shard = next((i for i, s in enumerate(self.shards) if s.has_archived_code(code)), None)
+            if shard is None:
+                raise HTTPException(status_code=400, detail="invalid_code")
+
+        def shard_session(device_id: str):
+            token, expires_at, persist = new_session(device_id)
+            return (f"s{shard}:{token}" if persist else token), expires_at, persist
+
+        return self.shards[shard].redeem_code(code, device_id, now, shard_session)
+
+    def get_session(self, token: str) -> Optional[int]:
+        return self.shards[self.token_shard(token)].get_session(token)
+
+    def purge_expired(self, table: str, cutoff: int, limit: int) -> int:
+        total = 0
+        for shard in self.shards:
+            keys = shard.write(lambda ops: ops.purge_expired(table, cutoff, limit))
+            if table == "codes":
+                self.forget_codes(keys)
+            total += len(keys)
+        return total
+
+    def create_payment(self, user_id: str, plan_months: int, method: str, now: int) -> int:
+        shard = self.user_shard(user_id)
+        return self.shards[shard].create_payment(user_id, plan_months, method, now) * self.count + shard
+
+    def attach_screenshot(self, payment_id: int, screenshot_file_id: str):
+        store, local_id = self.split_id(payment_id)
+        store.attach_screenshot(local_id, screenshot_file_id)
+
+    def review_payment(self, payment_id: int, reviewer_id: Optional[str], approve: bool, now: int) -> dict:
+        store, local_id = self.split_id(payment_id)
+        return store.review_payment(local_id, reviewer_id, approve, now)
+
+    def get_payment(self, payment_id: int) -> Optional[dict]:
+        store, local_id = self.split_id(payment_id)
+        payment = store.get_payment(local_id)
+        if payment is not None:
+            payment["id"] = payment_id
+        return payment
+
+    def list_payments(self, status: Optional[str], after_id: Optional[int], limit: int) -> List[dict]:
+        items = []
+        for i, shard in enumerate(self.shards):
+            items.extend(self.global_items(i, shard.list_payments(status, self.local_after(i, after_id), limit)))
+        items.sort(key=lambda item: item["id"], reverse=True)
+        return items[:limit]
+
+    def payments_by_user(self, user_id: str, after_id: Optional[int], limit: int) -> List[dict]:
+        i = self.user_shard(user_id)
+        return self.global_items(i, self.shards[i].payments_by_user(user_id, self.local_after(i, after_id), limit))
+
+    def list_expiring(
+        self, until: int, limit: int, after_expires_at: Optional[int], after_user_id: Optional[str]
+    ) -> List[Tuple[str, int]]:
+        rows = []
+        for shard in self.shards:
+            rows.extend(shard.list_expiring(until, limit, after_expires_at, after_user_id))
+        rows.sort(key=lambda r: (r[1], r[0]))
+        return rows[:limit]
+
+    def remove_subscription(self, user_id: str) -> dict:
+        return self.shards[self.user_shard(user_id)].remove_subscription(user_id)
+
+    def set_subscription_days(self, user_id: str, days: int, now: int) -> dict:
+        return self.shards[self.user_shard(user_id)].set_subscription_days(user_id, days, now)
+
+    def bulk(self, ops: list, now: int) -> List[dict]:
+        groups: dict = {}
+        for index, item in enumerate(ops):
+            shard, routed = 0, item
+            if item.op in ("approve", "reject") and item.payment_id is not None:
+                shard = item.payment_id % self.count
+                routed = SimpleNamespace(
+                    op=item.op,
+                    user_id=item.user_id,
+                    days=item.days,
+                    payment_id=item.payment_id // self.count,
+                    reviewer_id=item.reviewer_id,
+                )
+            elif item.user_id:
+                shard = self.user_shard(item.user_id.strip())
+            groups.setdefault(shard, []).append((index, routed))
+        results: List[dict] = [{}] * len(ops)
+        for shard, group in groups.items():
+            for (index, _), result in zip(group, self.shards[shard].bulk([item for _, item in group], now)):
+                results[index] = result
+        return results
+
+    def get_ios_link(self, user_id: str) -> Optional[dict]:
+        return self.shards[self.user_shard(user_id)].get_ios_link(user_id)
+
+    def create_ios_link(self, user_id: str, name: str, code: str, now: int):
+        def claim(conn):
+            try:
+                conn.execute("INSERT INTO ios_names(name, user_id) VALUES(?, ?)", (name, user_id))
+            except sqlite3.IntegrityError:
+                raise HTTPException(status_code=409, detail="name_taken")
+
+        self.directory.writer.submit(claim)
+        try:
+            self.shards[self.user_shard(user_id)].create_ios_link(user_id, name, code, now)
+        except HTTPException:
+            self.directory.writer.submit(
+                lambda conn: conn.execute("DELETE FROM ios_names WHERE name=? AND user_id=?", (name, user_id))
+            )
+            raise
+
+    def ios_name_taken(self, name: str) -> bool:
+        with self.directory.pool.connection() as conn:
+            row = conn.execute("SELECT 1 FROM ios_names WHERE name=?", (name,)).fetchone()
+        return row is not None
+
+    def archive(self, cutoff: int, limit: int) -> Tuple[int, int]:
+        payments = codes = 0
+        for shard in self.shards:
+            ids, keys = shard.archive_batch(cutoff, limit)
+            self.forget_codes(keys)
+            payments += len(ids)
+            codes += len(keys)
+        return payments, codes
+
+    def incremental_vacuum(self) -> int:
+        return sum(store.incremental_vacuum() for store in [*self.shards, self.directory])
+
+    def convert_incremental_vacuum(self) -> bool:
+        return any([store.convert_incremental_vacuum() for store in [*self.shards, self.directory]])
+
+    def introspect(self) -> dict:
+        return {"directory": self.directory.introspect(), "shards": [shard.introspect() for shard in self.shards]}
+
+
+# Dict-backed storage with the same semantics as SqliteStorage, for benchmark
+# baselines and fast tests. One lock serializes everything; every operation
+# validates before it mutates, so a failed operation leaves no partial state.
+class MemoryStorage(Storage):
+    def __init__(self, month_seconds: int = 30 * 24 * 60 * 60, code_alloc_attempts: int = 8):
+        self.month_seconds = month_seconds
+        self.code_alloc_attempts = code_alloc_attempts
+        self.lock = threading.RLock()
+        self.codes: dict = {}
+        self.sessions: dict = {}
+        self.subscriptions: dict = {}
+        self.payments: dict = {}
+        self.payment_ids: List[int] = []
+        self.payment_ids_by_user: dict = {}
+        self.last_payment_id = 0
+        self.archived_payments: dict = {}
+        self.archived_codes: dict = {}
+        self.ios_links: dict = {}
+        self.ios_names: dict = {}
+
+    def _allocate_code(self, taken: set) -> str:
+        for attempt in range(max(1, self.code_alloc_attempts)):
+            code = gen_code()
+            if code in self.codes or code in taken:
+                stat_inc("code_alloc_collisions_total")
+                continue
+            if attempt:
+                stat_inc("code_alloc_retried_total")
+            return code
+        stat_inc("code_alloc_failed_total")
+        raise HTTPException(status_code=503, detail="code_alloc_failed")
+
+    def issue_codes(self, user_ids: List[str], expires_at: int) -> List[str]:
+        with self.lock:
+            fresh: dict = {}
+            for user_id in user_ids:
+                fresh[self._allocate_code(fresh.keys())] = user_id
+            for code, user_id in fresh.items():
+                self.codes[code] = {
+                    "user_id": user_id,
+                    "expires_at": expires_at,
+                    "used": 0,
+                    "redeemed_device_id": None,
+                    "session_token": None,
+                    "session_expires_at": None,
+                }
+            return list(fresh)
+
+    def redeem_code(self, code: str, device_id: str, now: int, new_session: SessionFactory) -> dict:
+        with self.lock:
+            row = self.codes.get(code) or self.archived_codes.get(code)
+            if row is None:
+                raise HTTPException(status_code=400, detail="invalid_code")
+            if row["expires_at"] < now:
+                raise HTTPException(status_code=400, detail="code_expired")
+            if row["used"]:
+                session_expires_at = int(row["session_expires_at"] or 0)
+                if (
+                    (row["redeemed_device_id"] or "").strip() == device_id
+                    and (row["session_token"] or "").strip()
+                    and session_expires_at >= now
+                ):
+                    return {
+                        "ok": True,
+                        "session_token": row["session_token"],
+                        "expires_at": session_expires_at,
+                        "reused": True,
+                    }
+                raise HTTPException(status_code=400, detail="code_used")
+            token, session_expires, persist = new_session(device_id)
+            if persist:
+                self.sessions[token] = (device_id, session_expires)
+            row.update(
+                used=1,
+                redeemed_device_id=device_id,
+                session_token=token,
+                session_expires_at=session_expires,
+            )
+            return {"ok": True, "session_token": token, "expires_at": session_expires}
+
+    def get_session(self, token: str) -> Optional[int]:
+        with self.lock:
+            row = self.sessions.get(token)
+        return None if row is None else row[1]
+
+    def purge_expired(self, table: str, cutoff: int, limit: int) -> int:
+        with self.lock:
+            if table == "codes":
+                rows = self.codes
+                victims = [k for k, r in rows.items() if not r["used"] and r["expires_at"] < cutoff]
+            else:
+                rows = self.sessions
+                victims = [k for k, r in rows.items() if r[1] < cutoff]
+            for key in victims[:limit]:
+                del rows[key]
+            return min(len(victims), limit)
+
+    def create_payment(self, user_id: str, plan_months: int, method: str, now: int) -> int:
+        with self.lock:
+            self.last_payment_id += 1
+            payment_id = self.last_payment_id
+            self.payments[payment_id] = {
+                "id": payment_id,
+                "user_id": user_id,
+                "plan_months": plan_months,
+                "method": method,
+                "screenshot_file_id": None,
+                "status": "pending",
+                "created_at": now,
+                "reviewed_at": None,
+                "reviewer_id": None,
+            }
+            self.payment_ids.append(payment_id)
+            self.payment_ids_by_user.setdefault(user_id, []).append(payment_id)
+            return payment_id
+
+    def _pending_payment(self, payment_id: int) -> dict:
+        row = self.payments.get(payment_id)
+        if row is None:
+            if payment_id in self.archived_payments:
+                raise HTTPException(status_code=400, detail="payment_not_pending")
+            raise HTTPException(status_code=404, detail="payment_not_found")
+        if row["status"] != "pending":
+            raise HTTPException(status_code=400, detail="payment_not_pending")
+        return row
+
+    def attach_screenshot(self, payment_id: int, screenshot_file_id: str):
+        with self.lock:
+            self._pending_payment(payment_id)["screenshot_file_id"] = screenshot_file_id
+
+    def _extend_subscription(self, user_id: str, months: int, now: int) -> int:
+        current = self.subscriptions.get(user_id)
+        base = current if current is not None and current > now else now
+        self.subscriptions[user_id] = base + months * self.month_seconds
+        return self.subscriptions[user_id]
+
+    def review_payment(self, payment_id: int, reviewer_id: Optional[str], approve: bool, now: int) -> dict:
+        with self.lock:
+            row = self._pending_payment(payment_id)
+            row.update(status="approved" if approve else "rejected", reviewed_at=now, reviewer_id=reviewer_id or "")
+            if not approve:
+                return {"ok": True, "user_id": row["user_id"]}
+            new_expires = self._extend_subscription(row["user_id"], int(row["plan_months"]), now)
+            return {"ok": True, "user_id": row["user_id"], "expires_at": new_expires}
+
+    def get_payment(self, payment_id: int) -> Optional[dict]:
+        with self.lock:
+            row = self.payments.get(payment_id) or self.archived_payments.get(payment_id)
+            return None if row is None else dict(row)
+
+    def _page(self, ids: List[int], after_id: Optional[int], limit: int, status: Optional[str] = None) -> List[dict]:
+        end = bisect.bisect_left(ids, after_id if after_id is not None else MAX_ID)
+        items = []
+        for payment_id in reversed(ids[:end]):
+            row = self.payments.get(payment_id) or self.archived_payments[payment_id]
+            if status and row["status"] != status:
+                continue
+            items.append({k: row[k] for k in PAYMENT_LIST_COLUMNS})
+            if len(items) == limit:
+                break
+        return items
+
+    def list_payments(self, status: Optional[str], after_id: Optional[int], limit: int) -> List[dict]:
+        with self.lock:
+            return self._page(self.payment_ids, after_id, limit, status)
+
+    def payments_by_user(self, user_id: str, after_id: Optional[int], limit: int) -> List[dict]:
+        with self.lock:
+            return self._page(self.payment_ids_by_user.get(user_id, []), after_id, limit)
+
+    def list_expiring(
+        self, until: int, limit: int, after_expires_at: Optional[int], after_user_id: Optional[str]
+    ) -> List[Tuple[str, int]]:
+        with self.lock:
+            items = sorted((e, u) for u, e in self.subscriptions.items() if e <= until)
+        if after_expires_at is not None:
+            if after_user_id is None:
+                items = [i for i in items if i[0] > after_expires_at]
+            else:
+                items = [i for i in items if i > (after_expires_at, after_user_id)]
+        return [(u, e) for e, u in items[:limit]]
+
+    def remove_subscription(self, user_id: str) -> dict:
+        with self.lock:
+            old_expires = self.subscriptions.pop(user_id, None)
+        if old_expires is None:
+            return {"ok": True, "removed": False}
+        return {"ok": True, "removed": True, "old_expires_at": int(old_expires or 0)}
+
+    def set_subscription_days(self, user_id: str, days: int, now: int) -> dict:
+        with self.lock:
+            if days == 0:
+                self.subscriptions.pop(user_id, None)
+                return {"ok": True, "user_id": user_id, "removed": True, "expires_at": None}
+            new_expires = now + days * 24 * 60 * 60
+            self.subscriptions[user_id] = new_expires
+        return {"ok": True, "user_id": user_id, "removed": False, "expires_at": new_expires}
+
+    def bulk(self, ops: list, now: int) -> List[dict]:
+        results = []
+        with self.lock:
+            for item in ops:
+                try:
+                    results.append(run_bulk_op(self, item, now))
+                except HTTPException as e:
+                    results.append({"ok": False, "detail": e.detail})
+        return results
+
+    def get_ios_link(self, user_id: str) -> Optional[dict]:
+        with self.lock:
+            row = self.ios_links.get(user_id)
+            return None if row is None else dict(row)
+
+    def create_ios_link(self, user_id: str, name: str, code: str, now: int):
+        with self.lock:
+            if user_id in self.ios_links or name in self.ios_names:
+                raise HTTPException(status_code=409, detail="name_taken")
+            self.ios_links[user_id] = {"name": name, "code": code, "created_at": now}
+            self.ios_names[name] = user_id
+
+    def ios_name_taken(self, name: str) -> bool:
+        with self.lock:
+            return name in self.ios_names
+
+    def archive(self, cutoff: int, limit: int) -> Tuple[int, int]:
+        with self.lock:
+            # archived ids leave the status scan list but stay in the per-user
+            # lists, so /payment/by_user keeps returning them
+            ids = [
+                payment_id
+                for payment_id in self.payment_ids
+                if self.payments[payment_id]["status"] != "pending"
+                and self.payments[payment_id]["reviewed_at"] < cutoff
+            ][:limit]
+            for payment_id in ids:
+                self.archived_payments[payment_id] = self.payments.pop(payment_id)
+            if ids:
+                moved = set(ids)
+                self.payment_ids = [i for i in self.payment_ids if i not in moved]
+            codes = [k for k, r in self.codes.items() if r["used"] and r["expires_at"] < cutoff][:limit]
+            for code in codes:
+                self.archived_codes[code] = self.codes.pop(code)
+            return len(ids), len(codes)
+
+    def incremental_vacuum(self) -> int:
+        return 0
+
+    def convert_incremental_vacuum(self) -> bool:
+        return False
+
+    def introspect(self) -> dict:
+        with self.lock:
+            tables = {
+                "codes": self.codes,
+                "sessions": self.sessions,
+                "subscriptions": self.subscriptions,
+                "payments": self.payments,
+                "ios_links": self.ios_links,
+                "archived_payments": self.archived_payments,
+                "archived_codes": self.archived_codes,
+            }
+            return {"memory": {"tables": {name: {"rows": len(rows)} for name, rows in tables.items()}}}
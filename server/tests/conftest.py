@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# main reads its config at import time
+os.environ.setdefault("BOT_SECRET", "bot-secret")
+os.environ.setdefault("APP_SECRET", "app-secret")
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(prefix="v7ck9ll-tests-"), "codes.db"))
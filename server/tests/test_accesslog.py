@@ -0,0 +1,54 @@
+import json
+
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+
+from accesslog import AccessLog, AccessLogMiddleware, Sampler, parse_sampling
+
+
+def test_sampling_share_and_cap():
+    rules = parse_sampling("/validate=0/2, /verify=1/0")
+    assert rules == {"/validate": (0.0, 2.0), "/verify": (1.0, 0.0)}
+    sampler = Sampler(rules)
+    assert sampler.allow("/validate", 200, 0.0) is None
+    # errors skip the share but not the cap
+    assert [sampler.allow("/validate", 401, 0.0) for _ in range(3)] == [1.0, 1.0, None]
+    assert sampler.allow("/validate", 401, 1.0) == 1.0
+    assert all(sampler.allow("/verify", 200, 0.0) == 1.0 for _ in range(100))
+    assert sampler.allow("/issue", 200, 0.0) == 1.0
+
+
+def test_middleware_writes_hashed_json_lines(tmp_path):
+    app = FastAPI()
+
+    @app.post("/verify")
+    def verify(body: dict):
+        raise HTTPException(status_code=400, detail="code_used")
+
+    path = tmp_path / "access.log"
+    log = AccessLog(str(path), b"salt", {})
+    log.start()
+    app.add_middleware(AccessLogMiddleware, log=log)
+    TestClient(app).post("/verify", json={"code": "V7-AAAA-BBBB", "device_id": "phone-1"})
+    log.stop()
+
+    text = path.read_text()
+    assert "phone-1" not in text and "AAAA" not in text
+    entry = json.loads(text)
+    assert entry["route"] == "/verify" and entry["status"] == 400 and entry["detail"] == "code_used"
+    assert entry["device"].startswith("#") and "user" not in entry
+    assert entry["ms"] >= entry["db_ms"] == 0
+
+
+def test_file_is_reopened_after_rotation(tmp_path):
+    path = tmp_path / "access.log"
+    log = AccessLog(str(path), b"salt", {}, flush_seconds=60)
+    log.start()
+    log.put({"route": "/a"})
+    log.flush()
+    path.rename(tmp_path / "access.log.1")
+    log.put({"route": "/b"})
+    log.flush()
+    log.stop()
+    assert json.loads((tmp_path / "access.log.1").read_text())["route"] == "/a"
+    assert json.loads(path.read_text())["route"] == "/b"
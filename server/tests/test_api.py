@@ -0,0 +1,216 @@
+import hashlib
+import hmac
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+import main
+import metrics
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_fast_path_routes_document_request_body():
+    paths = main.app.openapi()["paths"]
+    for path, field in (("/issue", "user_id"), ("/verify", "code"), ("/validate", "session_token"), ("/sub/status", "user_id")):
+        schema = paths[path]["post"]["requestBody"]["content"]["application/json"]["schema"]
+        assert field in schema["properties"]
+
+
+APP = {"X-App-Secret": main.APP_SECRET}
+BOT = {"X-Bot-Secret": main.BOT_SECRET}
+
+
+def validate(client, token):
+    return client.post("/validate", json={"session_token": token}, headers=APP)
+
+
+def test_signed_sessions_verify_and_reject(monkeypatch):
+    keys = main.parse_session_keys("k1:old-secret,k2:new-secret")
+    monkeypatch.setattr(main, "session_keys", keys)
+    monkeypatch.setattr(main, "signing_kid", "k2")
+    now = int(time.time())
+    token = main.sign_session("device-1", now + 60)
+    assert token.startswith("v1.k2.")
+    assert main.check_signed_session(token, now) == now + 60
+
+    monkeypatch.setattr(main, "signing_kid", "k1")
+    old = main.sign_session("device-1", now + 60)
+    assert main.check_signed_session(old, now) == now + 60
+
+    _, kid, payload, sig = token.split(".")
+    for bad in (f"v1.k9.{payload}.{sig}", f"v1.k2.{payload}.{sig[:-2]}AA", "v1.k2.nope"):
+        with pytest.raises(HTTPException) as e:
+            main.check_signed_session(bad, now)
+        assert e.value.detail == "invalid_session"
+    with pytest.raises(HTTPException) as e:
+        main.check_signed_session(token, now + 61)
+    assert e.value.detail == "session_expired"
+    # a key id is only as good as its own secret
+    assert main.parse_session_keys("k2:other")["k2"] != keys["k2"]
+
+
+def test_signed_tokens_rejected_without_signing_key():
+    assert not main.session_keys
+    # what a key derived from the shipped APP_SECRET used to accept
+    key = hmac.new(main.APP_SECRET.encode(), b"session-key:k1", hashlib.sha256).digest()
+    body = "v1.k1." + main._b64(b"%d.00.device" % (int(time.time()) + 600))
+    token = body + "." + main._b64(hmac.new(key, body.encode(), hashlib.sha256).digest())
+    with TestClient(main.app) as client:
+        resp = validate(client, token)
+    assert resp.status_code == 400 and resp.json()["detail"] == "invalid_session"
+
+
+def test_session_key_config_is_checked():
+    with pytest.raises(ValueError):
+        main.parse_session_keys("k1")
+    assert list(main.parse_session_keys("", "single")) == ["k1"]
+
+
+def test_signed_mode_refuses_to_start_without_key(tmp_path):
+    env = dict(os.environ, SESSION_MODE="signed", SESSION_KEYS="", SESSION_SIGNING_SECRET="")
+    env["DB_PATH"] = str(tmp_path / "c.db")
+    result = subprocess.run(
+        [sys.executable, "-c", "import main"], cwd=SERVER_DIR, env=env, capture_output=True, text=True
+    )
+    assert result.returncode != 0 and "SESSION_MODE=signed needs" in result.stderr
+
+
+class Clock:
+    # stands in for main's time module so sessions can be aged without sleeping
+    def __init__(self):
+        self.offset = 0
+
+    def time(self):
+        return time.time() + self.offset
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+def new_session(client, user_id):
+    code = client.post("/issue", json={"user_id": user_id}, headers=BOT).json()["code"]
+    resp = client.post("/verify", json={"code": code, "device_id": f"{user_id}-device"}, headers=APP)
+    assert resp.status_code == 200
+    return resp.json()["session_token"], resp.json()["expires_at"]
+
+
+def cache_counts():
+    return metrics.stats.get("session_cache_hits", 0), metrics.stats.get("session_cache_misses", 0)
+
+
+def test_session_cache_issue_verify_validate(monkeypatch):
+    cache = main.SessionCache(2, True)
+    clock = Clock()
+    monkeypatch.setattr(main, "session_cache", cache)
+    monkeypatch.setattr(main, "time", clock)
+    with TestClient(main.app) as client:
+        sessions = [new_session(client, f"cache-{i}") for i in range(3)]
+        tokens = [token for token, _ in sessions]
+        # /verify fills the cache, which keeps the SESSION_CACHE_SIZE most recent
+        assert list(cache._items) == tokens[1:]
+
+        hits, misses = cache_counts()
+        assert validate(client, tokens[2]).json() == {"ok": True, "expires_at": sessions[2][1]}
+        assert cache_counts() == (hits + 1, misses)
+        assert validate(client, tokens[0]).status_code == 200
+        assert cache_counts() == (hits + 1, misses + 1)
+        assert list(cache._items) == [tokens[2], tokens[0]]
+
+        # a cached session lives until its own expires_at, not a cache TTL
+        token, expires_at = sessions[2]
+        clock.offset = expires_at - int(time.time())
+        assert validate(client, token).status_code == 200
+        assert cache_counts() == (hits + 2, misses + 1)
+        clock.offset += 1
+        expired = validate(client, token)
+        assert expired.status_code == 400 and expired.json()["detail"] == "session_expired"
+        assert token not in cache._items
+        assert cache_counts() == (hits + 2, misses + 2)
+
+
+def test_session_cache_disabled(monkeypatch):
+    cache = main.SessionCache(10, False)
+    monkeypatch.setattr(main, "session_cache", cache)
+    with TestClient(main.app) as client:
+        token, expires_at = new_session(client, "cache-off")
+        counts = cache_counts()
+        assert validate(client, token).json() == {"ok": True, "expires_at": expires_at}
+        assert not cache._items and cache_counts() == counts
+        stats = client.post("/admin/stats", headers=BOT).json()["stats"]
+    assert stats["session_cache_enabled"] is False
+
+
+def test_issue_batch_checks_input():
+    with TestClient(main.app) as client:
+        def issue_batch(**body):
+            return client.post("/issue/batch", json=body, headers=BOT)
+
+        for body in ({"user_id": "  ", "count": 2}, {"user_ids": ["batch-1", " "]}, {"user_ids": []}, {}):
+            resp = issue_batch(**body)
+            assert resp.status_code == 400 and resp.json()["detail"] == "user_id_required", body
+        assert issue_batch(user_id="batch-1", count=0).json()["detail"] == "invalid_count"
+        too_many = main.ISSUE_BATCH_MAX + 1
+        assert issue_batch(user_id="batch-1", count=too_many).json()["detail"] == "batch_too_large"
+        assert issue_batch(user_ids=[f"batch-{i}" for i in range(too_many)]).json()["detail"] == "batch_too_large"
+
+        resp = issue_batch(user_id=" batch-1 ", count=3)
+        items = resp.json()["items"]
+        assert resp.status_code == 200 and [i["user_id"] for i in items] == ["batch-1"] * 3
+        assert len({i["code"] for i in items}) == 3
+
+
+def test_admin_bulk_reports_failures_per_op():
+    with TestClient(main.app) as client:
+        ops = [{"op": "set_days", "user_id": f"bulk-{i}", "days": 1} for i in range(main.BULK_MAX_OPS + 1)]
+        too_large = client.post("/admin/bulk", json={"ops": ops}, headers=BOT)
+        assert too_large.status_code == 400 and too_large.json()["detail"] == "batch_too_large"
+
+        ops = [
+            {"op": "set_days", "user_id": "bulk-ok", "days": 30},
+            {"op": "remove", "user_id": " "},
+            {"op": "approve"},
+            {"op": "explode"},
+            {"op": "remove", "user_id": "bulk-ok"},
+        ]
+        resp = client.post("/admin/bulk", json={"ops": ops}, headers=BOT).json()
+    assert resp["failed"] == 3
+    assert [r.get("detail") for r in resp["results"]] == [
+        None,
+        "user_id_required",
+        "payment_id_required",
+        "unknown_op",
+        None,
+    ]
+    assert resp["results"][0]["ok"] and resp["results"][4]["ok"]
+
+
+def test_pagination_cursors_are_always_present():
+    def pages(client, path, body, cursor):
+        seen, next_body = [], dict(body)
+        while True:
+            data = client.post(path, json=next_body, headers=BOT).json()
+            assert set(cursor) <= set(data)
+            seen.extend(data["items"])
+            if data[cursor[0]] is None:
+                assert all(data[key] is None for key in cursor)
+                return seen
+            next_body = {**body, **{key[len("next_"):]: data[key] for key in cursor}}
+
+    with TestClient(main.app) as client:
+        for i in range(3):
+            client.post("/payment/create", json={"user_id": "pages-1", "plan_months": 1, "method": "UA"}, headers=BOT)
+            op = {"op": "set_days", "user_id": f"pages-{i}", "days": 1}
+            assert client.post("/admin/bulk", json={"ops": [op]}, headers=BOT).json()["failed"] == 0
+        by_user = pages(client, "/payment/by_user", {"user_id": "pages-1", "limit": 2}, ["next_after_id"])
+        assert len(by_user) == 3
+        listed = pages(client, "/payment/list", {"limit": 2}, ["next_after_id"])
+        assert len(listed) >= 3
+        cursor = ["next_after_expires_at", "next_after_user_id"]
+        expiring = pages(client, "/sub/expiring", {"days": 2, "limit": 2}, cursor)
+        assert {"pages-0", "pages-1", "pages-2"} <= {item["user_id"] for item in expiring}
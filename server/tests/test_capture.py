@@ -0,0 +1,43 @@
+import json
+
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+
+from capture import CaptureMiddleware, TraceWriter, anonymize
+
+
+def test_anonymize_hashes_identities_and_keeps_enums():
+    body = {"user_id": "42", "status": "pending", "limit": 20, "payment_id": 7, "ops": [{"op": "remove", "user_id": "42"}]}
+    out = anonymize(body, "", b"salt")
+    assert out["status"] == "pending" and out["limit"] == 20 and out["ops"][0]["op"] == "remove"
+    assert out["user_id"].startswith("#") and out["user_id"] == out["ops"][0]["user_id"]
+    assert out["payment_id"].startswith("#")
+    assert anonymize(" v7-abcd-ef12 ", "code", b"salt") == anonymize("V7-ABCD-EF12", "code", b"salt")
+    assert anonymize("42", "user_id", b"other") != out["user_id"]
+
+
+def test_middleware_records_links_between_requests(tmp_path):
+    app = FastAPI()
+
+    @app.post("/issue")
+    def issue(body: dict):
+        return {"code": "V7-AAAA-BBBB"}
+
+    @app.post("/verify")
+    def verify(body: dict):
+        raise HTTPException(status_code=400, detail="code_used")
+
+    path = tmp_path / "trace.jsonl"
+    writer = TraceWriter(str(path))
+    writer.start()
+    app.add_middleware(CaptureMiddleware, writer=writer, salt=b"s")
+    client = TestClient(app)
+    client.post("/issue", json={"user_id": "secret-user"})
+    client.post("/verify", json={"code": "v7-aaaa-bbbb", "device_id": "dev"})
+    writer.stop()
+
+    issued, verified = [json.loads(line) for line in path.read_text().splitlines()]
+    assert "secret-user" not in path.read_text() and "AAAA" not in path.read_text()
+    assert issued["r"] == "/issue" and issued["s"] == 200 and issued["us"] > 0
+    assert verified["b"]["code"] == issued["o"]["code"]
+    assert verified["s"] == 400 and verified["d"] == "code_used"
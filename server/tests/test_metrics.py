@@ -0,0 +1,95 @@
+import json
+import os
+import subprocess
+import sys
+
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+
+import main
+import metrics
+from metrics import MetricsMiddleware, count, observe, render_prometheus
+
+
+def test_histogram_buckets_are_cumulative():
+    observe("test_latency_seconds", 0.003, (("route", "/x"),))
+    observe("test_latency_seconds", 0.2, (("route", "/x"),))
+    count("test_hits_total", (("route", '/"q"'),), 2)
+    text = render_prometheus()
+    assert "# TYPE v7ck9ll_test_latency_seconds histogram" in text
+    assert 'v7ck9ll_test_latency_seconds_bucket{route="/x",le="0.0025"} 0' in text
+    assert 'v7ck9ll_test_latency_seconds_bucket{route="/x",le="0.005"} 1' in text
+    assert 'v7ck9ll_test_latency_seconds_bucket{route="/x",le="+Inf"} 2' in text
+    assert 'v7ck9ll_test_latency_seconds_count{route="/x"} 2' in text
+    assert 'v7ck9ll_test_hits_total{route="/\\"q\\""} 2' in text
+
+
+def test_middleware_counts_routes_and_error_details():
+    app = FastAPI()
+
+    @app.post("/verify")
+    def verify(used: bool = False):
+        if used:
+            raise HTTPException(status_code=409, detail="code_used")
+        return {"ok": True}
+
+    app.add_middleware(MetricsMiddleware)
+    client = TestClient(app)
+    client.post("/verify")
+    client.post("/verify?used=1")
+    client.post("/verify?used=1")
+    client.post("/scan/../../etc/passwd")
+    series = metrics.labeled
+    assert series[("http_requests_total", (("route", "/verify"), ("status", "200")))] >= 1
+    assert series[("http_errors_total", (("route", "/verify"), ("status", "409"), ("detail", "code_used")))] >= 2
+    assert ("http_errors_total", (("route", "unmatched"), ("status", "404"), ("detail", "Not Found"))) in series
+    assert ("http_request_duration_seconds", (("route", "/verify"),)) in metrics.histograms
+
+
+def test_metrics_endpoint_requires_token_and_reports_db_time():
+    with TestClient(main.app) as client:
+        assert client.get("/metrics").status_code == 401
+        issued = client.post("/issue", json={"user_id": "metrics-1"}, headers={"X-Bot-Secret": main.BOT_SECRET})
+        assert issued.status_code == 200
+        resp = client.get("/metrics", headers={"Authorization": f"Bearer {main.BOT_SECRET}"})
+    assert resp.status_code == 200 and resp.headers["content-type"].startswith("text/plain")
+    text = resp.text
+    assert 'v7ck9ll_http_requests_total{route="/issue",status="200"}' in text
+    assert 'v7ck9ll_http_errors_total{route="/metrics",status="401",detail="unauthorized"} 1' in text
+    assert "v7ck9ll_db_lock_wait_seconds_count" in text
+    assert "# TYPE v7ck9ll_db_write_queue_depth gauge" in text
+
+
+def test_worker_files_are_merged(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "share_dir", str(tmp_path))
+    metrics.stat_inc("merge_test_total", 2)
+    metrics.stat_set("merge_test_setting", 5)
+    monkeypatch.setitem(metrics.stats, "admission_inflight", 1)
+    count("merge_test_hits_total", (("route", "/x"),))
+    metrics.flush()
+    own = json.loads((tmp_path / f"{os.getpid()}.json").read_text())
+    assert own["counters"]["merge_test_total"] >= 2
+
+    exited = subprocess.Popen([sys.executable, "-c", "pass"])
+    exited.wait()
+    workers = {os.getppid(): (3, 1), exited.pid: (7, 9)}
+    for pid, (inflight, setting) in workers.items():
+        part = {
+            "counters": {"merge_test_total": 10},
+            "gauges": {"admission_inflight": inflight, "merge_test_setting": setting},
+            "labeled": [["merge_test_hits_total", [["route", "/x"]], 4]],
+            "histograms": [],
+        }
+        (tmp_path / f"{pid}.json").write_text(json.dumps(part))
+
+    merged = metrics.snapshot()
+    assert merged["metrics_workers"] == 3
+    assert merged["merge_test_total"] == metrics.stats["merge_test_total"] + 20
+    # load gauges add up over live workers; the exited one only keeps its counters
+    assert merged["admission_inflight"] == 1 + 3
+    assert merged["merge_test_setting"] == 5
+    text = render_prometheus()
+    assert "# TYPE v7ck9ll_merge_test_total counter" in text
+    assert "v7ck9ll_admission_inflight 4" in text
+    hits = metrics.labeled[("merge_test_hits_total", (("route", "/x"),))] + 8
+    assert f'v7ck9ll_merge_test_hits_total{{route="/x"}} {hits}' in text
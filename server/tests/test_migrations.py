@@ -0,0 +1,80 @@
+import sqlite3
+
+from storage import BACKGROUND_STEPS, SCHEMA_VERSION, SqliteStorage
+
+LEGACY_SCHEMA = """
+CREATE TABLE codes (code TEXT PRIMARY KEY, user_id TEXT, expires_at INTEGER, used INTEGER DEFAULT 0);
+CREATE TABLE subscriptions (user_id TEXT PRIMARY KEY, expires_at INTEGER);
+CREATE TABLE payments (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT, plan_months INTEGER, method TEXT,
+    screenshot_file_id TEXT, status TEXT, created_at INTEGER, reviewed_at INTEGER, reviewer_id TEXT
+);
+CREATE TABLE ios_links (user_id TEXT PRIMARY KEY, name TEXT UNIQUE, code TEXT, created_at INTEGER);
+INSERT INTO codes(code, user_id, expires_at, used) VALUES ('V7-AAAA-BBBB', 'u1', 2000000000, 0);
+"""
+
+
+def done_steps(path: str) -> set:
+    conn = sqlite3.connect(path)
+    try:
+        return {row[0] for row in conn.execute("SELECT name FROM schema_steps")}
+    finally:
+        conn.close()
+
+
+def legacy_database(tmp_path) -> str:
+    path = str(tmp_path / "codes.db")
+    conn = sqlite3.connect(path)
+    conn.executescript(LEGACY_SCHEMA)
+    conn.close()
+    return path
+
+
+def test_upgrades_unversioned_database(tmp_path):
+    path = legacy_database(tmp_path)
+    store = SqliteStorage(path)
+    store.init()
+    assert store.pending_steps == [name for name, _ in BACKGROUND_STEPS]
+    store.start()
+    try:
+        store.steps.wait()
+        assert done_steps(path) == {name for name, _ in BACKGROUND_STEPS}
+        result = store.redeem_code("V7-AAAA-BBBB", "d1", 1_700_000_000, lambda d: ("tok", 1_700_000_600, True))
+        assert result["session_token"] == "tok"
+    finally:
+        store.close()
+
+    conn = sqlite3.connect(path)
+    try:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+        indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='index'")}
+        assert {name for name, _ in BACKGROUND_STEPS} <= indexes
+    finally:
+        conn.close()
+
+
+def test_current_database_skips_migrations(tmp_path):
+    path = str(tmp_path / "codes.db")
+    first = SqliteStorage(path)
+    first.init()
+    first.start()
+    first.steps.wait()
+    first.close()
+
+    second = SqliteStorage(path)
+    second.init()
+    assert second.pending_steps == []
+    second.close()
+
+
+def test_steps_can_run_offline(tmp_path):
+    path = legacy_database(tmp_path)
+    store = SqliteStorage(path, steps_in_background=False)
+    store.init()
+    store.start()
+    try:
+        assert store.steps._thread is None and done_steps(path) == set()
+        assert store.run_steps() == [name for name, _ in BACKGROUND_STEPS]
+        assert done_steps(path) == {name for name, _ in BACKGROUND_STEPS}
+    finally:
+        store.close()
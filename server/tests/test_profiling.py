@@ -0,0 +1,53 @@
+import marshal
+import pstats
+import threading
+import time
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from profiling import ProfileMiddleware, Sampler
+
+
+def busy_loop(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_cpu_sampler_sees_busy_thread_and_writes_pstats(tmp_path):
+    stop = threading.Event()
+    worker = threading.Thread(target=busy_loop, args=(stop,), name="busy")
+    worker.start()
+    sampler = Sampler(0.002, "cpu")
+    sampler.start()
+    time.sleep(0.3)
+    sampler.stop()
+    stop.set()
+    worker.join()
+
+    folded = sampler.collapsed().decode()
+    assert any(line.startswith("busy;") and "busy_loop" in line for line in folded.splitlines())
+    path = tmp_path / "cpu.pstats"
+    path.write_bytes(sampler.pstats())
+    stats = pstats.Stats(str(path)).stats
+    assert any(name == "busy_loop" for _, _, name in stats)
+    assert marshal.loads(path.read_bytes()) == stats
+
+
+def test_profile_header_replaces_response_for_admins_only():
+    app = FastAPI()
+
+    @app.post("/slow")
+    def slow():
+        time.sleep(0.05)
+        return {"ok": True}
+
+    app.add_middleware(ProfileMiddleware, secret="s")
+    client = TestClient(app)
+    assert client.post("/slow", headers={"X-Profile": "collapsed"}).json() == {"ok": True}
+    assert client.post("/slow", headers={"X-Profile": "collapsed", "X-Bot-Secret": "x"}).json() == {"ok": True}
+
+    resp = client.post("/slow", headers={"X-Profile": "collapsed", "X-Bot-Secret": "s"})
+    assert resp.headers["x-profile-status"] == "200"
+    assert "attachment" in resp.headers["content-disposition"]
+    assert "test_profiling.py:slow" in resp.text
@@ -0,0 +1,83 @@
+import anyio
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from ratelimit import AdmissionMiddleware, Rule, TokenBuckets, parse_rules
+
+
+def test_parse_rules():
+    assert parse_rules("/issue=30/60@user_id, /verify=5@ip,,/validate=10/2") == [
+        Rule("/issue", "user_id", 30, 60),
+        Rule("/verify", "ip", 5, 1),
+        Rule("/validate", "ip", 10, 2),
+    ]
+    with pytest.raises(ValueError):
+        parse_rules("/issue=1/1@token")
+
+
+def test_token_bucket_refills_and_bounds_keys():
+    buckets = TokenBuckets(Rule("/x", "ip", 2, 10), max_keys=2)
+    assert buckets.take("a", 0) == 0 and buckets.take("a", 0) == 0
+    assert buckets.take("a", 0) == pytest.approx(5)
+    assert buckets.take("a", 5) == 0
+    buckets.take("b", 5)
+    buckets.take("c", 5)
+    assert list(buckets.buckets) == ["b", "c"]
+
+
+def make_client(rules, max_concurrency=0):
+    app = FastAPI()
+
+    @app.post("/issue")
+    async def issue(body: dict):
+        return {"ok": True, "user_id": body.get("user_id")}
+
+    @app.post("/slow")
+    async def slow():
+        await anyio.sleep(0.2)
+        return {"ok": True}
+
+    app.add_middleware(AdmissionMiddleware, rules=parse_rules(rules), max_concurrency=max_concurrency)
+    return TestClient(app)
+
+
+def test_limits_per_body_key_and_replays_body():
+    client = make_client("/issue=2/3600@user_id")
+    for _ in range(2):
+        assert client.post("/issue", json={"user_id": "a"}).json() == {"ok": True, "user_id": "a"}
+    limited = client.post("/issue", json={"user_id": "a"})
+    assert limited.status_code == 429 and limited.json() == {"detail": "rate_limited"}
+    assert int(limited.headers["retry-after"]) >= 1
+    assert client.post("/issue", json={"user_id": "b"}).status_code == 200
+    # requests without the key share the client's ip bucket
+    assert client.post("/issue", json={}).status_code == 200
+
+
+def test_concurrency_cap_sheds_load():
+    client = make_client("", max_concurrency=1)
+    results = []
+
+    async def call():
+        results.append(await anyio.to_thread.run_sync(lambda: client.post("/slow").status_code))
+
+    async def run():
+        async with anyio.create_task_group() as tg:
+            for _ in range(4):
+                tg.start_soon(call)
+
+    with client:
+        anyio.run(run)
+    assert sorted(results)[0] == 200 and 429 in results
+
+
+def test_client_ip_takes_entry_appended_by_trusted_proxy():
+    scope = {
+        "client": ("10.0.0.1", 1234),
+        "headers": [(b"x-forwarded-for", b"6.6.6.6, 1.1.1.1"), (b"x-forwarded-for", b"2.2.2.2")],
+    }
+    assert AdmissionMiddleware(None, [], trusted_hops=0).client_ip(scope) == "10.0.0.1"
+    assert AdmissionMiddleware(None, [], trusted_hops=1).client_ip(scope) == "2.2.2.2"
+    assert AdmissionMiddleware(None, [], trusted_hops=2).client_ip(scope) == "1.1.1.1"
+    # fewer entries than proxies: the request did not come through them
+    assert AdmissionMiddleware(None, [], trusted_hops=4).client_ip(scope) == "10.0.0.1"
@@ -0,0 +1,287 @@
+import secrets
+import sqlite3
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+from storage import MemoryStorage, ShardedStorage, SqliteStorage
+
+NOW = 1_700_000_000
+MONTH = 30 * 24 * 60 * 60
+
+
+@pytest.fixture(params=["sqlite", "sharded", "memory"])
+def store(request, tmp_path):
+    if request.param == "sqlite":
+        backend = SqliteStorage(str(tmp_path / "codes.db"), month_seconds=MONTH)
+    elif request.param == "sharded":
+        backend = ShardedStorage(str(tmp_path / "codes.db"), 3, month_seconds=MONTH)
+    else:
+        backend = MemoryStorage(month_seconds=MONTH)
+    backend.init()
+    backend.start()
+    yield backend
+    backend.close()
+
+
+def table_session(device_id: str):
+    return secrets.token_urlsafe(16), NOW + 600, True
+
+
+def detail(fn, *args):
+    with pytest.raises(HTTPException) as e:
+        fn(*args)
+    return e.value.detail
+
+
+def test_issue_and_redeem(store):
+    code_a, code_b = store.issue_codes(["u1", "u2"], NOW + 600)
+    assert code_a != code_b
+    fresh = store.redeem_code(code_a, "d1", NOW, table_session)
+    assert fresh["ok"] and "reused" not in fresh
+    assert store.get_session(fresh["session_token"]) == NOW + 600
+
+    reused = store.redeem_code(code_a, "d1", NOW + 1, table_session)
+    assert reused["reused"] and reused["session_token"] == fresh["session_token"]
+    assert detail(store.redeem_code, code_a, "d2", NOW, table_session) == "code_used"
+    assert detail(store.redeem_code, "V7-0000-0000", "d1", NOW, table_session) == "invalid_code"
+    assert detail(store.redeem_code, code_b, "d1", NOW + 601, table_session) == "code_expired"
+
+
+def test_unpersisted_session_is_not_stored(store):
+    (code,) = store.issue_codes(["u1"], NOW + 600)
+    result = store.redeem_code(code, "d1", NOW, lambda d: ("v1.signed", NOW + 600, False))
+    assert result["session_token"] == "v1.signed"
+    assert store.get_session("v1.signed") is None
+    assert store.get_session("missing") is None
+
+
+def test_purge_expired(store):
+    old, used = store.issue_codes(["u1", "u2"], NOW - 10)
+    store.issue_codes(["u3"], NOW + 600)
+    store.redeem_code(used, "d1", NOW - 20, lambda d: ("tok", NOW - 5, True))
+    assert store.purge_expired("codes", NOW, 100) == 1
+    assert detail(store.redeem_code, old, "d1", NOW - 20, table_session) == "invalid_code"
+    assert store.purge_expired("sessions", NOW, 100) == 1
+    assert store.get_session("tok") is None
+
+
+def test_payment_review_extends_subscription(store):
+    pid = store.create_payment("u1", 2, "UA", NOW)
+    store.attach_screenshot(pid, "file")
+    approved = store.review_payment(pid, "admin", True, NOW)
+    assert approved == {"ok": True, "user_id": "u1", "expires_at": NOW + 2 * MONTH}
+    payment = store.get_payment(pid)
+    assert payment["status"] == "approved" and payment["screenshot_file_id"] == "file"
+    assert detail(store.review_payment, pid, "admin", False, NOW) == "payment_not_pending"
+    assert detail(store.attach_screenshot, pid, "x") == "payment_not_pending"
+    assert detail(store.attach_screenshot, 10**6, "x") == "payment_not_found"
+    assert store.get_payment(10**6) is None
+
+    second = store.create_payment("u1", 1, "UA", NOW)
+    assert store.review_payment(second, None, True, NOW)["expires_at"] == NOW + 3 * MONTH
+    rejected = store.create_payment("u1", 1, "UA", NOW)
+    assert store.review_payment(rejected, None, False, NOW) == {"ok": True, "user_id": "u1"}
+
+
+def collect(page, limit):
+    seen, after = [], None
+    while True:
+        items = page(after, limit)
+        seen += [item["id"] for item in items]
+        if len(items) < limit:
+            return seen
+        after = items[-1]["id"]
+
+
+def test_payment_pagination(store):
+    ids = [store.create_payment(f"u{i % 3}", 1, "UA", NOW) for i in range(23)]
+    store.review_payment(ids[4], None, False, NOW)
+    everything = collect(lambda after, limit: store.list_payments(None, after, limit), 5)
+    assert everything == sorted(ids, reverse=True)
+    pending = collect(lambda after, limit: store.list_payments("pending", after, limit), 4)
+    assert pending == sorted(set(ids) - {ids[4]}, reverse=True)
+    mine = collect(lambda after, limit: store.payments_by_user("u1", after, limit), 3)
+    assert mine == sorted(ids[1::3], reverse=True)
+    assert set(store.list_payments(None, None, 1)[0]) == {
+        "id", "user_id", "plan_months", "method", "status", "created_at"
+    }
+
+
+def test_subscriptions(store):
+    for i in range(7):
+        store.set_subscription_days(f"u{i}", i + 1, NOW)
+    store.set_subscription_days("tie", 3, NOW)
+    rows, after = [], (None, None)
+    while True:
+        page = store.list_expiring(NOW + 30 * 86400, 3, *after)
+        rows += page
+        if len(page) < 3:
+            break
+        after = (page[-1][1], page[-1][0])
+    assert [r[0] for r in rows] == ["u0", "u1", "tie", "u2", "u3", "u4", "u5", "u6"]
+    assert store.list_expiring(NOW + 2 * 86400, 10, None, None) == [("u0", NOW + 86400), ("u1", NOW + 2 * 86400)]
+
+    assert store.remove_subscription("u0") == {"ok": True, "removed": True, "old_expires_at": NOW + 86400}
+    assert store.remove_subscription("u0") == {"ok": True, "removed": False}
+    assert store.set_subscription_days("u1", 0, NOW)["removed"] is True
+    assert store.list_expiring(NOW + 2 * 86400, 10, None, None) == []
+
+
+def op(name, **fields):
+    return SimpleNamespace(op=name, **{"user_id": None, "days": None, "payment_id": None, "reviewer_id": None, **fields})
+
+
+def test_bulk_isolates_failures(store):
+    pid = store.create_payment("u9", 1, "UA", NOW)
+    results = store.bulk(
+        [
+            op("set_days", user_id=" u1 ", days=5),
+            op("approve", payment_id=pid, reviewer_id="r"),
+            op("approve", payment_id=pid),
+            op("reject", payment_id=10**6),
+            op("remove", user_id="u1"),
+            op("set_days", user_id="u2", days=-1),
+            op("set_days"),
+            op("nope"),
+        ],
+        NOW,
+    )
+    assert [r["ok"] for r in results] == [True, True, False, False, True, False, False, False]
+    assert [r.get("detail") for r in results[2:4]] == ["payment_not_pending", "payment_not_found"]
+    assert [r["detail"] for r in results[5:]] == ["invalid_days", "user_id_required", "unknown_op"]
+    assert store.get_payment(pid)["status"] == "approved"
+    assert store.list_expiring(NOW + 10 * MONTH, 10, None, None) == [("u9", NOW + MONTH)]
+
+
+def test_ios_links(store):
+    assert store.get_ios_link("u1") is None
+    store.create_ios_link("u1", "name", "IOS-1", NOW)
+    assert store.get_ios_link("u1") == {"name": "name", "code": "IOS-1", "created_at": NOW}
+    assert store.ios_name_taken("name") and not store.ios_name_taken("other")
+    assert detail(store.create_ios_link, "u2", "name", "IOS-2", NOW) == "name_taken"
+    assert detail(store.create_ios_link, "u1", "other", "IOS-3", NOW) == "name_taken"
+    assert not store.ios_name_taken("other")
+
+
+def test_sharded_issue_failure_leaves_no_codes(tmp_path, monkeypatch):
+    store = ShardedStorage(str(tmp_path / "codes.db"), 3)
+    store.init()
+    store.start()
+    try:
+        user_ids = [f"u{i}" for i in range(12)]
+        order = list(dict.fromkeys(store.user_shard(u) for u in user_ids))
+        assert len(order) == 3
+        # fail the last shard written so the first two have to be undone
+        failing = store.shards[order[-1]]
+
+        def broken(fn):
+            raise HTTPException(status_code=503, detail="shard_down")
+
+        monkeypatch.setattr(failing, "write", broken)
+        assert detail(store.issue_codes, user_ids, NOW + 600) == "shard_down"
+        for shard in [store.directory, *store.shards]:
+            with shard.pool.connection() as conn:
+                table = "code_shards" if shard is store.directory else "codes"
+                assert conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] == 0
+    finally:
+        store.close()
+
+
+def test_archive_keeps_payments_and_codes_reachable(store):
+    day = 24 * 60 * 60
+    (code,) = store.issue_codes(["u1"], NOW - 100 * day + 600)
+    store.redeem_code(code, "d1", NOW - 100 * day, table_session)
+    old = [store.create_payment("u1", 1, "UA", NOW - 100 * day) for _ in range(3)]
+    for pid in old:
+        store.review_payment(pid, "r", True, NOW - 100 * day)
+    pending = store.create_payment("u1", 1, "UA", NOW - 100 * day)
+    fresh = store.create_payment("u1", 1, "UA", NOW)
+    store.review_payment(fresh, "r", False, NOW)
+
+    assert store.archive(NOW - 90 * day, 2) == (2, 1)
+    assert store.archive(NOW - 90 * day, 2) == (1, 0)
+    assert store.archive(NOW - 90 * day, 2) == (0, 0)
+
+    assert store.get_payment(old[0])["status"] == "approved"
+    assert [p["id"] for p in store.payments_by_user("u1", None, 10)] == sorted([*old, pending, fresh], reverse=True)
+    assert [p["id"] for p in store.payments_by_user("u1", old[2], 2)] == [old[1], old[0]]
+    assert [p["id"] for p in store.list_payments(None, None, 10)] == sorted([pending, fresh], reverse=True)
+    assert detail(store.redeem_code, code, "d1", NOW, table_session) == "code_expired"
+    assert detail(store.review_payment, old[0], "r", True, NOW) == "payment_not_pending"
+    assert detail(store.attach_screenshot, old[0], "file") == "payment_not_pending"
+    assert detail(store.review_payment, 10**9, "r", True, NOW) == "payment_not_found"
+    assert store.create_payment("u2", 1, "UA", NOW) not in old
+
+
+def test_archive_copy_survives_interrupted_drop(tmp_path):
+    store = SqliteStorage(str(tmp_path / "codes.db"))
+    store.init()
+    store.start()
+    try:
+        pid = store.create_payment("u1", 1, "UA", NOW)
+        store.review_payment(pid, "r", True, NOW)
+        # a crash after the copy committed: the row is in both files
+        assert store.write(lambda ops: ops.archive_copy(NOW + 1, 10)) == ([pid], [])
+        with store.pool.connection() as conn:
+            assert conn.execute("SELECT COUNT(*) FROM main.payments").fetchone()[0] == 1
+            assert conn.execute("SELECT COUNT(*) FROM archive.payments").fetchone()[0] == 1
+        assert store.payments_by_user("u1", None, 10)[0]["id"] == pid
+        assert len(store.payments_by_user("u1", None, 10)) == 1
+        assert store.archive(NOW + 1, 10) == (1, 0)
+        with store.pool.connection() as conn:
+            assert conn.execute("SELECT COUNT(*) FROM main.payments").fetchone()[0] == 0
+        assert store.get_payment(pid)["status"] == "approved"
+    finally:
+        store.close()
+
+
+def test_incremental_vacuum_conversion_is_explicit(tmp_path):
+    path = str(tmp_path / "codes.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE legacy(x)")
+    conn.close()
+    store = SqliteStorage(path)
+    store.init()
+    auto_vacuum = lambda: sqlite3.connect(path).execute("PRAGMA auto_vacuum").fetchone()[0]  # noqa: E731
+    assert auto_vacuum() == 0
+    assert store.convert_incremental_vacuum() is True
+    assert auto_vacuum() == 2
+    assert store.convert_incremental_vacuum() is False
+    store.close()
+
+    fresh = SqliteStorage(str(tmp_path / "fresh.db"))
+    fresh.init()
+    assert sqlite3.connect(str(tmp_path / "fresh.db")).execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    fresh.close()
+
+
+def test_introspect_reports_row_counts(store):
+    store.issue_codes(["u1", "u2"], NOW + 600)
+    info = store.introspect()
+    if "memory" in info:
+        assert info["memory"]["tables"]["codes"]["rows"] == 2
+        return
+    dbs = info["shards"] if "shards" in info else [info]
+    assert sum(db["main"]["tables"]["codes"]["rows"] for db in dbs) == 2
+    main = dbs[0]["main"]
+    assert main["page_count"] > 0 and main["freelist_count"] >= 0 and main["wal_bytes"] >= 0
+    assert main["tables"]["payments"]["pages"] >= 1
+    assert "archive" in dbs[0]
+
+
+def test_slow_queries_are_logged_with_plan(tmp_path, caplog):
+    from storage import slow_queries
+
+    backend = SqliteStorage(str(tmp_path / "codes.db"), month_seconds=MONTH, slow_query_ms=1e-6)
+    backend.init()
+    backend.start()
+    try:
+        slow_queries.clear()
+        backend.list_payments("pending", None, 10)
+    finally:
+        backend.close()
+    entry = next(e for e in slow_queries if e["sql"].startswith("SELECT") and "payments" in e["sql"])
+    assert entry["plan"] and "?" in entry["sql"]
+    assert "slow query" in caplog.text
@@ -0,0 +1,50 @@
+import json
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from capture import TraceWriter
+from tracing import TraceMiddleware, span
+
+PARENT = "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01"
+
+
+def make_client(writer):
+    app = FastAPI()
+
+    @app.post("/issue")
+    def issue():
+        with span("secret_check"):
+            pass
+        return {"ok": True}
+
+    app.add_middleware(TraceMiddleware, writer=writer)
+    return TestClient(app)
+
+
+def test_traceparent_is_continued_and_exported(tmp_path):
+    path = tmp_path / "spans.jsonl"
+    writer = TraceWriter(str(path), name="trace_export")
+    writer.start()
+    client = make_client(writer)
+    resp = client.post("/issue", headers={"traceparent": PARENT})
+    client.post("/issue", headers={"traceparent": PARENT[:-2] + "00"})
+    fresh = client.post("/issue", headers={"traceparent": "garbage"})
+    writer.stop()
+
+    version, trace_id, span_id, flags = resp.headers["traceresponse"].split("-")
+    assert trace_id == "0af7651916cd43dd8448eb211c80319c" and flags == "01"
+    assert fresh.headers["traceresponse"].split("-")[1] != trace_id
+    lines = [json.loads(line) for line in path.read_text().splitlines()]
+    # the unsampled request is not exported
+    assert len(lines) == 2
+    assert lines[0]["span_id"] == span_id and lines[0]["parent_id"] == "b7ad6b7169203331"
+    assert lines[0]["name"] == "POST /issue" and lines[0]["status"] == 200
+    assert [s["name"] for s in lines[0]["spans"]] == ["secret_check"]
+    assert lines[1]["parent_id"] is None
+
+
+def test_ids_are_returned_without_exporter():
+    resp = make_client(None).post("/issue", headers={"traceparent": PARENT})
+    assert resp.headers["traceresponse"].split("-")[1] == "0af7651916cd43dd8448eb211c80319c"
+    assert resp.headers["traceresponse"].endswith("-00")
@@ -0,0 +1,121 @@
+import os
+import random
+import re
+import time
+from contextlib import nullcontext
+from contextvars import ContextVar
+from typing import Optional
+
+from capture import TraceWriter
+
+# W3C trace context: "traceparent: 00-<trace id>-<parent span id>-<flags>" is
+# accepted from callers (the bot) and "traceresponse" carries this server's
+# span back. Exported requests are one JSON line each, with the internal
+# phases as child spans.
+TRACEPARENT = re.compile(rb"00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})")
+NOOP = nullcontext()
+
+
+class Trace:
+    __slots__ = ("trace_id", "span_id", "parent_id", "epoch", "started", "spans")
+
+    def __init__(self, trace_id: str, parent_id: Optional[str], sampled: bool):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.epoch = time.time()
+        self.started = time.perf_counter()
+        # None while not exported: phases then cost one ContextVar lookup
+        self.spans: Optional[list] = [] if sampled else None
+
+    def add(self, name: str, started: float, elapsed: float, **attrs):
+        if self.spans is not None:
+            self.spans.append(
+                {"name": name, "at_ms": round((started - self.started) * 1000, 3), "ms": round(elapsed * 1000, 3), **attrs}
+            )
+
+
+current: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+
+
+class Span:
+    __slots__ = ("trace", "name", "started")
+
+    def __init__(self, trace: Trace, name: str):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.trace.add(self.name, self.started, time.perf_counter() - self.started)
+        return False
+
+
+def span(name: str):
+    trace = current.get()
+    if trace is None or trace.spans is None:
+        return NOOP
+    return Span(trace, name)
+
+
+def record(name: str, started: float, elapsed: float, **attrs):
+    # for phases timed elsewhere, e.g. by the writer thread
+    trace = current.get()
+    if trace is not None and trace.spans is not None:
+        trace.add(name, started, elapsed, **attrs)
+
+
+class TraceMiddleware:
+    def __init__(self, app, writer: Optional[TraceWriter], sample_rate: float = 1.0):
+        self.app = app
+        self.writer = writer
+        self.sample_rate = sample_rate
+
+    def incoming(self, scope) -> Trace:
+        for name, value in scope.get("headers", []):
+            if name == b"traceparent":
+                match = TRACEPARENT.fullmatch(value.strip().lower())
+                if match and match.group(1) != b"0" * 32:
+                    sampled = self.writer is not None and bool(int(match.group(3), 16) & 1)
+                    return Trace(match.group(1).decode(), match.group(2).decode(), sampled)
+                break
+        sampled = self.writer is not None and random.random() < self.sample_rate
+        return Trace(os.urandom(16).hex(), None, sampled)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        trace = self.incoming(scope)
+        token = current.set(trace)
+        header = f"00-{trace.trace_id}-{trace.span_id}-{'01' if trace.spans is not None else '00'}".encode()
+        status = 500
+
+        async def send_traced(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message = {**message, "headers": [*message.get("headers", []), (b"traceresponse", header)]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_traced)
+        finally:
+            current.reset(token)
+            if trace.spans is not None:
+                route = scope.get("route")
+                self.writer.put(
+                    {
+                        "service": "server",
+                        "trace_id": trace.trace_id,
+                        "span_id": trace.span_id,
+                        "parent_id": trace.parent_id,
+                        "name": f"{scope['method']} {route.path if route is not None else scope['path'][:128]}",
+                        "start": round(trace.epoch, 6),
+                        "ms": round((time.perf_counter() - trace.started) * 1000, 3),
+                        "status": status,
+                        "spans": trace.spans,
+                    }
+                )